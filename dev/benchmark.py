@@ -0,0 +1,440 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+import pipeline
+from pipeline import create_db_engine, get_dataframes, process_dataframes, process_students, \
+					update_db_tables, merge_df, stage, enable_wal, get_dataframes_parallel, SOURCE_TABLES, \
+					process_students_parallel
+
+
+# Raw schemas of the source database, as found in cademycode.db
+SOURCE_SCHEMA = [
+	"""CREATE TABLE cademycode_students (
+	uuid INTEGER,
+	name VARCHAR,
+	dob VARCHAR,
+	sex TEXT,
+	contact_info JSON,
+	job_id VARCHAR,
+	num_course_taken VARCHAR,
+	current_career_path_id VARCHAR,
+	time_spent_hrs VARCHAR
+)""",
+	"""CREATE TABLE cademycode_courses (
+	career_path_id BIGINT,
+	career_path_name TEXT,
+	hours_to_complete BIGINT
+)""",
+	"""CREATE TABLE cademycode_student_jobs (
+	job_id BIGINT,
+	job_category TEXT,
+	avg_salary BIGINT
+)""",
+]
+
+# The dimension tables are small and fixed, cademycode_student_jobs carries the same duplicated rows as the real one
+JOBS = [
+	(1, 'analytics', 86000), (2, 'engineer', 101000), (3, 'software developer', 110000),
+	(4, 'creative', 66000), (5, 'financial services', 135000), (6, 'education', 61000),
+	(7, 'HR', 80000), (8, 'student', 10000), (9, 'healthcare', 120000), (0, 'other', 80000),
+	(3, 'software developer', 110000), (4, 'creative', 66000), (5, 'financial services', 135000),
+]
+COURSES = [
+	(1, 'data scientist', 20), (2, 'data engineer', 20), (3, 'data analyst', 12),
+	(4, 'software engineering', 25), (5, 'backend engineer', 18), (6, 'frontend engineer', 20),
+	(7, 'iOS developer', 27), (8, 'android developer', 27), (9, 'machine learning engineer', 35),
+	(10, 'ux/ui designer', 15),
+]
+
+FIRST_NAMES = ['Annabelle', 'Micah', 'Hosea', 'Mariann', 'Lucio', 'Lakita', 'Georgia', 'Dorian', 'Ines', 'Tobias']
+LAST_NAMES = ['Avery', 'Rubio', 'Dale', 'Kirk', 'Alexander', 'Richardson', 'Patton', 'Lowe', 'Meyer', 'Quinn']
+STREETS = ['N Timber Key', 'Crescent Fair', 'Cinder Cliff', 'Umber Forge Land', 'Squaw Tunnel']
+STATES = ['Wisconsin', 'Indiana', 'Virginia', 'Arkansas', 'Rhode Island', 'Montana', 'Massachusetts']
+EMAIL_DOMAINS = ['woohoo.com', 'hmail.com', 'coldmail.com']
+
+# Share of NULLs per column, close to what cademycode_updated.db contains
+NULL_RATES = {
+	'job_id': 0.002,
+	'num_course_taken': 0.045,
+	'current_career_path_id': 0.08,
+}
+
+
+# The per-column cleaning that process_students replaced, kept as the benchmark baseline
+def legacy_process_students(df_students):
+	df_students['dob'] = pd.to_datetime(df_students['dob'], errors='coerce')
+	df_students['job_id'] = pd.to_numeric(df_students['job_id'], errors='coerce')
+	df_students['num_course_taken'] = pd.to_numeric(df_students['num_course_taken'], errors='coerce')
+	df_students['time_spent_hrs'] = pd.to_numeric(df_students['time_spent_hrs'], errors='coerce')
+	df_students['current_career_path_id'] = pd.to_numeric(df_students['current_career_path_id'], errors='coerce')
+
+	df_students_clean = df_students.copy()
+	nan_counts = df_students_clean.isna().sum()
+	if (nan_counts != 0).any():
+		df_students_clean = df_students.dropna(subset=['job_id', 'num_course_taken', 'current_career_path_id', 'time_spent_hrs']).copy()
+
+	df_students_clean['dob'] = df_students_clean['dob'].astype('datetime64[ns]')
+	df_students_clean['job_id'] = df_students_clean['job_id'].astype(int)
+	df_students_clean['num_course_taken'] = df_students_clean['num_course_taken'].astype(int)
+	df_students_clean['time_spent_hrs'] = df_students_clean['time_spent_hrs'].astype(float)
+	df_students_clean['contact_info'] = df_students_clean['contact_info'].apply(json.dumps)
+	df_students_clean['current_career_path_id'] = df_students_clean['current_career_path_id'].astype(int)
+	return df_students_clean
+
+
+# Best wall time of several rounds, each on a fresh copy of the input
+def best_of(func, df, rounds):
+	timings = []
+	for _ in range(rounds):
+		data = df.copy()
+		start = time.perf_counter()
+		func(data)
+		timings.append(time.perf_counter() - start)
+	return min(timings)
+
+
+# Time the legacy cleaning against process_students on the students table repeated `repeat` times
+def bench_cleaning(db_url, repeat=100, rounds=3):
+	engine = create_db_engine(db_url)
+	changelog = logging.getLogger('benchmark')
+
+	# The legacy cleaning was fed by read_sql_table, which decodes contact_info into dicts
+	legacy_input = pd.concat([pd.read_sql_table('cademycode_students', engine)] * repeat, ignore_index=True)
+	spec_input = pd.concat([pd.read_sql(text("SELECT * FROM cademycode_students"), engine)] * repeat, ignore_index=True)
+	engine.dispose()
+
+	legacy_seconds = best_of(legacy_process_students, legacy_input, rounds)
+	spec_seconds = best_of(lambda df: process_students(df, changelog), spec_input, rounds)
+
+	return {
+		'benchmark': 'clean_students',
+		'rows': len(spec_input),
+		'legacy_seconds': round(legacy_seconds, 4),
+		'spec_seconds': round(spec_seconds, 4),
+		'speedup': round(legacy_seconds / spec_seconds, 1),
+	}
+
+
+def best_time(func, rounds):
+	timings = []
+	for _ in range(rounds):
+		start = time.perf_counter()
+		func()
+		timings.append(time.perf_counter() - start)
+	return min(timings)
+
+
+# Time sequential extraction against the thread pool at each worker count
+def bench_extraction(db_path, workers=(2, 4, 8), chunksize=100000, rounds=3):
+	changelog = logging.getLogger('benchmark')
+	engine = create_db_engine(f"sqlite:///{db_path}")
+	enable_wal(engine)
+	results = {'benchmark': 'extract', 'db': os.path.basename(db_path)}
+	results['sequential_seconds'] = round(best_time(lambda: get_dataframes(engine, changelog), rounds), 4)
+	engine.dispose()
+
+	for count in workers:
+		read_engine = create_db_engine(f"sqlite:///{db_path}", pool_size=count, read_only=True)
+		seconds = best_time(lambda: get_dataframes_parallel(read_engine, changelog, count, chunksize, SOURCE_TABLES), rounds)
+		results[f"workers_{count}_seconds"] = round(seconds, 4)
+		read_engine.dispose()
+	return results
+
+
+# Time process_students against the process pool at each process count, on the students as get_dataframes reads them
+def bench_parallel_cleaning(db_path, processes=(2, 4, 8), rounds=3):
+	changelog = logging.getLogger('benchmark')
+	engine = create_db_engine(f"sqlite:///{db_path}")
+	df_students = pd.read_sql(text("SELECT * FROM cademycode_students"), engine)
+	engine.dispose()
+
+	results = {'benchmark': 'parallel_clean', 'rows': len(df_students), 'cpus': os.cpu_count()}
+	results['sequential_seconds'] = round(best_time(lambda: process_students(df_students, changelog), rounds), 4)
+	for count in processes:
+		seconds = best_time(lambda: process_students_parallel(df_students, changelog, count), rounds)
+		results[f"processes_{count}_seconds"] = round(seconds, 4)
+	return results
+
+
+# Synthetic students in the raw source format: VARCHAR numerics, JSON contact_info and injected NULLs
+def generate_students(start_uuid, n_students, rng):
+	uuid = np.arange(start_uuid, start_uuid + n_students)
+	first = np.array(FIRST_NAMES, dtype=object)[rng.integers(0, len(FIRST_NAMES), n_students)]
+	last = np.array(LAST_NAMES, dtype=object)[rng.integers(0, len(LAST_NAMES), n_students)]
+	dob = np.datetime64('1940-01-01') + rng.integers(0, 65 * 365, n_students).astype('timedelta64[D]')
+
+	street = np.array(STREETS, dtype=object)[rng.integers(0, len(STREETS), n_students)]
+	state = np.array(STATES, dtype=object)[rng.integers(0, len(STATES), n_students)]
+	domain = np.array(EMAIL_DOMAINS, dtype=object)[rng.integers(0, len(EMAIL_DOMAINS), n_students)]
+	house = rng.integers(1, 999, n_students).astype(str).astype(object)
+	zip_code = rng.integers(10000, 99999, n_students).astype(str).astype(object)
+	contact_info = ('{"mailing_address": "' + house + ' ' + street + ', Springfield, ' + state + ', ' + zip_code +
+					'", "email": "' + last + uuid.astype(str).astype(object) + '@' + domain + '"}')
+
+	career_path_id = rng.integers(1, 11, n_students).astype(float)
+	time_spent_hrs = np.round(rng.uniform(0, 36, n_students), 2)
+
+	df = pd.DataFrame({
+		'uuid': uuid,
+		'name': first + ' ' + last,
+		'dob': np.datetime_as_string(dob, unit='D'),
+		'sex': np.array(['F', 'M', 'N'], dtype=object)[rng.choice(3, n_students, p=[0.4, 0.4, 0.2])],
+		'contact_info': contact_info,
+		'job_id': rng.integers(0, 10, n_students).astype(float).astype(str),
+		'num_course_taken': rng.integers(0, 16, n_students).astype(float).astype(str),
+		'current_career_path_id': career_path_id.astype(str),
+		'time_spent_hrs': time_spent_hrs.astype(str),
+	}).astype(object)
+
+	for column, rate in NULL_RATES.items():
+		df.loc[rng.random(n_students) < rate, column] = None
+	# Students without a career path have no time spent either
+	df.loc[df['current_career_path_id'].isna(), 'time_spent_hrs'] = None
+	return df
+
+
+# Write a database with the cademycode schemas and n_students synthetic students, in batches to bound memory
+def generate_cademycode_db(path, n_students, seed=0, batch_size=200000):
+	rng = np.random.default_rng(seed)
+	if os.path.exists(path):
+		os.remove(path)
+
+	connection = sqlite3.connect(path)
+	try:
+		for statement in SOURCE_SCHEMA:
+			connection.execute(statement)
+		connection.executemany("INSERT INTO cademycode_student_jobs VALUES (?, ?, ?)", JOBS)
+		connection.executemany("INSERT INTO cademycode_courses VALUES (?, ?, ?)", COURSES)
+
+		for start in range(0, n_students, batch_size):
+			df = generate_students(start + 1, min(batch_size, n_students - start), rng)
+			df['uuid'] = df['uuid'].astype(int)
+			connection.executemany("INSERT INTO cademycode_students VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+								   df.itertuples(index=False, name=None))
+		connection.commit()
+	finally:
+		connection.close()
+	return path
+
+
+# Run the pipeline stages on a copy of db_path and time each of them
+def bench_stages(db_path, work_dir):
+	changelog = logging.getLogger('benchmark')
+	pipeline.changelog = changelog
+
+	work_db = os.path.join(work_dir, 'cademycode.db')
+	shutil.copy(db_path, work_db)
+	engine = create_db_engine(f"sqlite:///{work_db}")
+	metrics = []
+
+	with stage('get_dataframes', metrics, 'benchmark') as record:
+		dataframes = get_dataframes(engine, changelog)
+		record['rows_out'] = len(dataframes['cademycode_students'])
+
+	with stage('process_dataframes', metrics, 'benchmark', rows_in=record['rows_out']) as record:
+		df_students, df_jobs, df_courses = process_dataframes(dataframes, changelog)
+		record['rows_out'] = len(df_students)
+	del dataframes
+
+	with stage('update_db_tables', metrics, 'benchmark', rows_in=len(df_students)) as record:
+		update_db_tables(engine, df_students, df_jobs, df_courses)
+		record['rows_out'] = len(df_students)
+
+	with stage('merge_df', metrics, 'benchmark', rows_in=len(df_students)) as record:
+		merged_df = merge_df(df_students, df_jobs, df_courses, changelog)
+		record['rows_out'] = len(merged_df)
+
+	with stage('to_csv', metrics, 'benchmark', rows_in=len(merged_df)) as record:
+		merged_df.to_csv(os.path.join(work_dir, 'merged_data.csv'), index=False)
+		record['rows_out'] = len(merged_df)
+
+	engine.dispose()
+	return [{key: value for key, value in record.items() if key not in ('version', 'started_at')} for record in metrics]
+
+
+# Commit the results belong to, so runs can be compared across commits
+def git_revision():
+	try:
+		return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+							  check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+# Benchmark each size in its own interpreter so one size does not warm up or bloat the next
+def bench_pipeline(sizes, data_dir, seed=0):
+	os.makedirs(data_dir, exist_ok=True)
+	run = {
+		'revision': git_revision(),
+		'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+		'python': platform.python_version(),
+		'pandas': pd.__version__,
+	}
+	records = []
+	for size in sizes:
+		db_path = os.path.join(data_dir, f"cademycode_{size}_{seed}.db")
+		if not os.path.exists(db_path):
+			generate_cademycode_db(db_path, size, seed)
+
+		output = subprocess.run([sys.executable, os.path.abspath(__file__), 'stages', db_path],
+								capture_output=True, text=True, check=True).stdout
+		for result in json.loads(output):
+			records.append({**run, 'size': size, **result})
+	return records
+
+
+# Time fresh interpreters running the pipeline from a build directory laid out like the real one.
+# After a first run has saved the state, 'noop' finds the database file unchanged, 'touched' finds it
+# touched but with the same row counts; 'import' only imports the module.
+def bench_startup(db_path, runs=10):
+	work_dir = tempfile.mkdtemp()
+	try:
+		build_dir = os.path.join(work_dir, 'build')
+		os.mkdir(build_dir)
+		shutil.copy(db_path, os.path.join(work_dir, 'cademycode.db'))
+		shutil.copy(pipeline.__file__, build_dir)
+
+		def timed(command, before=None):
+			timings = []
+			for _ in range(runs):
+				if before:
+					before()
+				start = time.perf_counter()
+				subprocess.run(command, cwd=build_dir, capture_output=True, check=True)
+				timings.append(time.perf_counter() - start)
+			return round(min(timings), 4), round(sorted(timings)[len(timings) // 2], 4)
+
+		subprocess.run([sys.executable, 'pipeline.py'], cwd=build_dir, capture_output=True, check=True)
+		results = {'benchmark': 'startup', 'runs': runs}
+		commands = {
+			'interpreter': ([sys.executable, '-c', 'pass'], None),
+			'import': ([sys.executable, '-c', 'import pipeline'], None),
+			'noop': ([sys.executable, 'pipeline.py'], None),
+			'touched': ([sys.executable, 'pipeline.py'], lambda: os.utime(os.path.join(work_dir, 'cademycode.db'))),
+		}
+		for name, (command, before) in commands.items():
+			results[f"{name}_best_seconds"], results[f"{name}_median_seconds"] = timed(command, before)
+		return results
+	finally:
+		shutil.rmtree(work_dir)
+
+
+# Compare two result sets and return the stages that got slower by more than threshold
+def find_regressions(baseline, current, threshold=0.2):
+	baseline_seconds = {(record['size'], record['stage']): record['wall_seconds'] for record in baseline}
+	regressions = []
+	for record in current:
+		previous = baseline_seconds.get((record['size'], record['stage']))
+		if previous and record['wall_seconds'] > previous * (1 + threshold):
+			regressions.append({
+				'size': record['size'],
+				'stage': record['stage'],
+				'baseline_seconds': previous,
+				'wall_seconds': record['wall_seconds'],
+			})
+	return regressions
+
+
+def load_results(path):
+	with open(path, 'r') as file:
+		return [json.loads(line) for line in file if line.strip()]
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='CademyCode pipeline benchmarks')
+	subparsers = parser.add_subparsers(dest='command', required=True)
+
+	clean_parser = subparsers.add_parser('clean', help='compare the legacy and spec-driven student cleaning')
+	clean_parser.add_argument('--db-url', default='sqlite:///../cademycode.db')
+	clean_parser.add_argument('--repeat', type=int, default=100, help='times the students table is repeated')
+	clean_parser.add_argument('--rounds', type=int, default=3, help='rounds per timing, the best one is kept')
+
+	extract_parser = subparsers.add_parser('extract', help='compare sequential and parallel extraction')
+	extract_parser.add_argument('db_path')
+	extract_parser.add_argument('--workers', type=int, nargs='+', default=[2, 4, 8])
+	extract_parser.add_argument('--chunksize', type=int, default=100000, help='rows per rowid range')
+	extract_parser.add_argument('--rounds', type=int, default=3, help='rounds per timing, the best one is kept')
+
+	parallel_clean_parser = subparsers.add_parser('parallel-clean', help='compare single-process and multi-process student cleaning')
+	parallel_clean_parser.add_argument('db_path')
+	parallel_clean_parser.add_argument('--processes', type=int, nargs='+', default=[2, 4, 8])
+	parallel_clean_parser.add_argument('--rounds', type=int, default=3, help='rounds per timing, the best one is kept')
+
+	generate_parser = subparsers.add_parser('generate', help='write a synthetic cademycode database')
+	generate_parser.add_argument('path')
+	generate_parser.add_argument('--size', type=int, default=10000, help='number of students')
+	generate_parser.add_argument('--seed', type=int, default=0)
+
+	pipeline_parser = subparsers.add_parser('pipeline', help='time every pipeline stage at several sizes')
+	pipeline_parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+	pipeline_parser.add_argument('--seed', type=int, default=0)
+	pipeline_parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'cademycode_bench'),
+								 help='where generated databases are cached')
+	pipeline_parser.add_argument('--output', help='append the results to this JSON-lines file')
+	pipeline_parser.add_argument('--compare', help='JSON-lines results to check for regressions against')
+	pipeline_parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown before a stage counts as a regression')
+
+	startup_parser = subparsers.add_parser('startup', help='time interpreter startup and the no-op run')
+	startup_parser.add_argument('--db-path', default='../cademycode.db')
+	startup_parser.add_argument('--runs', type=int, default=10)
+
+	stages_parser = subparsers.add_parser('stages', help=argparse.SUPPRESS)
+	stages_parser.add_argument('db_path')
+
+	args = parser.parse_args(argv)
+
+	if args.command == 'clean':
+		print(json.dumps(bench_cleaning(args.db_url, args.repeat, args.rounds)))
+
+	elif args.command == 'extract':
+		print(json.dumps(bench_extraction(args.db_path, args.workers, args.chunksize, args.rounds)))
+
+	elif args.command == 'parallel-clean':
+		print(json.dumps(bench_parallel_cleaning(args.db_path, args.processes, args.rounds)))
+
+	elif args.command == 'generate':
+		generate_cademycode_db(args.path, args.size, args.seed)
+
+	elif args.command == 'startup':
+		print(json.dumps(bench_startup(args.db_path, args.runs)))
+
+	elif args.command == 'stages':
+		work_dir = tempfile.mkdtemp()
+		try:
+			print(json.dumps(bench_stages(args.db_path, work_dir)))
+		finally:
+			shutil.rmtree(work_dir)
+
+	elif args.command == 'pipeline':
+		records = bench_pipeline(args.sizes, args.data_dir, args.seed)
+		for record in records:
+			print(json.dumps(record))
+
+		if args.output:
+			with open(args.output, 'a') as file:
+				for record in records:
+					file.write(json.dumps(record) + '\n')
+
+		if args.compare:
+			regressions = find_regressions(load_results(args.compare), records, args.threshold)
+			for regression in regressions:
+				print(f"Regression: {json.dumps(regression)}", file=sys.stderr)
+			if regressions:
+				sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
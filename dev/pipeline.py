@@ -1,13 +1,145 @@
-import pandas as pd
-import sqlalchemy
-from sqlalchemy import create_engine, text, inspect, MetaData, Table, Column, Integer, String, Float, DateTime
+import argparse
+import collections
+import contextlib
+import cProfile
+import hashlib
+import importlib.util
 import json
 import logging
 import os
-import unittest
+import pstats
+import resource
+import queue
+import shutil
+import signal
+import sqlite3
+import tempfile
+import threading
+import time
+import tracemalloc
 import sys
 
 
+# Import a module on first attribute access instead of now. Runs that find nothing to do never pay for
+# pandas and SQLAlchemy. Returns None when the module is not installed.
+def lazy_import(name):
+	if name in sys.modules:
+		return sys.modules[name]
+	spec = importlib.util.find_spec(name)
+	if spec is None:
+		return None
+	spec.loader = importlib.util.LazyLoader(spec.loader)
+	module = importlib.util.module_from_spec(spec)
+	sys.modules[name] = module
+	if '.' in name:
+		# Bind submodules on their package like a regular import does
+		package, _, child = name.rpartition('.')
+		setattr(sys.modules[package], child, module)
+	spec.loader.exec_module(module)
+	return module
+
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+sqlalchemy = lazy_import('sqlalchemy')
+pa = lazy_import('pyarrow')
+concurrent_futures = lazy_import('concurrent.futures')
+
+
+# Finish the lazy imports in the calling thread. LazyLoader is not thread-safe: a thread that touches a module
+# while another one is still executing it sees it half-initialized, so this runs before any thread pool starts.
+def load_lazy_modules():
+	for module in [np, pd, sqlalchemy, pa, concurrent_futures]:
+		if module is not None:
+			getattr(module, '__name__')
+
+
+# Database and state files, relative to the build directory
+DB_URL = 'sqlite:///../cademycode.db'
+VERSION_FILE = '../version.txt'
+ROW_COUNTS_FILE = '../row_counts.json'
+WATERMARKS_FILE = '../watermarks.json'
+CHANGE_STATE_FILE = '../change_state.json'
+RUN_STATE_FILE = '../run_state.json'
+CHECKPOINT_DIR = '../checkpoint'
+PROFILE_DIR = '../profiles'
+LOG_DIR = '../'
+
+# Each source of a multi-source run keeps its state files, logs and outputs in a directory below this one
+SHARDS_DIR = '../shards'
+# The state files in a shard directory, by their field of the run's paths, see shard_paths
+STATE_FILE_NAMES = {
+	'version_file': 'version.txt',
+	'row_counts_file': 'row_counts.json',
+	'watermarks_file': 'watermarks.json',
+	'change_state_file': 'change_state.json',
+	'run_state_file': 'run_state.json',
+	'checkpoint_dir': 'checkpoint',
+}
+
+# Setting this environment variable to anything but an empty string turns on --profile
+PROFILE_ENV = 'CADEMYCODE_PROFILE'
+
+# Source tables read by the pipeline and the key each one is upserted on
+SOURCE_TABLES = ['cademycode_students', 'cademycode_student_jobs', 'cademycode_courses']
+TABLE_KEYS = {
+	'cademycode_students': 'uuid',
+	'cademycode_student_jobs': 'job_id',
+	'cademycode_courses': 'career_path_id',
+}
+
+# Text columns are stored as Arrow-backed strings when pyarrow is installed
+STRING_DTYPE = 'string[pyarrow]' if pa is not None else 'string'
+
+# Cleaning spec for cademycode_students: column -> (target dtype, null policy).
+# Rows with a null in a 'drop' column are removed, 'keep' columns may stay null.
+STUDENT_COLUMNS = {
+	'uuid': ('int32', 'drop'),
+	'name': (STRING_DTYPE, 'keep'),
+	'dob': ('datetime64[ns]', 'keep'),
+	'sex': ('category', 'keep'),
+	'contact_info': (STRING_DTYPE, 'keep'),
+	'job_id': ('int32', 'drop'),
+	'num_course_taken': ('int32', 'drop'),
+	'current_career_path_id': ('int32', 'drop'),
+	'time_spent_hrs': ('float64', 'drop'),
+}
+
+# Data-quality rules per table: (reason code, check, column, argument). Rows failing any rule are moved to the
+# quarantine table with their reason codes. Checks are listed in RULE_CHECKS.
+CONTACT_INFO_PATTERN = r'\{"mailing_address": "[^"]+", "email": "[^"@\s]+@[^"@\s]+\.[^"@\s]+"\}'
+QUALITY_RULES = {
+	'cademycode_students': [
+		('duplicate_uuid', 'unique', 'uuid', None),
+		('negative_num_course_taken', 'range', 'num_course_taken', (0, None)),
+		('negative_time_spent_hrs', 'range', 'time_spent_hrs', (0, None)),
+		('dob_out_of_range', 'range', 'dob', ('1900-01-01', None)),
+		('invalid_contact_info', 'regex', 'contact_info', CONTACT_INFO_PATTERN),
+		('unknown_job_id', 'foreign_key', 'job_id', ('cademycode_student_jobs', 'job_id')),
+		('unknown_career_path_id', 'foreign_key', 'current_career_path_id', ('cademycode_courses', 'career_path_id')),
+	],
+	'cademycode_student_jobs': [
+		('duplicate_row', 'unique', None, None),
+		('duplicate_job_id', 'unique', 'job_id', None),
+		('negative_avg_salary', 'range', 'avg_salary', (0, None)),
+	],
+	'cademycode_courses': [
+		('duplicate_career_path_id', 'unique', 'career_path_id', None),
+		('negative_hours_to_complete', 'range', 'hours_to_complete', (0, None)),
+	],
+}
+QUARANTINE_TABLE = 'cademycode_quarantine'
+
+# Compact mode: contact_info is split into these fields, and these columns hold a handful of distinct values
+CONTACT_INFO_FIELDS = ['mailing_address', 'email']
+CATEGORY_COLUMNS = ['sex', 'job_category', 'career_path_name']
+
+# The merged dataset published as a table, with indexes for point queries, and its pre-aggregated summary
+MERGED_TABLE = 'cademycode_merged'
+MERGED_INDEXES = ['job_id', 'current_career_path_id']
+SUMMARY_TABLE = 'cademycode_merged_summary'
+
+
 def configure_logging(log_file_prefix='../', app_version='1.0.0', test_env=False):
 	# Create a formatter with timestamp
 	formatter = logging.Formatter(f'%(asctime)s - %(levelname)s - {app_version} - %(message)s')
@@ -19,6 +151,7 @@ def configure_logging(log_file_prefix='../', app_version='1.0.0', test_env=False
 	# Remove existing handlers
 	for handler in root_logger.handlers[:]:
 		root_logger.removeHandler(handler)
+		handler.close()
 
 	# Create a console handler
 	console_handler = logging.StreamHandler()
@@ -32,8 +165,10 @@ def configure_logging(log_file_prefix='../', app_version='1.0.0', test_env=False
 		# Remove existing handlers
 		for handler in changelog.handlers[:]:
 			changelog.removeHandler(handler)
+			handler.close()
 		for handler in errorlog.handlers[:]:
 			errorlog.removeHandler(handler)
+			handler.close()
 
 		# Create file handlers and set formatter
 		changelog_handler = logging.FileHandler(os.path.join(log_file_prefix, 'changelog.log'))
@@ -57,7 +192,7 @@ def get_current_version(version_file):
 	return version
 
 
-def update_version(version, part='patch'):
+def update_version(version, version_file, part='patch'):
 	major, minor, patch = map(int, version.split('.'))
 
 	if part == 'major':
@@ -74,7 +209,7 @@ def update_version(version, part='patch'):
 	new_version = f"{major}.{minor}.{patch}"
 
 	# Write the new version to the file
-	with open('../version.txt', 'w') as file:
+	with open(version_file, 'w') as file:
 		file.write(new_version)
 
 	return new_version
@@ -84,19 +219,217 @@ def log_version_change(changelog, version_file):
 	current_version = get_current_version(version_file)
 
 	# Update the version
-	new_version = update_version(current_version)
+	new_version = update_version(current_version, version_file)
 
 	# Log the version change
 	changelog.info(f"Version {new_version}: Updates applied.")
 	return new_version
 
 
+# Resident memory high-water mark of this process in kilobytes
+def peak_rss_kb():
+	try:
+		with open('/proc/self/status', 'r') as file:
+			for line in file:
+				if line.startswith('VmHWM:'):
+					return int(line.split()[1])
+	except OSError:
+		pass
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# macOS reports bytes, Linux kilobytes
+	return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+# Reset the high-water mark so the next reading only covers the current stage (Linux only)
+def reset_peak_rss():
+	try:
+		with open('/proc/self/clear_refs', 'w') as file:
+			file.write('5')
+	except OSError:
+		pass
+
+
+# Record wall time, CPU time, rows and peak memory of a pipeline stage into metrics.
+# The caller fills in rows_in/rows_out on the yielded record.
+@contextlib.contextmanager
+def stage(name, metrics, version, rows_in=None):
+	record = {
+		'stage': name,
+		'version': version,
+		'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+		'rows_in': rows_in,
+		'rows_out': None,
+	}
+	reset_peak_rss()
+	wall_start = time.perf_counter()
+	cpu_start = time.process_time()
+	try:
+		with profile_stage(name):
+			yield record
+		record['status'] = 'ok'
+	except BaseException:
+		record['status'] = 'error'
+		raise
+	finally:
+		record['wall_seconds'] = round(time.perf_counter() - wall_start, 6)
+		record['cpu_seconds'] = round(time.process_time() - cpu_start, 6)
+		record['peak_rss_kb'] = peak_rss_kb()
+		metrics.append(record)
+
+
+# Append the stage records of a run to a JSON-lines file
+def write_metrics(metrics, file_path, run_id):
+	with open(file_path, 'a') as file:
+		for record in metrics:
+			file.write(json.dumps({'run_id': run_id, **record}) + '\n')
+
+
+# Write the stage records in the Prometheus text format for the node_exporter textfile collector
+def write_prometheus_metrics(metrics, file_path):
+	gauges = [
+		('pipeline_stage_wall_seconds', 'wall_seconds', 'Wall time of the pipeline stage in seconds.'),
+		('pipeline_stage_cpu_seconds', 'cpu_seconds', 'CPU time of the pipeline stage in seconds.'),
+		('pipeline_stage_rows_in', 'rows_in', 'Rows the pipeline stage received.'),
+		('pipeline_stage_rows_out', 'rows_out', 'Rows the pipeline stage produced.'),
+		('pipeline_stage_peak_rss_kilobytes', 'peak_rss_kb', 'Peak resident memory during the pipeline stage.'),
+	]
+	lines = []
+	for metric, key, description in gauges:
+		lines.append(f"# HELP {metric} {description}")
+		lines.append(f"# TYPE {metric} gauge")
+		for record in metrics:
+			if record.get(key) is not None:
+				lines.append(f'{metric}{{stage="{record["stage"]}",version="{record["version"]}"}} {record[key]}')
+	lines.append("# HELP pipeline_last_run_timestamp_seconds Unix time the pipeline last ran.")
+	lines.append("# TYPE pipeline_last_run_timestamp_seconds gauge")
+	lines.append(f"pipeline_last_run_timestamp_seconds {time.time():.0f}")
+
+	# The collector may read at any time, so replace the file in one step
+	tmp_path = f"{file_path}.tmp"
+	with open(tmp_path, 'w') as file:
+		file.write('\n'.join(lines) + '\n')
+	os.replace(tmp_path, file_path)
+
+
+# State of the run being profiled, see profile_run. None while profiling is off.
+profiling = None
+
+
+# Sample the stacks of all other threads every `interval` seconds and count them per stage, in the collapsed
+# format of flamegraph.pl and speedscope. Unlike cProfile this also sees the threads of pipelined runs.
+def sample_stacks(samples, stop, interval):
+	sampler = threading.get_ident()
+	while not stop.wait(interval):
+		names = {thread.ident: thread.name for thread in threading.enumerate()}
+		for ident, frame in sys._current_frames().items():
+			if ident == sampler:
+				continue
+			stack = []
+			while frame is not None:
+				code = frame.f_code
+				stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+				frame = frame.f_back
+			samples[';'.join([profiling['stage'], names.get(ident, str(ident))] + stack[::-1])] += 1
+
+
+# Profile a whole run with cProfile over the run's thread and the stack sampler. Each stage gets its own
+# cProfile stats and tracemalloc allocation report, see profile_stage. Everything is written to
+# <profile_dir>/<version>/ when the run ends, under the version the run ended with.
+@contextlib.contextmanager
+def profile_run(run_id, profile_dir, version_file, top=25, interval=0.005):
+	global profiling
+	profiling = {'profiler': cProfile.Profile(), 'stage': 'main', 'stages': [], 'top': top}
+	samples = collections.Counter()
+	stop = threading.Event()
+	sampler = threading.Thread(target=sample_stacks, args=(samples, stop, interval), name='profile-sampler', daemon=True)
+
+	sampler.start()
+	profiling['profiler'].enable()
+	try:
+		yield
+	finally:
+		profiling['profiler'].disable()
+		stop.set()
+		sampler.join()
+		state, profiling = profiling, None
+		write_profiles(state, samples, os.path.join(profile_dir, get_current_version(version_file)), run_id)
+
+
+# Give a stage its own cProfile, and unless top is 0 its peak traced memory and the top allocations it left behind
+@contextlib.contextmanager
+def profile_stage(name):
+	if profiling is None:
+		yield
+		return
+
+	profiling['profiler'].disable()
+	profiler = cProfile.Profile()
+	# Only trace the stage itself. Its snapshot then holds just what the stage allocated and still holds,
+	# not everything allocated since the imports, which would make every snapshot take seconds.
+	if profiling['top']:
+		tracemalloc.start()
+	profiling['stage'] = name
+	profiler.enable()
+	try:
+		yield
+	finally:
+		profiler.disable()
+		profiling['stage'] = 'main'
+		peak, allocations = None, None
+		if profiling['top']:
+			peak = tracemalloc.get_traced_memory()[1]
+			allocations = tracemalloc.take_snapshot().statistics('lineno')[:profiling['top']]
+			tracemalloc.stop()
+		profiling['stages'].append((name, profiler, peak, allocations))
+		profiling['profiler'].enable()
+
+
+# run.prof merges the whole run with all of its stages, <stage>.prof and <stage>.allocations.txt cover one stage
+def write_profiles(state, samples, directory, run_id):
+	os.makedirs(directory, exist_ok=True)
+	prefix = os.path.join(directory, run_id)
+	run_stats = pstats.Stats(state['profiler'])
+	for name, profiler, peak, allocations in state['stages']:
+		stats = pstats.Stats(profiler)
+		stats.dump_stats(f"{prefix}-{name}.prof")
+		run_stats.add(stats)
+		if allocations is None:
+			continue
+		with open(f"{prefix}-{name}.allocations.txt", 'w') as file:
+			file.write(f"Peak traced memory: {peak / 1024 ** 2:.1f} MiB\n")
+			file.write(f"Top {len(allocations)} lines by memory allocated during the stage and still held at its end:\n")
+			file.writelines(f"{allocation}\n" for allocation in allocations)
+	run_stats.dump_stats(f"{prefix}-run.prof")
+
+	with open(f"{prefix}.collapsed", 'w') as file:
+		file.writelines(f"{stack} {count}\n" for stack, count in sorted(samples.items()))
+	logging.getLogger('changelog').info(f"Wrote profiles of run {run_id} to {directory}")
+
+
 # Create a database engine
-def create_db_engine(db_url):
-	return create_engine(db_url)
+# pool_size sizes the connection pool explicitly (no overflow) for concurrent readers.
+# read_only opens SQLite files through a read-only URI so extraction can never take the write lock.
+def create_db_engine(db_url, pool_size=None, read_only=False):
+	url = sqlalchemy.make_url(db_url)
+	options = {}
+	if read_only and url.get_backend_name() == 'sqlite' and url.database and url.database != ':memory:':
+		url = url.set(database=f"file:{os.path.abspath(url.database)}", query={'mode': 'ro', 'uri': 'true'})
+	if pool_size:
+		options.update(poolclass=sqlalchemy.pool.QueuePool, pool_size=pool_size, max_overflow=0)
+	return sqlalchemy.create_engine(url, **options)
+
+
+# WAL lets the parallel readers run alongside each other and the writer. The mode is stored in the database file.
+def enable_wal(engine):
+	if engine.dialect.name != 'sqlite':
+		return None
+	with engine.connect() as connection:
+		return connection.exec_driver_sql("PRAGMA journal_mode=WAL").scalar()
 
 
 def run_tests():
+	import unittest
+
 	# Run the unittests in the tests directory
 	test_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'tests')
 	loader = unittest.TestLoader()
@@ -109,31 +442,27 @@ def run_tests():
 
 # get table names from database
 def get_table_names(engine):
-	inspector = inspect(engine)
+	inspector = sqlalchemy.inspect(engine)
 	table_names = inspector.get_table_names()
 	return table_names
 
 
-def get_row_counts(engine):
+def count_rows(engine, table):
 	with engine.connect() as connection:
-		inspector = inspect(engine)
-		tables = inspector.get_table_names()
-		row_counts = {}
-		for table in tables:
-			try:
-				result = connection.execute(text(f"SELECT COUNT(*) FROM {table}")).scalar()
-				row_counts[table] = result
-			except Exception as e:
-				changelog.error(f"Error retrieving row count for table '{table}': {str(e)}")
-		return row_counts
+		return connection.execute(sqlalchemy.text(f"SELECT COUNT(*) FROM {table}")).scalar()
 
 
-def initialize_row_counts(engine, file_path):
-	table_names = get_table_names(engine)
-	row_counts = {table: 1 for table in table_names}
-	with open(file_path, 'w') as file:
-		json.dump(row_counts, file)
-	changelog.info(f"Initialized row counts: {row_counts}")
+# Count every table, or the given ones, with up to `workers` counts running at once on separate connections
+def get_row_counts(engine, workers=1, tables=None):
+	tables = tables or get_table_names(engine)
+	row_counts = {}
+	with concurrent_futures.ThreadPoolExecutor(max_workers=workers) as executor:
+		futures = {table: executor.submit(count_rows, engine, table) for table in tables}
+	for table, future in futures.items():
+		try:
+			row_counts[table] = future.result()
+		except Exception as e:
+			changelog.error(f"Error retrieving row count for table '{table}': {str(e)}")
 	return row_counts
 
 
@@ -166,8 +495,208 @@ def load_row_counts(file_path):
         return {}
 
 
-def get_dataframes(engine, changelog):
-	table_names = get_table_names(engine)
+# Path of the database file behind a SQLite engine, None for other databases
+def get_db_file(engine):
+	database = engine.url.database
+	if engine.dialect.name != 'sqlite' or not database or database == ':memory:' or engine.url.query.get('mode') == 'memory':
+		return None
+	return database
+
+
+# Same as get_db_file, straight from a sqlite:/// URL so it works before SQLAlchemy is loaded
+def get_db_file_from_url(db_url):
+	if not db_url.startswith('sqlite:///'):
+		return None
+	database, _, query = db_url[len('sqlite:///'):].partition('?')
+	return None if not database or database == ':memory:' or 'mode=memory' in query.split('&') else database
+
+
+# Size and modification time of the database file and its WAL, a near-free "nothing changed" check
+def get_file_fingerprint(db_path):
+	fingerprint = []
+	for path in (db_path, f"{db_path}-wal"):
+		if os.path.exists(path):
+			stat = os.stat(path)
+			fingerprint.append([stat.st_size, stat.st_mtime_ns])
+		else:
+			fingerprint.append(None)
+	return fingerprint
+
+
+# Highest rowid of every table. Cheap, catches appends but not in-place updates or deletes.
+def get_max_rowids(engine, tables=None):
+	return get_watermarks(engine, tables or get_table_names(engine))
+
+
+# Hash of every table's content, read in rowid order and in chunks. Catches any change but reads everything.
+def get_content_hashes(engine, chunksize=100000, tables=None):
+	hashes = {}
+	with engine.connect() as connection:
+		for table in tables or get_table_names(engine):
+			hasher = hashlib.blake2b(digest_size=16)
+			query = sqlalchemy.text(f"SELECT * FROM {table} ORDER BY rowid")
+			for chunk in pd.read_sql(query, connection, chunksize=chunksize):
+				hasher.update(pd.util.hash_pandas_object(chunk, index=False).to_numpy().tobytes())
+			hashes[table] = hasher.hexdigest()
+	return hashes
+
+
+# Per-table fingerprint functions for detect_changes
+CHANGE_DETECTORS = {
+	'counts': get_row_counts,
+	'rowid': get_max_rowids,
+	'hash': get_content_hashes,
+}
+
+
+# Fingerprints of the database file and of every table, as compared by detect_changes.
+# `tables` are the table names when the caller already has them.
+def get_change_state(engine, detector='counts', tables=None):
+	state = {'detector': detector}
+	db_path = get_db_file(engine)
+	if db_path is not None:
+		state['file'] = get_file_fingerprint(db_path)
+	state['tables'] = CHANGE_DETECTORS[detector](engine, tables=tables)
+	return state
+
+
+# Find the tables that changed since last_state. When the database file has not been touched
+# since then, the tables are not looked at at all.
+def detect_changes(engine, last_state, changelog, detector='counts', tables=None):
+	changelog.info("Checking for updates...")
+
+	same_detector = last_state.get('detector') == detector
+	db_path = get_db_file(engine)
+	if db_path is not None and same_detector and last_state.get('file') == get_file_fingerprint(db_path):
+		changelog.info("Database file unchanged since the last run.")
+		return set(), last_state
+
+	state = get_change_state(engine, detector, tables)
+	last_tables = last_state.get('tables', {}) if same_detector else {}
+
+	changed_tables = set()
+	for table, fingerprint in state['tables'].items():
+		if last_tables.get(table) != fingerprint:
+			changelog.info(f"Update found in table '{table}': last {detector} = {last_tables.get(table)}, current {detector} = {fingerprint}")
+			changed_tables.add(table)
+	for table in set(last_tables) - set(state['tables']):
+		changelog.info(f"Table '{table}' was removed")
+		changed_tables.add(table)
+
+	return changed_tables, state
+
+
+def save_change_state(state, file_path):
+	with open(file_path, 'w') as file:
+		json.dump(state, file)
+
+
+def load_change_state(file_path):
+	if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
+		with open(file_path, 'r') as file:
+			return json.load(file)
+	return {}
+
+
+# State of the last run, carrying over the row counts of runs from before the change state was kept
+def load_last_state(detector, paths):
+	last_state = load_change_state(paths.change_state_file)
+	if not last_state and detector == 'counts' and load_row_counts(paths.row_counts_file):
+		last_state = {'detector': 'counts', 'tables': load_row_counts(paths.row_counts_file)}
+	return last_state
+
+
+# The counts and rowid detectors computed with the stdlib sqlite3 module, for the startup check
+STDLIB_DETECTORS = {
+	'counts': 'SELECT COUNT(*) FROM "{}"',
+	'rowid': 'SELECT COALESCE(MAX(rowid), 0) FROM "{}"',
+}
+
+
+# Startup check that needs neither pandas nor SQLAlchemy. True only when the database file is unchanged since
+# the last run, or its tables still match the saved counts/rowids; anything else goes to the full detection.
+def nothing_to_do(args, paths):
+	global changelog, errorlog
+
+	db_path = get_db_file_from_url(paths.db_url)
+	last_state = load_last_state(args.change_detector, paths)
+	if os.path.exists(paths.run_state_file):
+		# An interrupted run is waiting to be resumed
+		return False
+	if db_path is None or not last_state or args.change_detector not in STDLIB_DETECTORS \
+			or last_state.get('detector') != args.change_detector:
+		return False
+
+	current_version = get_current_version(paths.version_file)
+	metrics = []
+	with stage('detect', metrics, current_version) as record:
+		fingerprint = get_file_fingerprint(db_path)
+		if last_state.get('file') != fingerprint:
+			connection = sqlite3.connect(f"file:{os.path.abspath(db_path)}?mode=ro", uri=True)
+			try:
+				tables = [row[0] for row in connection.execute(
+					"SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")]
+				query = STDLIB_DETECTORS[args.change_detector]
+				current_tables = {table: connection.execute(query.format(table)).fetchone()[0] for table in tables}
+			finally:
+				connection.close()
+			if current_tables != last_state.get('tables'):
+				return False
+			# Same content, only the file was touched: remember the new fingerprint for the next run
+			save_change_state(dict(last_state, file=fingerprint), paths.change_state_file)
+		record['rows_out'] = 0
+
+	changelog, errorlog = configure_logging(log_file_prefix=paths.log_dir, app_version=current_version)
+	changelog.info(f"Starting script with version {current_version}")
+	changelog.info("No updates found.")
+	if args.metrics_file:
+		write_metrics(metrics, args.metrics_file, time.strftime('%Y%m%dT%H%M%S'))
+	return True
+
+
+# Highest rowid per source table. SQLite hands out increasing rowids to appended rows,
+# so everything above the stored watermark is new since the last run.
+def get_watermarks(engine, tables=SOURCE_TABLES):
+	watermarks = {}
+	with engine.connect() as connection:
+		for table in tables:
+			watermarks[table] = connection.execute(sqlalchemy.text(f"SELECT COALESCE(MAX(rowid), 0) FROM {table}")).scalar()
+	return watermarks
+
+
+def save_watermarks(watermarks, file_path):
+	with open(file_path, 'w') as file:
+		json.dump(watermarks, file)
+
+
+def load_watermarks(file_path):
+	if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
+		with open(file_path, 'r') as file:
+			return json.load(file)
+	return {}
+
+
+def can_run_incremental(last_watermarks, current_watermarks, last_row_counts, current_row_counts, changelog):
+	# A delta read is only safe if every table has only grown since the watermark was taken
+	if not last_watermarks:
+		changelog.info("No watermarks found, running a full reload.")
+		return False
+
+	for table in SOURCE_TABLES:
+		if table not in last_watermarks or table not in current_watermarks:
+			changelog.info(f"No watermark for table '{table}', running a full reload.")
+			return False
+		if current_watermarks[table] < last_watermarks[table]:
+			changelog.info(f"Table '{table}' was rewritten since the last run, running a full reload.")
+			return False
+		if current_row_counts.get(table, 0) < last_row_counts.get(table, 0):
+			changelog.info(f"Rows were deleted from table '{table}', running a full reload.")
+			return False
+	return True
+
+
+def get_dataframes(engine, changelog, tables=None):
+	table_names = tables or get_table_names(engine)
 	dataframes = {}
 	if not table_names:
 		changelog.warning("No tables found in the database.")
@@ -175,194 +704,1923 @@ def get_dataframes(engine, changelog):
 		#changelog.info("Tables in the database:")
 		for table_name in table_names:
 			#changelog.info(table_name)
-			df = pd.read_sql_table(table_name, engine)
+			# Plain SQL keeps JSON columns as text instead of decoding every value
+			df = pd.read_sql(sqlalchemy.text(f"SELECT * FROM {table_name}"), engine)
 			dataframes[table_name] = df
 			#changelog.info(f"Data from {table_name}:")
 			#changelog.info(df.head().to_string())  # Convert DataFrame head to string
 	return dataframes
 
 
-def process_dataframes(dataframes, changelog):
-	# Clean and process df_students
+# Split a SQLite table into rowid ranges of about chunksize rows. Other databases are read whole.
+def get_rowid_ranges(engine, table_name, chunksize):
+	if engine.dialect.name != 'sqlite' or not chunksize:
+		return [None]
+	with engine.connect() as connection:
+		low, high = connection.execute(sqlalchemy.text(f"SELECT MIN(rowid), MAX(rowid) FROM {table_name}")).fetchone()
+	if low is None or high - low < chunksize:
+		return [None]
+	return [(start, min(start + chunksize - 1, high)) for start in range(low, high + 1, chunksize)]
+
+
+def read_table_range(engine, table_name, rowid_range=None):
+	with engine.connect() as connection:
+		if rowid_range is None:
+			return pd.read_sql(sqlalchemy.text(f"SELECT * FROM {table_name}"), connection)
+		query = sqlalchemy.text(f"SELECT * FROM {table_name} WHERE rowid BETWEEN :low AND :high ORDER BY rowid")
+		return pd.read_sql(query, connection, params={'low': rowid_range[0], 'high': rowid_range[1]})
+
+
+# Read tables, and rowid ranges of large tables, concurrently from a pool of `workers` threads.
+# The engine should have a pool of at least `workers` connections, see create_db_engine.
+def get_dataframes_parallel(engine, changelog, workers=4, chunksize=100000, tables=None):
+	table_names = tables or get_table_names(engine)
+	if not table_names:
+		changelog.warning("No tables found in the database.")
+		return {}
+
+	with concurrent_futures.ThreadPoolExecutor(max_workers=workers) as executor:
+		ranges = {table_name: executor.submit(get_rowid_ranges, engine, table_name, chunksize) for table_name in table_names}
+		parts = {
+			table_name: [executor.submit(read_table_range, engine, table_name, rowid_range) for rowid_range in future.result()]
+			for table_name, future in ranges.items()
+		}
+		dataframes = {}
+		for table_name, futures in parts.items():
+			frames = [future.result() for future in futures]
+			dataframes[table_name] = frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+
+	changelog.info(f"Read {sum(len(df) for df in dataframes.values())} rows from {len(dataframes)} tables with {workers} workers")
+	return dataframes
+
+
+# Read only the rows appended after the given watermarks
+def get_dataframes_since(engine, watermarks, changelog, tables=SOURCE_TABLES):
+	dataframes = {}
+	with engine.connect() as connection:
+		for table_name in tables:
+			query = sqlalchemy.text(f"SELECT * FROM {table_name} WHERE rowid > :watermark ORDER BY rowid")
+			df = pd.read_sql(query, connection, params={'watermark': watermarks.get(table_name, 0)})
+			if not df.empty:
+				changelog.info(f"Read {len(df)} new rows from {table_name}")
+				dataframes[table_name] = df
+	return dataframes
+
+
+# processes cleans the students on a process pool, see process_students_parallel. compact returns compacted frames,
+# see compact_dataframe. Rows that are dropped or fail QUALITY_RULES are added to `rejected` as quarantine records.
+# Foreign keys are checked against the tables in `dataframes`, or against `references` for tables that are not being processed.
+def process_dataframes(dataframes, changelog, rejected=None, references=None, processes=1, compact=False):
+	rejected = [] if rejected is None else rejected
 	df_students = dataframes.get('cademycode_students', pd.DataFrame())
 	df_jobs = dataframes.get('cademycode_student_jobs', pd.DataFrame())
 	df_courses = dataframes.get('cademycode_courses', pd.DataFrame())
 
-	df_students['dob'] = pd.to_datetime(df_students['dob'], errors='coerce')
-	df_students['job_id'] = pd.to_numeric(df_students['job_id'], errors='coerce')
-	df_students['num_course_taken'] = pd.to_numeric(df_students['num_course_taken'], errors='coerce')
-	df_students['time_spent_hrs'] = pd.to_numeric(df_students['time_spent_hrs'], errors='coerce')
-	df_students['current_career_path_id'] = pd.to_numeric(df_students['current_career_path_id'], errors='coerce')
-
-	df_students_clean = df_students.copy()
-	nan_counts = df_students_clean.isna().sum()
-
-	# Drop rows with NaN values
-	if (nan_counts != 0).any():
-		changelog.info(f"Dropping df_students NaN values {nan_counts}")
-		df_students_clean = df_students.dropna(subset=['job_id', 'num_course_taken', 'current_career_path_id', 'time_spent_hrs']).copy()
-		changelog.info("NaN values dropped")
+	# Validate the dimension tables first, the students' foreign keys are checked against them
+	df_jobs_clean = apply_quality_rules(df_jobs, 'cademycode_student_jobs', changelog, rejected)
+	df_courses = apply_quality_rules(df_courses, 'cademycode_courses', changelog, rejected)
+	references = dict(references or {})
+	for table_name, df in [('cademycode_student_jobs', df_jobs_clean), ('cademycode_courses', df_courses)]:
+		if table_name in dataframes:
+			references[table_name] = df
+
+	# Incremental runs may only carry deltas for some of the tables
+	if df_students.empty:
+		changelog.info("No df_students rows to process")
+		df_students_clean = df_students
 	else:
-		changelog.info("No NaN values found in df_students")
+		if processes > 1:
+			df_students_clean = process_students_parallel(df_students, changelog, processes)
+		else:
+			df_students_clean = process_students(df_students, changelog)
+		df_students_clean = validate_students(df_students, df_students_clean, changelog, rejected, references)
 
-	df_students_clean['dob'] = df_students_clean['dob'].astype('datetime64[ns]')
-	df_students_clean['job_id'] = df_students_clean['job_id'].astype(int)
-	df_students_clean['num_course_taken'] = df_students_clean['num_course_taken'].astype(int)
-	df_students_clean['time_spent_hrs'] = df_students_clean['time_spent_hrs'].astype(float)
-	df_students_clean['contact_info'] = df_students_clean['contact_info'].apply(json.dumps)
-	df_students_clean['current_career_path_id'] = df_students_clean['current_career_path_id'].astype(int)
-
-	# Drop duplicated values
-	df_jobs_clean = df_jobs.copy()
-	jobs_duplicates = df_jobs.duplicated()
-	if jobs_duplicates.any():
-		changelog.info(f"Dropping df_jobs duplicates {df_jobs.duplicated()}")
-		df_jobs_clean = df_jobs.drop_duplicates()
-		changelog.info("Duplicates dropped")
-	else:
-		changelog.info("No duplicates found in df_jobs")
+	if compact:
+		df_students_clean = compact_dataframe(df_students_clean, 'cademycode_students', changelog)
+		df_jobs_clean = compact_dataframe(df_jobs_clean, 'cademycode_student_jobs', changelog)
+		df_courses = compact_dataframe(df_courses, 'cademycode_courses', changelog)
 
 	changelog.info("Dataframes processing completed")
 
 	return df_students_clean, df_jobs_clean, df_courses
 
 
-# Function to save DataFrames back to the database
-def update_db_tables(engine, df_students, df_jobs, df_courses):
-	metadata = MetaData()
+# Coerce numeric and datetime columns to float64 and datetime64[ns], nulls and unparsable values become NaN/NaT
+def coerce_columns(df, numeric_columns, datetime_columns):
+	columns = numeric_columns + datetime_columns
+	if pa is not None and columns:
+		# One Arrow cast over all columns, unparsable strings raise and fall back below
+		try:
+			table = pa.Table.from_pandas(df[columns], preserve_index=False)
+			table = table.cast(pa.schema(
+				[(column, pa.float64()) for column in numeric_columns] +
+				[(column, pa.timestamp('ns')) for column in datetime_columns]))
+			return {
+				column: pd.Series(table.column(column).to_numpy(), index=df.index)
+				for column in columns
+			}
+		except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError):
+			pass
+
+	coerced = {}
+	for column in numeric_columns:
+		coerced[column] = pd.to_numeric(df[column], errors='coerce').astype('float64')
+	for column in datetime_columns:
+		coerced[column] = pd.to_datetime(df[column], errors='coerce', format='ISO8601')
+	return coerced
+
+
+# Clean df_students according to a column spec in a single vectorized pass:
+# coerce every column once, compute the null mask once, and build the result from the kept rows.
+def process_students(df_students, changelog, spec=STUDENT_COLUMNS):
+	order = list(df_students.columns)
+	columns = [column for column in order if column in spec]
+	numeric_columns = [column for column in columns if pd.api.types.is_numeric_dtype(pd.api.types.pandas_dtype(spec[column][0]))]
+	datetime_columns = [column for column in columns if spec[column][0].startswith('datetime64')]
+
+	coerced = coerce_columns(df_students, numeric_columns, datetime_columns)
+	for column in columns:
+		if column in coerced:
+			continue
+		series = df_students[column]
+		if series.dtype == object and pd.api.types.infer_dtype(series, skipna=True) != 'string':
+			# read_sql_table decodes JSON columns into dicts, store them as text again
+			coerced[column] = series.map(json.dumps, na_action='ignore')
+		else:
+			coerced[column] = series
+
+	nulls = {column: values.isna().to_numpy() for column, values in coerced.items()}
+	nan_counts = pd.Series({column: int(mask.sum()) for column, mask in nulls.items()})
+	drop = np.zeros(len(df_students), dtype=bool)
+	for column in columns:
+		if spec[column][1] == 'drop':
+			drop |= nulls[column]
+
+	# Drop rows with NaN values
+	if drop.any():
+		changelog.info(f"Dropping df_students NaN values {nan_counts[nan_counts != 0].to_dict()}")
+		changelog.info(f"{int(drop.sum())} NaN rows dropped")
+		keep = np.flatnonzero(~drop)
+		coerced = {column: values.take(keep) for column, values in coerced.items()}
+		df_students = df_students[[column for column in order if column not in coerced]].take(keep)
+	else:
+		changelog.info("No NaN values found in df_students")
+
+	df_students_clean = pd.DataFrame({
+		column: coerced[column].astype(spec[column][0]) if column in coerced else df_students[column]
+		for column in order
+	})
+
+	return df_students_clean
+
+
+# Rule checks: each returns a boolean array marking the failing rows, or None when the rule cannot be checked.
+# Nulls pass every check, whether a column may be null is decided by STUDENT_COLUMNS.
+def check_range(df, column, bounds, references, seen):
+	values = df[column]
+	low, high = bounds
+	if pd.api.types.is_datetime64_any_dtype(values):
+		low, high = [None if bound is None else pd.Timestamp(bound) for bound in bounds]
+	failed = np.zeros(len(df), dtype=bool)
+	if low is not None:
+		failed |= (values < low).to_numpy(dtype=bool, na_value=False)
+	if high is not None:
+		failed |= (values > high).to_numpy(dtype=bool, na_value=False)
+	return failed
+
+
+def check_regex(df, column, pattern, references, seen):
+	# The default str dtype matches nulls as False rather than NA, so they are excluded explicitly
+	values = df[column]
+	return ~values.str.fullmatch(pattern).to_numpy(dtype=bool, na_value=True) & values.notna().to_numpy()
+
+
+def check_foreign_key(df, column, reference, references, seen):
+	table_name, key = reference
+	if references is None or table_name not in references:
+		return None
+	return ~df[column].isin(references[table_name][key]).to_numpy()
+
+
+# Duplicates after the first occurrence, also across chunks when `seen` carries the keys of earlier chunks.
+# The keys are kept in a set per column, so each chunk costs O(chunk) however many came before it.
+# Without a column whole rows are compared.
+def check_unique(df, column, argument, references, seen):
+	if column is None:
+		return df.duplicated().to_numpy()
+	values = df[column]
+	failed = values.duplicated().to_numpy()
+	if seen is not None:
+		keys = seen.setdefault(column, set())
+		if keys:
+			failed = failed | np.fromiter(map(keys.__contains__, values.tolist()), dtype=bool, count=len(values))
+		keys.update(values.dropna().tolist())
+	return failed
+
+
+RULE_CHECKS = {
+	'range': check_range,
+	'regex': check_regex,
+	'foreign_key': check_foreign_key,
+	'unique': check_unique,
+}
+
+
+# Quarantine records for rejected rows: the source table, the reason codes and the row itself as JSON
+def quarantine_records(table_name, rows, reasons):
+	records = rows.to_json(orient='records', lines=True, date_format='iso').splitlines()
+	return pd.DataFrame({
+		'source_table': table_name,
+		'reason': list(reasons),
+		'record': records,
+		'quarantined_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+	})
+
+
+# Evaluate every rule of the table as a vectorized mask, move the failing rows to `rejected` and return the rest
+def apply_quality_rules(df, table_name, changelog, rejected, rules=QUALITY_RULES, references=None, seen=None):
+	if df.empty:
+		return df
+
+	failures = []
+	for code, check, column, argument in rules.get(table_name, []):
+		failed = RULE_CHECKS[check](df, column, argument, references, seen)
+		if failed is not None and failed.any():
+			failures.append((code, failed))
+	if not failures:
+		return df
+
+	bad = np.logical_or.reduce([failed for _, failed in failures])
+	reasons = pd.Series('', index=np.flatnonzero(bad), dtype=object)
+	for code, failed in failures:
+		reasons[failed[bad]] += f"{code};"
+	rejected.append(quarantine_records(table_name, df[bad], reasons.str.rstrip(';')))
+
+	counts = {code: int(failed.sum()) for code, failed in failures}
+	changelog.warning(f"Quarantined {int(bad.sum())} rows of {table_name}: {counts}")
+	return df[~bad]
+
+
+# Quarantine the raw students process_students dropped for nulls, then apply the students' quality rules
+def validate_students(df_raw, df_clean, changelog, rejected, references=None, seen=None, spec=STUDENT_COLUMNS):
+	dropped = df_raw[~df_raw.index.isin(df_clean.index)]
+	if not dropped.empty:
+		columns = [column for column in dropped.columns if column in spec]
+		coerced = coerce_columns(
+			dropped,
+			[column for column in columns if pd.api.types.is_numeric_dtype(pd.api.types.pandas_dtype(spec[column][0]))],
+			[column for column in columns if spec[column][0].startswith('datetime64')])
+		reasons = pd.Series('', index=dropped.index, dtype=object)
+		for column, (_, policy) in spec.items():
+			if policy == 'drop':
+				missing = (coerced[column] if column in coerced else dropped[column]).isna().to_numpy()
+				reasons[missing] += f"missing_{column};"
+		rejected.append(quarantine_records('cademycode_students', dropped, reasons.str.rstrip(';')))
+
+	return apply_quality_rules(df_clean, 'cademycode_students', changelog, rejected, references=references, seen=seen)
+
+
+# Split contact_info into its fields. Values with JSON escapes are decoded, the rest is used as it is.
+# Returns None when a value does not have the {"mailing_address": ..., "email": ...} shape, nothing is split then.
+def split_contact_info(contact_info):
+	pattern = r'^\{"mailing_address": "(?P<mailing_address>[^"]*)", "email": "(?P<email>[^"]*)"\}$'
+	if pa is not None:
+		# One RE2 pass in Arrow, pandas extracts Arrow strings row by row with re
+		import pyarrow.compute
+		matches = pyarrow.compute.extract_regex(pa.array(contact_info.astype(STRING_DTYPE)), pattern)
+		fields = pd.DataFrame({
+			field: pd.Series(matches.field(field), index=contact_info.index).where(matches.is_valid().to_numpy(zero_copy_only=False))
+			for field in CONTACT_INFO_FIELDS
+		})
+	else:
+		fields = contact_info.astype(STRING_DTYPE).str.extract(pattern)
+	if (fields['email'].isna() & contact_info.notna()).any():
+		return None
+	for field in CONTACT_INFO_FIELDS:
+		escaped = fields[field].str.contains('\\', regex=False).to_numpy(dtype=bool, na_value=False)
+		if escaped.any():
+			fields.loc[escaped, field] = [json.loads(f'"{value}"') for value in fields.loc[escaped, field]]
+		fields[field] = fields[field].astype(STRING_DTYPE)
+	return fields
+
+
+# JSON string literals of a string column, as json.dumps writes them. Plain printable ASCII is only quoted.
+def json_strings(values):
+	literals = '"' + values + '"'
+	escape = values.str.contains(r'[^\x20\x21\x23-\x5b\x5d-\x7e]').to_numpy(dtype=bool, na_value=False)
+	if escape.any():
+		literals[escape] = values[escape].map(json.dumps)
+	return literals
+
+
+# contact_info rebuilt from the fields of a compacted frame, for the database tables that store it as JSON text
+def join_contact_info(df):
+	if 'contact_info' in df.columns or not set(CONTACT_INFO_FIELDS) <= set(df.columns):
+		return df
+	contact_info = ('{"mailing_address": ' + json_strings(df['mailing_address']) +
+					', "email": ' + json_strings(df['email']) + '}')
+	position = df.columns.get_loc('mailing_address')
+	df = df.drop(columns=CONTACT_INFO_FIELDS)
+	df.insert(position, 'contact_info', contact_info.astype(STRING_DTYPE))
+	return df
+
+
+# Compact a cleaned or merged frame: contact_info split into its fields, CATEGORY_COLUMNS as categoricals,
+# integers downcast to the smallest type that holds their values and text as Arrow-backed strings.
+# Logs the memory footprint before and after.
+def compact_dataframe(df, table_name, changelog):
+	before = df.memory_usage(deep=True).sum()
+	columns = {}
+	for column in df.columns:
+		series = df[column]
+		if column == 'contact_info':
+			fields = split_contact_info(series)
+			if fields is not None:
+				columns.update(fields)
+				continue
+			changelog.warning(f"contact_info of {table_name} does not have the expected shape, it is not split")
+		if column in CATEGORY_COLUMNS:
+			series = series.astype('category')
+		elif pd.api.types.is_integer_dtype(series) and not pd.api.types.is_extension_array_dtype(series):
+			series = pd.to_numeric(series, downcast='integer')
+		elif pd.api.types.is_object_dtype(series) and pd.api.types.infer_dtype(series, skipna=True) == 'string':
+			series = series.astype(STRING_DTYPE)
+		columns[column] = series
+
+	df = pd.DataFrame(columns, index=df.index)
+	after = df.memory_usage(deep=True).sum()
+	changelog.info(f"Compacted {table_name} from {before / 1024 ** 2:.2f} MiB to {after / 1024 ** 2:.2f} MiB "
+				   f"({len(df)} rows, {after / max(len(df), 1):.0f} bytes per row)")
+	return df
+
+
+# Concatenate cleaned partitions into the frame process_students gives for the whole table
+def concat_partitions(parts, spec=STUDENT_COLUMNS):
+	df_students_clean = pd.concat(parts)
+	# Categories of the partitions differ, recompute them over the whole table
+	for column, (dtype, _) in spec.items():
+		if dtype == 'category' and column in df_students_clean:
+			df_students_clean[column] = df_students_clean[column].astype('category')
+	return df_students_clean
+
+
+# Write a frame to an Arrow IPC file, index and pandas dtypes included
+def write_arrow_ipc(df, path):
+	table = pa.Table.from_pandas(df, preserve_index=True)
+	with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+		writer.write_table(table)
+
+
+# Read a frame back through a memory map, the pages are shared with the process that wrote them
+def read_arrow_ipc(path):
+	with pa.memory_map(path) as source:
+		return pa.ipc.open_file(source).read_pandas()
+
+
+# Runs in a worker process: clean one raw partition file into another. Partitions move between processes
+# as memory-mapped Arrow IPC files, not as frames pickled through the pool's pipe.
+def clean_partition(source, target, changelog, spec=STUDENT_COLUMNS):
+	write_arrow_ipc(process_students(read_arrow_ipc(source), changelog, spec), target)
+
+
+# Clean the students in row partitions on a pool of `processes`, one partition per process by default.
+# Gives the same frame as process_students on the whole table.
+def process_students_parallel(df_students, changelog, processes=4, partition_rows=None, spec=STUDENT_COLUMNS):
+	if pa is None:
+		changelog.warning("pyarrow is not installed, cleaning in a single process")
+		return process_students(df_students, changelog, spec)
+	partition_rows = partition_rows or -(-len(df_students) // max(processes, 1))
+	if processes <= 1 or len(df_students) <= partition_rows:
+		return process_students(df_students, changelog, spec)
+
+	with tempfile.TemporaryDirectory(prefix='cademycode-clean-') as tmp_dir:
+		sources, targets = [], []
+		for number, start in enumerate(range(0, len(df_students), partition_rows)):
+			sources.append(os.path.join(tmp_dir, f"raw-{number}.arrow"))
+			targets.append(os.path.join(tmp_dir, f"clean-{number}.arrow"))
+			write_arrow_ipc(df_students.iloc[start:start + partition_rows], sources[-1])
+
+		changelog.info(f"Cleaning df_students in {len(sources)} partitions on {processes} processes")
+		with concurrent_futures.ProcessPoolExecutor(max_workers=processes) as executor:
+			list(executor.map(clean_partition, sources, targets, [changelog] * len(sources), [spec] * len(sources)))
+
+		return concat_partitions([read_arrow_ipc(target) for target in targets], spec)
+
+
+# Rejected rows with the table they came from and why, see QUALITY_RULES
+def define_quarantine_table(metadata):
+	return sqlalchemy.Table(
+		QUARANTINE_TABLE,
+		metadata,
+		sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+		sqlalchemy.Column('source_table', sqlalchemy.String),
+		sqlalchemy.Column('reason', sqlalchemy.String),
+		sqlalchemy.Column('record', sqlalchemy.String),
+		sqlalchemy.Column('quarantined_at', sqlalchemy.String),
+		sqlalchemy.Column('run_id', sqlalchemy.String),
+		sqlalchemy.Column('version', sqlalchemy.String),
+	)
+
 
-	cademycode_students2 = Table(
+# Append the rejected rows in bulk on an open connection, in the caller's transaction. Rejected rows are gone from
+# the published tables, so the quarantine is their only copy and later runs never remove them. `run` stamps the
+# rows with the run_id and version of the run. Rows a resumed run of the same version already published for the
+# same source tables are replaced, so retrying a publish does not add them twice.
+def publish_quarantine(conn, rejected, changelog, run=None):
+	quarantine = define_quarantine_table(sqlalchemy.MetaData())
+	quarantine.create(conn, checkfirst=True)
+	# Quarantine tables of older versions have no run columns yet
+	existing = {column['name'] for column in sqlalchemy.inspect(conn).get_columns(QUARANTINE_TABLE)}
+	for column in quarantine.columns:
+		if column.name not in existing:
+			conn.execute(sqlalchemy.text(f"ALTER TABLE {QUARANTINE_TABLE} ADD COLUMN {column.name} {column.type.compile(conn.dialect)}"))
+	if not rejected:
+		return 0
+
+	df = pd.concat(rejected, ignore_index=True)
+	if run is not None:
+		df = df.assign(**run)
+		conn.execute(quarantine.delete().where(
+			quarantine.c.version == run['version'], quarantine.c.source_table.in_(df['source_table'].unique().tolist())))
+	rows = insert_dataframe(conn, quarantine, df)
+	changelog.info(f"Quarantined {rows} rows into {QUARANTINE_TABLE}")
+	return rows
+
+
+# Declared schemas of the staging tables, keyed by the table each one replaces
+def define_staging_tables(metadata):
+	cademycode_students2 = sqlalchemy.Table(
 		'cademycode_students2',
 		metadata,
-		Column('uuid', Integer, primary_key=True),
-		Column('name', String),
-		Column('dob', DateTime),
-		Column('sex', String),
-		Column('contact_info', String),
-		Column('job_id', Integer),
-		Column('num_course_taken', Integer),
-		Column('current_career_path_id', Integer),
-		Column('time_spent_hrs', Float)
+		sqlalchemy.Column('uuid', sqlalchemy.Integer, primary_key=True),
+		sqlalchemy.Column('name', sqlalchemy.String),
+		sqlalchemy.Column('dob', sqlalchemy.DateTime),
+		sqlalchemy.Column('sex', sqlalchemy.String),
+		sqlalchemy.Column('contact_info', sqlalchemy.String),
+		sqlalchemy.Column('job_id', sqlalchemy.Integer),
+		sqlalchemy.Column('num_course_taken', sqlalchemy.Integer),
+		sqlalchemy.Column('current_career_path_id', sqlalchemy.Integer),
+		sqlalchemy.Column('time_spent_hrs', sqlalchemy.Float)
 	)
 
-	cademycode_jobs2 = Table(
+	cademycode_jobs2 = sqlalchemy.Table(
 		'cademycode_jobs2',
 		metadata,
-		Column('job_id', Integer, primary_key=True),
-		Column('job_category', String),
-		Column('avg_salary', Integer)
+		sqlalchemy.Column('job_id', sqlalchemy.Integer, primary_key=True),
+		sqlalchemy.Column('job_category', sqlalchemy.String),
+		sqlalchemy.Column('avg_salary', sqlalchemy.Integer)
 	)
 
-	cademycode_courses2 = Table(
+	cademycode_courses2 = sqlalchemy.Table(
 		'cademycode_courses2',
 		metadata,
-		Column('career_path_id', Integer, primary_key=True),
-		Column('career_path_name', String),
-		Column('hours_to_complete', Integer)
+		sqlalchemy.Column('career_path_id', sqlalchemy.Integer, primary_key=True),
+		sqlalchemy.Column('career_path_name', sqlalchemy.String),
+		sqlalchemy.Column('hours_to_complete', sqlalchemy.Integer)
 	)
 
-	with engine.begin() as conn:
+	return {
+		'cademycode_students': cademycode_students2,
+		'cademycode_student_jobs': cademycode_jobs2,
+		'cademycode_courses': cademycode_courses2,
+	}
+
+
+# Drop leftovers of an interrupted run and create empty staging tables with the declared schema
+def prepare_staging_tables(conn, metadata, staging_tables):
+	drop_staging_tables(conn, staging_tables)
+	metadata.create_all(conn)
+	conn.commit()
+
+
+def drop_staging_tables(conn, staging_tables):
+	for staging_table in staging_tables.values():
+		conn.execute(sqlalchemy.text(f"DROP TABLE IF EXISTS {staging_table.name}"))
+	conn.commit()
+
+
+# Insert DataFrame rows into a table with batched executemany calls, or run `statement` (an upsert) for them.
+# Staging tables are invisible to readers, so they can be committed batch by batch.
+def insert_dataframe(conn, table, df, batch_size=10000, commit=False, statement=None):
+	columns = [column.name for column in table.columns if column.name in df.columns]
+	statement = table.insert() if statement is None else statement
+	rows = 0
+	for start in range(0, len(df), batch_size):
+		batch = df.iloc[start:start + batch_size][columns].astype(object)
+		records = batch.where(batch.notna(), None).to_dict('records')
+		conn.execute(statement, records)
+		rows += len(records)
+		if commit:
+			conn.commit()
+	return rows
+
+
+# Drop the old tables and rename the staging tables in their place, as a single transaction.
+# after_swap(conn) runs in the same transaction, once the tables have their final names.
+def swap_staging_tables(conn, staging_tables, after_swap=None):
+	conn.commit()
+
+	# pysqlite does not open a transaction before DDL statements, so start one explicitly
+	if conn.dialect.name == 'sqlite':
+		conn.exec_driver_sql("BEGIN")
+
+	try:
+		for table_name in staging_tables:
+			conn.execute(sqlalchemy.text(f"DROP TABLE IF EXISTS {table_name}"))
+
+		for table_name, staging_table in staging_tables.items():
+			conn.execute(sqlalchemy.text(f"ALTER TABLE {staging_table.name} RENAME TO {table_name}"))
+
+		if after_swap is not None:
+			after_swap(conn)
+
+		conn.commit()
+	except Exception:
+		conn.rollback()
+		raise
+
+
+# Function to save DataFrames back to the database
+def update_db_tables(engine, df_students, df_jobs, df_courses, batch_size=10000, tables=None, rejected=None, run=None):
+	metadata = sqlalchemy.MetaData()
+	staging_tables = define_staging_tables(metadata)
+
+	# Only publish the given tables, the others are left as they are
+	if tables is not None:
+		for table_name in set(staging_tables) - set(tables):
+			metadata.remove(staging_tables.pop(table_name))
+	dataframes = {
+		'cademycode_students': df_students,
+		'cademycode_student_jobs': df_jobs,
+		'cademycode_courses': df_courses,
+	}
+
+	with engine.connect() as conn:
 		try:
 			# Create new tables
-			metadata.create_all(conn)
+			prepare_staging_tables(conn, metadata, staging_tables)
+
+			# Insert data into new tables, keeping the declared schema and primary keys
+			for table_name, staging_table in staging_tables.items():
+				df = dataframes[table_name]
+				# A repeated key would abort the whole publish on the primary key, its first row is kept
+				key = TABLE_KEYS[table_name]
+				duplicated = df[key].duplicated().to_numpy()
+				if duplicated.any():
+					changelog.warning(f"Dropped {int(duplicated.sum())} rows of {table_name} with a repeated {key}")
+					if rejected is not None:
+						rejected = rejected + [quarantine_records(table_name, df[duplicated], [f"duplicate_{key}"] * int(duplicated.sum()))]
+					df = df[~duplicated]
+				rows = insert_dataframe(conn, staging_table, df, batch_size, commit=True)
+				changelog.info(f"Loaded {rows} rows into {staging_table.name}")
+
+			# The rows rejected from the republished tables are quarantined together with them
+			if rejected is not None:
+				publish_quarantine(conn, [df for df in rejected if df['source_table'].iloc[0] in staging_tables], changelog, run)
+
+			# Drop old tables and rename new tables
+			swap_staging_tables(conn, staging_tables)
 
-			# Insert data into new table
-			df_students.to_sql('cademycode_students2', engine, if_exists='replace', index=False)
-			df_jobs.to_sql('cademycode_jobs2', engine, if_exists='replace', index=False)
-			df_courses.to_sql('cademycode_courses2', engine, if_exists='replace', index=False)
+			changelog.info('Database updated successfully.')
 
-			# Drop old table and rename new table
-			drop_cademycode_students = text("DROP TABLE IF EXISTS cademycode_students")
-			drop_cademycode_jobs = text("DROP TABLE IF EXISTS cademycode_student_jobs")
-			drop_cademycode_courses = text("DROP TABLE IF EXISTS cademycode_courses")
+		except Exception as e:
+			changelog.error(f"Error updating database: {e}")
+			# The published tables were not touched, leave no half-loaded staging tables behind
+			conn.rollback()
+			drop_staging_tables(conn, staging_tables)
+			raise
 
-			conn.execute(drop_cademycode_students)
-			conn.execute(drop_cademycode_jobs)
-			conn.execute(drop_cademycode_courses)
 
-			rename_drop_cademycode_students = text("ALTER TABLE cademycode_students2 RENAME TO cademycode_students")
-			rename_drop_cademycode_jobs = text("ALTER TABLE cademycode_jobs2 RENAME TO cademycode_student_jobs")
-			rename_drop_cademycode_courses = text("ALTER TABLE cademycode_courses2 RENAME TO cademycode_courses")
+# INSERT ... ON CONFLICT (key) DO UPDATE for the dialects that have it, None for the others
+def upsert_statement(conn, table, key):
+	if conn.dialect.name not in ('sqlite', 'postgresql'):
+		return None
+	dialect = importlib.import_module(f"sqlalchemy.dialects.{conn.dialect.name}")
+	statement = dialect.insert(table)
+	return statement.on_conflict_do_update(
+		index_elements=[key],
+		set_={column.name: statement.excluded[column.name] for column in table.columns if column.name != key})
+
+
+# Column values as the database gives them back, so cleaned and published rows can be compared
+def comparable_values(series):
+	if pd.api.types.is_datetime64_any_dtype(series):
+		return series.astype('datetime64[ns]').to_numpy()
+	if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+		return series.to_numpy(dtype='float64', na_value=np.nan)
+	return series.to_numpy(dtype=object, na_value=None)
+
+
+# Compare the cleaned rows with the published ones by key. Returns the rows to insert, the rows whose values
+# changed and the published keys that are gone. Nulls compare equal to nulls.
+def diff_by_key(df, published, key):
+	df = df.set_index(key, drop=False)
+	published = published.set_index(key, drop=False)
+	new_keys = df.index.difference(published.index)
+	common_keys = df.index.intersection(published.index)
+	deleted_keys = published.index.difference(df.index)
+
+	current = df.loc[common_keys]
+	previous = published.reindex(common_keys)
+	changed = np.zeros(len(common_keys), dtype=bool)
+	for column in df.columns:
+		if column not in previous.columns:
+			continue
+		a, b = comparable_values(current[column]), comparable_values(previous[column])
+		changed |= ~((a == b) | (pd.isna(a) & pd.isna(b)))
+
+	return df.loc[new_keys], current[changed], deleted_keys.tolist()
+
+
+# Publish the cleaned tables by applying only their differences to the published tables: new and changed rows
+# with batched upserts, removed keys with batched deletes, all in one transaction. Indexes, triggers and views on
+# the tables are kept. Tables without a primary key on their key (the raw source tables before the first run)
+# and databases without ON CONFLICT are published with update_db_tables instead.
+# Returns the inserted, updated, deleted and unchanged row counts per table.
+def upsert_db_tables(engine, df_students, df_jobs, df_courses, changelog, batch_size=10000, tables=None, rejected=None, run=None):
+	dataframes = {
+		'cademycode_students': df_students,
+		'cademycode_student_jobs': df_jobs,
+		'cademycode_courses': df_courses,
+	}
+	tables = SOURCE_TABLES if tables is None else [table_name for table_name in SOURCE_TABLES if table_name in tables]
+
+	counts = {}
+	with engine.begin() as conn:
+		try:
+			inspector = sqlalchemy.inspect(conn)
+			metadata = sqlalchemy.MetaData()
+			upserts = {}
+			for table_name in tables:
+				key = TABLE_KEYS[table_name]
+				if not inspector.has_table(table_name) or inspector.get_pk_constraint(table_name)['constrained_columns'] != [key]:
+					continue
+				table = sqlalchemy.Table(table_name, metadata, autoload_with=conn)
+				statement = upsert_statement(conn, table, key)
+				if statement is not None:
+					upserts[table_name] = (table, key, statement)
+
+			for table_name, (table, key, statement) in upserts.items():
+				df = dataframes[table_name]
+				published = pd.read_sql_table(table_name, conn)
+				df_new, df_changed, deleted_keys = diff_by_key(df, published, key)
+
+				insert_dataframe(conn, table, pd.concat([df_new, df_changed]), batch_size, statement=statement)
+				for start in range(0, len(deleted_keys), 500):
+					conn.execute(table.delete().where(table.c[key].in_(deleted_keys[start:start + 500])))
+
+				counts[table_name] = {
+					'inserted': len(df_new),
+					'updated': len(df_changed),
+					'deleted': len(deleted_keys),
+					'unchanged': len(df) - len(df_new) - len(df_changed),
+				}
+				changelog.info(f"Upserted {table_name}: " + ', '.join(f"{count} {name}" for name, count in counts[table_name].items()))
+
+			if rejected is not None and upserts:
+				publish_quarantine(conn, [df for df in rejected if df['source_table'].iloc[0] in upserts], changelog, run)
 
-			conn.execute(rename_drop_cademycode_students)
-			conn.execute(rename_drop_cademycode_jobs)
-			conn.execute(rename_drop_cademycode_courses)
+		except Exception as e:
+			changelog.error(f"Error upserting database tables: {e}")
+			raise
 
-			changelog.info('Database updated successfully.')
+	# Tables that cannot be upserted into are replaced
+	swapped = [table_name for table_name in tables if table_name not in upserts]
+	if swapped:
+		changelog.info(f"No primary key to upsert on in {swapped}, replacing them")
+		update_db_tables(engine, df_students, df_jobs, df_courses, batch_size, tables=swapped, rejected=rejected, run=run)
+	return counts
+
+
+# Clean and publish the students table chunk by chunk so memory is bounded by the chunk size.
+# The small jobs and courses tables are cleaned once and kept in memory for the joins.
+def stream_students(engine, changelog, chunksize=10000, sinks=('csv',), output_dir='.', partition_cols=None, run=None):
+	metadata = sqlalchemy.MetaData()
+	staging_tables = define_staging_tables(metadata)
+	for sink in sinks:
+		if not OUTPUT_SINKS[sink][2]:
+			raise ValueError(f"The {sink} output cannot be written chunk by chunk")
+
+	paths = [os.path.join(output_dir, OUTPUT_SINKS[sink][1]) for sink in sinks]
+	for path in paths:
+		remove_output(f"{path}.tmp")
+	rows_read = 0
+	rows_written = 0
+
+	# Reads and writes share one connection so the open read cursor never blocks the staging writes
+	with engine.connect() as conn:
+		try:
+			prepare_staging_tables(conn, metadata, staging_tables)
+
+			df_jobs = pd.read_sql_table('cademycode_student_jobs', conn)
+			df_courses = pd.read_sql_table('cademycode_courses', conn)
+			rejected = []
+			_, df_jobs, df_courses = process_dataframes(
+				{'cademycode_student_jobs': df_jobs, 'cademycode_courses': df_courses}, changelog, rejected=rejected)
+			references = {'cademycode_student_jobs': df_jobs, 'cademycode_courses': df_courses}
+			seen = {}
+
+			insert_dataframe(conn, staging_tables['cademycode_student_jobs'], df_jobs)
+			insert_dataframe(conn, staging_tables['cademycode_courses'], df_courses)
+
+			chunks = pd.read_sql(sqlalchemy.text("SELECT * FROM cademycode_students ORDER BY rowid"), conn, chunksize=chunksize)
+			for i, chunk in enumerate(chunks):
+				rows_read += len(chunk)
+				df_students = validate_students(chunk, process_students(chunk, changelog), changelog, rejected, references, seen)
+				rows_written += insert_dataframe(conn, staging_tables['cademycode_students'], df_students, chunksize)
+
+				merged_df = merge_df(df_students, df_jobs, df_courses, changelog)
+				for sink, path in zip(sinks, paths):
+					OUTPUT_SINKS[sink][0](merged_df, f"{path}.tmp", append=i > 0, partition_cols=partition_cols)
+
+			publish_quarantine(conn, rejected, changelog, run)
+			swap_staging_tables(conn, staging_tables)
+
+		except Exception as e:
+			changelog.error(f"Error streaming students: {e}")
+			for path in paths:
+				remove_output(f"{path}.tmp")
+			raise
+
+	# Only replace the outputs once the database swap has been committed
+	for path in paths:
+		if os.path.exists(f"{path}.tmp"):
+			replace_output(f"{path}.tmp", path)
+	changelog.info(f"Streamed {rows_read} students in chunks of {chunksize}, {rows_written} written.")
+	return rows_read, rows_written
+
+
+# Marks the end of the chunks flowing through a pipelined run
+END_OF_STREAM = object()
+
+
+# Queue get/put that give up once another stage has failed, so no thread blocks forever on a full or empty queue
+def get_item(inbox, failed):
+	while True:
+		try:
+			return inbox.get(timeout=0.1)
+		except queue.Empty:
+			if failed.is_set():
+				return END_OF_STREAM
+
+
+def put_item(outbox, item, failed):
+	while not failed.is_set():
+		try:
+			outbox.put(item, timeout=0.1)
+			return
+		except queue.Full:
+			pass
+
+
+# Run one stage of a pipelined run in its own thread. The stage takes items from `inbox` (or from `source` for
+# the first stage), passes each through `func` and puts the result on every outbox. Busy time is added to `busy`.
+def start_stage(name, func, outboxes, failed, errors, busy, inbox=None, source=None):
+	def work():
+		try:
+			items = iter(source) if source is not None else None
+			while not failed.is_set():
+				item = next(items, END_OF_STREAM) if items is not None else get_item(inbox, failed)
+				if item is END_OF_STREAM:
+					break
+				start = time.perf_counter()
+				result = func(item)
+				busy[name] += time.perf_counter() - start
+				for outbox in outboxes:
+					put_item(outbox, result, failed)
+		except Exception as e:
+			errors.append((name, e))
+			failed.set()
+		finally:
+			for outbox in outboxes:
+				put_item(outbox, END_OF_STREAM, failed)
+
+	busy[name] = 0.0
+	thread = threading.Thread(target=work, name=f"pipeline-{name}", daemon=True)
+	thread.start()
+	return thread
+
+
+# Like stream_students, but reading, cleaning, publishing and exporting run as concurrent stages joined by
+# bounded queues: read -> clean -> (publish, export). Cleaning chunk N overlaps with reading chunk N+1 and the
+# export runs alongside the database writes, so the wall time approaches that of the slowest stage.
+# SQLite is switched to WAL so the reader and the staging writer do not block each other.
+def pipeline_students(engine, changelog, chunksize=10000, sinks=('csv',), output_dir='.', partition_cols=None, queue_size=4, run=None):
+	metadata = sqlalchemy.MetaData()
+	staging_tables = define_staging_tables(metadata)
+	for sink in sinks:
+		if not OUTPUT_SINKS[sink][2]:
+			raise ValueError(f"The {sink} output cannot be written chunk by chunk")
+
+	enable_wal(engine)
+	paths = [os.path.join(output_dir, OUTPUT_SINKS[sink][1]) for sink in sinks]
+	for path in paths:
+		remove_output(f"{path}.tmp")
+	counts = {'read': 0, 'written': 0, 'exported': 0}
+
+	with engine.connect() as conn:
+		try:
+			prepare_staging_tables(conn, metadata, staging_tables)
+
+			df_jobs = pd.read_sql_table('cademycode_student_jobs', conn)
+			df_courses = pd.read_sql_table('cademycode_courses', conn)
+			rejected = []
+			_, df_jobs, df_courses = process_dataframes(
+				{'cademycode_student_jobs': df_jobs, 'cademycode_courses': df_courses}, changelog, rejected=rejected)
+			references = {'cademycode_student_jobs': df_jobs, 'cademycode_courses': df_courses}
+			seen = {}
+
+			insert_dataframe(conn, staging_tables['cademycode_student_jobs'], df_jobs)
+			insert_dataframe(conn, staging_tables['cademycode_courses'], df_courses)
+
+			# Each rowid range is read in its own short transaction on a separate connection
+			def read(rowid_range):
+				chunk = read_table_range(engine, 'cademycode_students', rowid_range)
+				counts['read'] += len(chunk)
+				return chunk
+
+			def clean(chunk):
+				df_students = validate_students(chunk, process_students(chunk, changelog), changelog, rejected, references, seen)
+				return df_students, merge_df(df_students, df_jobs, df_courses, changelog)
+
+			def publish(cleaned):
+				counts['written'] += insert_dataframe(conn, staging_tables['cademycode_students'], cleaned[0], chunksize)
+
+			def export(cleaned):
+				for sink, path in zip(sinks, paths):
+					OUTPUT_SINKS[sink][0](cleaned[1], f"{path}.tmp", append=counts['exported'] > 0, partition_cols=partition_cols)
+				counts['exported'] += 1
+
+			cleaned_queue = queue.Queue(queue_size)
+			publish_queue = queue.Queue(queue_size)
+			export_queue = queue.Queue(queue_size)
+			failed = threading.Event()
+			errors = []
+			busy = {}
+			threads = [
+				start_stage('read', read, [cleaned_queue], failed, errors, busy,
+							source=get_rowid_ranges(engine, 'cademycode_students', chunksize)),
+				start_stage('clean', clean, [publish_queue, export_queue], failed, errors, busy, inbox=cleaned_queue),
+				start_stage('publish', publish, [], failed, errors, busy, inbox=publish_queue),
+				start_stage('export', export, [], failed, errors, busy, inbox=export_queue),
+			]
+			for thread in threads:
+				thread.join()
+			if errors:
+				name, error = errors[0]
+				raise RuntimeError(f"Pipeline stage '{name}' failed: {error}") from error
+
+			publish_quarantine(conn, rejected, changelog, run)
+			swap_staging_tables(conn, staging_tables)
+
+		except Exception as e:
+			changelog.error(f"Error pipelining students: {e}")
+			for path in paths:
+				remove_output(f"{path}.tmp")
+			raise
+
+	# Only replace the outputs once the database swap has been committed
+	for path in paths:
+		if os.path.exists(f"{path}.tmp"):
+			replace_output(f"{path}.tmp", path)
+	changelog.info(f"Pipelined {counts['read']} students in chunks of {chunksize}, {counts['written']} written. "
+				   f"Stage busy time: {', '.join(f'{name} {seconds:.2f}s' for name, seconds in busy.items())}")
+	return counts['read'], counts['written']
+
+
+# Upsert cleaned deltas in place of the raw rows they were read from
+def append_db_tables(engine, watermarks, dataframes, changelog, rejected=None, run=None):
+	with engine.begin() as conn:
+		try:
+			if rejected:
+				publish_quarantine(conn, rejected, changelog, run)
+
+			for table_name in SOURCE_TABLES:
+				df = dataframes.get(table_name)
+				if df is None:
+					continue
+
+				key = TABLE_KEYS[table_name]
+
+				# Remove the raw delta rows, they are replaced by their cleaned version below
+				conn.execute(sqlalchemy.text(f"DELETE FROM {table_name} WHERE rowid > :watermark"),
+							 {'watermark': watermarks.get(table_name, 0)})
+
+				if df.empty:
+					continue
+
+				# Later rows win, both inside the delta and over rows already in the table
+				df = df.drop_duplicates(subset=[key], keep='last')
+				keys = df[key].tolist()
+				for start in range(0, len(keys), 500):
+					batch = keys[start:start + 500]
+					placeholders = ', '.join(f':k{i}' for i in range(len(batch)))
+					conn.execute(sqlalchemy.text(f"DELETE FROM {table_name} WHERE {key} IN ({placeholders})"),
+								 {f'k{i}': value for i, value in enumerate(batch)})
+
+				df.to_sql(table_name, conn, if_exists='append', index=False)
+				changelog.info(f"Upserted {len(df)} rows into {table_name}")
 
 		except Exception as e:
 			changelog.error(f"Error updating database: {e}")
 			raise
 
 
-def merge_df(df_students, df_jobs, df_courses, changelog):
-	merged_df = df_students.merge(df_jobs, on='job_id', how='inner')
-	changelog.info('df_students and df_jobs merged')
+# Positions of each key in a dimension table's key column, -1 where the key is missing
+def lookup_positions(keys, dimension_keys):
+	return pd.Index(dimension_keys).get_indexer(keys)
+
 
-	merged_df = merged_df.merge(df_courses, left_on='current_career_path_id', right_on='career_path_id', how='inner')
-	changelog.info('df_courses merged to merged_df')
+# Join the students to the job and course dimensions. The dimensions are tiny, so instead of two full merges
+# the row position of every student's job and course is looked up once and the dimension columns are gathered.
+# Gives the same rows, row order and columns as two inner merges; students without a known job or course are
+# dropped and reported.
+def merge_df(df_students, df_jobs, df_courses, changelog):
+	if not (df_jobs['job_id'].is_unique and df_courses['career_path_id'].is_unique):
+		changelog.warning("Dimension keys are not unique, falling back to merges")
+		merged_df = df_students.merge(df_jobs, on='job_id', how='inner')
+		return merged_df.merge(df_courses, left_on='current_career_path_id', right_on='career_path_id', how='inner')
+
+	job_positions = lookup_positions(df_students['job_id'], df_jobs['job_id'])
+	course_positions = lookup_positions(df_students['current_career_path_id'], df_courses['career_path_id'])
+	missing_job = job_positions < 0
+	missing_course = course_positions < 0
+
+	if missing_job.any() or missing_course.any():
+		changelog.warning(
+			f"Dropped {int((missing_job | missing_course).sum())} students from the merge: "
+			f"{int(missing_job.sum())} with unknown job_id {sorted(df_students['job_id'][missing_job].unique().tolist())}, "
+			f"{int(missing_course.sum())} with unknown current_career_path_id "
+			f"{sorted(df_students['current_career_path_id'][missing_course].unique().tolist())}")
+		keep = ~(missing_job | missing_course)
+		df_students = df_students[keep]
+		job_positions = job_positions[keep]
+		course_positions = course_positions[keep]
+
+	merged_df = pd.concat([
+		df_students.reset_index(drop=True),
+		df_jobs.drop(columns='job_id').take(job_positions).reset_index(drop=True),
+		df_courses.take(course_positions).reset_index(drop=True),
+	], axis=1)
+	changelog.info('df_students joined to df_jobs and df_courses')
 	return merged_df
 
 
-def main():
-	global changelog, errorlog
+# Schema of the merged table: the students with their job and course columns, keyed on uuid
+def define_merged_table(metadata, name=MERGED_TABLE):
+	return sqlalchemy.Table(
+		name,
+		metadata,
+		sqlalchemy.Column('uuid', sqlalchemy.Integer, primary_key=True),
+		sqlalchemy.Column('name', sqlalchemy.String),
+		sqlalchemy.Column('dob', sqlalchemy.DateTime),
+		sqlalchemy.Column('sex', sqlalchemy.String),
+		sqlalchemy.Column('contact_info', sqlalchemy.String),
+		sqlalchemy.Column('job_id', sqlalchemy.Integer),
+		sqlalchemy.Column('num_course_taken', sqlalchemy.Integer),
+		sqlalchemy.Column('current_career_path_id', sqlalchemy.Integer),
+		sqlalchemy.Column('time_spent_hrs', sqlalchemy.Float),
+		sqlalchemy.Column('job_category', sqlalchemy.String),
+		sqlalchemy.Column('avg_salary', sqlalchemy.Integer),
+		sqlalchemy.Column('career_path_id', sqlalchemy.Integer),
+		sqlalchemy.Column('career_path_name', sqlalchemy.String),
+		sqlalchemy.Column('hours_to_complete', sqlalchemy.Integer)
+	)
 
-	version_file = '../version.txt'
-	row_counts_file = '../row_counts.json'
-	db_url = 'sqlite:///../cademycode.db'
 
-	current_version = get_current_version(version_file)
-	changelog, errorlog = configure_logging(app_version=current_version)
-	engine = create_db_engine(db_url)
+# Students and hours per career path and job category, sums so dashboards can roll them up either way
+def define_summary_table(metadata):
+	return sqlalchemy.Table(
+		SUMMARY_TABLE,
+		metadata,
+		sqlalchemy.Column('career_path_id', sqlalchemy.Integer),
+		sqlalchemy.Column('career_path_name', sqlalchemy.String),
+		sqlalchemy.Column('job_category', sqlalchemy.String),
+		sqlalchemy.Column('students', sqlalchemy.Integer),
+		sqlalchemy.Column('time_spent_hrs', sqlalchemy.Float),
+		sqlalchemy.Column('hours_to_complete', sqlalchemy.Integer)
+	)
 
-	changelog.info(f"Starting script with version {current_version}")
 
-	# Get row counts
-	if not os.path.exists(row_counts_file) or os.path.getsize(row_counts_file) == 0:
-		last_row_counts = initialize_row_counts(engine, row_counts_file)
+# uuid is the primary key, the other lookup columns get their own index
+def create_merged_indexes(conn):
+	for column in MERGED_INDEXES:
+		conn.execute(sqlalchemy.text(f"CREATE INDEX IF NOT EXISTS ix_{MERGED_TABLE}_{column} ON {MERGED_TABLE} ({column})"))
+
+
+# Recompute the summary from the merged table inside the database, in the caller's transaction
+def refresh_summary_table(conn):
+	summary = define_summary_table(sqlalchemy.MetaData())
+	summary.create(conn, checkfirst=True)
+	conn.execute(summary.delete())
+	conn.execute(sqlalchemy.text(
+		f"INSERT INTO {SUMMARY_TABLE} (career_path_id, career_path_name, job_category, students, time_spent_hrs, hours_to_complete) "
+		f"SELECT career_path_id, career_path_name, job_category, COUNT(*), SUM(time_spent_hrs), SUM(hours_to_complete) "
+		f"FROM {MERGED_TABLE} GROUP BY career_path_id, career_path_name, job_category"))
+
+
+# Replace the merged table with the full merged frame. It is loaded into a staging table without indexes,
+# and the indexes and the summary are built in the swap transaction.
+def publish_merged_table(engine, merged_df, changelog, summary=False, batch_size=10000):
+	metadata = sqlalchemy.MetaData()
+	staging_tables = {MERGED_TABLE: define_merged_table(metadata, f"{MERGED_TABLE}2")}
+
+	def after_swap(conn):
+		create_merged_indexes(conn)
+		if summary:
+			refresh_summary_table(conn)
+
+	with engine.connect() as conn:
+		try:
+			prepare_staging_tables(conn, metadata, staging_tables)
+			rows = insert_dataframe(conn, staging_tables[MERGED_TABLE], merged_df, batch_size, commit=True)
+			swap_staging_tables(conn, staging_tables, after_swap)
+		except Exception as e:
+			changelog.error(f"Error publishing {MERGED_TABLE}: {e}")
+			raise
+
+	changelog.info(f"Published {rows} rows to {MERGED_TABLE}")
+	return rows
+
+
+# Upsert the merged rows of new students and copy the columns of changed jobs and courses onto the merged rows
+# that reference them, in one transaction. Returns the number of upserted rows.
+def upsert_merged_table(engine, merged_df, df_jobs, df_courses, changelog, summary=False, batch_size=10000):
+	rows = 0
+	with engine.begin() as conn:
+		try:
+			table = define_merged_table(sqlalchemy.MetaData())
+			table.create(conn, checkfirst=True)
+			create_merged_indexes(conn)
+
+			if merged_df is not None and not merged_df.empty:
+				statement = upsert_statement(conn, table, 'uuid')
+				if statement is None:
+					keys = merged_df['uuid'].tolist()
+					for start in range(0, len(keys), 500):
+						conn.execute(table.delete().where(table.c.uuid.in_(keys[start:start + 500])))
+				rows = insert_dataframe(conn, table, merged_df, batch_size, statement=statement)
+
+			for df, key, columns in [(df_jobs, 'job_id', ['job_category', 'avg_salary']),
+									 (df_courses, 'career_path_id', ['career_path_name', 'hours_to_complete'])]:
+				if df is None or df.empty:
+					continue
+				foreign_key = 'current_career_path_id' if key == 'career_path_id' else key
+				assignments = ', '.join(f"{column} = :{column}" for column in columns)
+				records = df[[key] + columns].astype(object).where(df[[key] + columns].notna(), None).to_dict('records')
+				conn.execute(sqlalchemy.text(f"UPDATE {MERGED_TABLE} SET {assignments} WHERE {foreign_key} = :{key}"), records)
+
+			if summary:
+				refresh_summary_table(conn)
+
+		except Exception as e:
+			changelog.error(f"Error upserting into {MERGED_TABLE}: {e}")
+			raise
+
+	changelog.info(f"Upserted {rows} rows into {MERGED_TABLE}")
+	return rows
+
+
+# Output sinks for the merged data. Every writer takes the frame, a path and whether to append to it.
+def write_csv(df, path, append=False, **options):
+	df.to_csv(path, mode='a' if append else 'w', header=not (append and os.path.exists(path)), index=False)
+
+
+# Parquet output is a dataset directory: appends add part files, partition_cols split it into one directory per value
+def write_parquet(df, path, append=False, partition_cols=None, compression='zstd', **options):
+	if pa is None:
+		raise ImportError("Parquet output requires pyarrow")
+	import pyarrow.parquet as pq
+
+	if not append and os.path.exists(path):
+		shutil.rmtree(path)
+	table = pa.Table.from_pandas(df, preserve_index=False)
+	pq.write_to_dataset(table, root_path=path, partition_cols=partition_cols or None, compression=compression)
+
+
+def write_feather(df, path, append=False, compression='zstd', **options):
+	if pa is None:
+		raise ImportError("Feather output requires pyarrow")
+	if append:
+		raise ValueError("Feather output cannot be appended to, use csv or parquet")
+	df.reset_index(drop=True).to_feather(path, compression=compression)
+
+
+# Sink name -> (writer, default path, can append)
+OUTPUT_SINKS = {
+	'csv': (write_csv, 'merged_data.csv', True),
+	'parquet': (write_parquet, 'merged_data.parquet', True),
+	'feather': (write_feather, 'merged_data.feather', False),
+}
+
+
+def remove_output(path):
+	if os.path.isdir(path):
+		shutil.rmtree(path)
+	elif os.path.exists(path):
+		os.remove(path)
+
+
+# Replace an output file or dataset directory with a freshly written one
+def replace_output(tmp_path, path):
+	if os.path.isdir(path):
+		shutil.rmtree(path)
+	os.replace(tmp_path, path)
+
+
+# Write merged_df to every sink. Full writes go to a temporary path first so readers never see a partial output.
+def write_outputs(merged_df, sinks, changelog, output_dir='.', append=False, partition_cols=None, compression='zstd'):
+	paths = []
+	for sink in sinks:
+		writer, file_name, _ = OUTPUT_SINKS[sink]
+		path = os.path.join(output_dir, file_name)
+		if append:
+			writer(merged_df, path, append=True, partition_cols=partition_cols, compression=compression)
+		else:
+			tmp_path = f"{path}.tmp"
+			writer(merged_df, tmp_path, partition_cols=partition_cols, compression=compression)
+			replace_output(tmp_path, path)
+		changelog.info(f"Wrote {len(merged_df)} merged rows to {path}")
+		paths.append(path)
+	return paths
+
+
+# Read a merged output back, optionally only some columns and, for Parquet, only matching partitions/rows
+def read_output(path, columns=None, filters=None):
+	if path.endswith('.parquet'):
+		return pd.read_parquet(path, columns=columns, filters=filters)
+	if path.endswith('.feather'):
+		df = pd.read_feather(path, columns=columns)
+	else:
+		df = pd.read_csv(path, usecols=columns)
+
+	for column, op, value in filters or []:
+		if op == '==':
+			df = df[df[column] == value]
+		elif op == 'in':
+			df = df[df[column].isin(value)]
+		else:
+			raise ValueError(f"Unsupported filter operator '{op}'")
+	return df
+
+
+# Delta format -> (file extension, compression)
+DELTA_FORMATS = {
+	'parquet': ('parquet', 'zstd'),
+	'csv': ('csv.gz', 'gzip'),
+}
+DELTA_MANIFEST = 'manifest.json'
+DELTA_STATE = 'row_hashes.npz'
+
+
+def write_delta_file(df, path, compression):
+	tmp_path = f"{path}.tmp"
+	if path.endswith('.parquet'):
+		if pa is None:
+			raise ImportError("Parquet deltas require pyarrow")
+		import pyarrow.parquet as pq
+		pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp_path, compression=compression)
 	else:
-		last_row_counts = load_row_counts(row_counts_file)
+		df.to_csv(tmp_path, index=False, compression=compression)
+	os.replace(tmp_path, path)
+
+
+def file_sha256(path):
+	digest = hashlib.sha256()
+	with open(path, 'rb') as file:
+		for block in iter(lambda: file.read(1 << 20), b''):
+			digest.update(block)
+	return digest.hexdigest()
+
+
+def load_delta_manifest(file_path):
+	if os.path.exists(file_path):
+		with open(file_path, 'r') as file:
+			return json.load(file)
+	return None
+
+
+def save_delta_manifest(manifest, file_path):
+	tmp_path = f"{file_path}.tmp"
+	with open(tmp_path, 'w') as file:
+		json.dump(manifest, file, indent=4)
+	os.replace(tmp_path, file_path)
+
+
+# The uuids and row hashes of the last exported version, sorted by uuid
+def load_row_hashes(file_path):
+	if not os.path.exists(file_path):
+		return None
+	with np.load(file_path) as state:
+		return str(state['version']), state['uuid'], state['hash']
+
+
+def save_row_hashes(file_path, version, uuids, hashes):
+	tmp_path = f"{file_path}.tmp.npz"
+	np.savez(tmp_path, version=np.array(version), uuid=uuids, hash=hashes)
+	os.replace(tmp_path, file_path)
+
+
+# Delta export: write only the merged rows added or changed ('upsert') and removed ('delete', only uuid is set) since
+# the last exported version, as one compressed file per version listed in manifest.json. Rows are compared by a hash
+# of the whole row. After snapshot_every deltas, or when a delta would hold more than half the rows, the full merged
+# data is written as a new snapshot instead and the files before it are removed. Consumers load the snapshot and
+# apply the listed deltas in order. Returns the number of rows written.
+def export_delta(merged_df, delta_dir, version, changelog, delta_format='parquet', snapshot_every=10):
+	extension, compression = DELTA_FORMATS[delta_format]
+	os.makedirs(delta_dir, exist_ok=True)
+	manifest_path = os.path.join(delta_dir, DELTA_MANIFEST)
+	state_path = os.path.join(delta_dir, DELTA_STATE)
+	manifest = load_delta_manifest(manifest_path)
+	state = load_row_hashes(state_path)
+	if state is not None and state[0] == version:
+		changelog.info(f"Version {version} was already exported to {delta_dir}")
+		return 0
+
+	order = np.argsort(merged_df['uuid'].to_numpy(dtype='int64'), kind='stable')
+	uuids = merged_df['uuid'].to_numpy(dtype='int64')[order]
+	# Nearly every contact_info is unique, factorizing before hashing would only cost time
+	hashes = pd.util.hash_pandas_object(merged_df, index=False, categorize=False).to_numpy()[order]
+	columns = [str(column) for column in merged_df.columns]
+
+	# A delta needs the state of the version the manifest ends at. An entry for this version is left over
+	# from an interrupted export and is written again.
+	deltas = [entry for entry in manifest['deltas'] if entry['version'] != version] if manifest else []
+	rows = None
+	if manifest is not None and state is not None and manifest['format'] == delta_format \
+			and manifest['columns'] == columns and manifest['snapshot']['version'] != version \
+			and (deltas[-1]['version'] if deltas else manifest['snapshot']['version']) == state[0] \
+			and len(deltas) < snapshot_every:
+		_, last_uuids, last_hashes = state
+		if len(last_uuids):
+			positions = np.minimum(np.searchsorted(last_uuids, uuids), len(last_uuids) - 1)
+			changed = (last_uuids[positions] != uuids) | (last_hashes[positions] != hashes)
+		else:
+			changed = np.ones(len(uuids), dtype=bool)
+		removed = np.setdiff1d(last_uuids, uuids, assume_unique=True)
+
+		if (changed.sum() + len(removed)) * 2 <= len(uuids):
+			delta = merged_df.iloc[order[changed]].assign(op='upsert')
+			if len(removed):
+				delta = pd.concat([delta, pd.DataFrame({'uuid': removed, 'op': 'delete'})], ignore_index=True)
+			file_name = f"merged_delta_{version}.{extension}"
+			write_delta_file(delta, os.path.join(delta_dir, file_name), compression)
+			deltas.append({'version': version, 'base_version': state[0], 'file': file_name, 'upserts': int(changed.sum()),
+						   'deletes': len(removed), 'sha256': file_sha256(os.path.join(delta_dir, file_name))})
+			manifest.update(version=version, deltas=deltas)
+			rows = len(delta)
+			changelog.info(f"Exported {int(changed.sum())} upserts and {len(removed)} deletes of version {version} to {file_name}")
+
+	if rows is None:
+		# Compact into a full snapshot
+		file_name = f"merged_snapshot_{version}.{extension}"
+		write_delta_file(merged_df, os.path.join(delta_dir, file_name), compression)
+		manifest = {'version': version, 'format': delta_format, 'columns': columns, 'deltas': [],
+					'snapshot': {'version': version, 'file': file_name, 'rows': len(merged_df),
+								 'sha256': file_sha256(os.path.join(delta_dir, file_name))}}
+		rows = len(merged_df)
+		changelog.info(f"Exported a snapshot of {rows} rows of version {version} to {file_name}")
+
+	# The manifest goes first, an export interrupted before the state is saved is written again by the next run
+	save_delta_manifest(manifest, manifest_path)
+	save_row_hashes(state_path, version, uuids, hashes)
+	listed = {manifest['snapshot']['file']} | {entry['file'] for entry in manifest['deltas']}
+	for file_name in os.listdir(delta_dir):
+		if file_name.startswith('merged_') and file_name not in listed:
+			os.remove(os.path.join(delta_dir, file_name))
+	return rows
+
+
+# Apply one delta to the merged data of its base version
+def apply_delta(df, delta):
+	dtypes = {column: dtype for column, dtype in df.dtypes.items() if dtype.kind in 'biuM'}
+	upserts = delta[delta['op'] == 'upsert'].drop(columns='op')
+	df = pd.concat([df[~df['uuid'].isin(delta['uuid'])], upserts], ignore_index=True)
+	return df.astype(dtypes)
+
+
+# What a consumer does: load the snapshot of a delta export and apply its deltas, giving the latest version
+def load_delta_export(delta_dir):
+	manifest = load_delta_manifest(os.path.join(delta_dir, DELTA_MANIFEST))
+	df = read_output(os.path.join(delta_dir, manifest['snapshot']['file']))
+	for entry in manifest['deltas']:
+		df = apply_delta(df, read_output(os.path.join(delta_dir, entry['file'])))
+	return df
+
+
+# Options that change what a run writes, an interrupted run is only resumed with the same ones
+RESUME_OPTIONS = ['incremental', 'chunksize', 'pipelined', 'publish', 'merged_table', 'summary_table', 'compact',
+				  'change_detector', 'output', 'output_dir', 'partition_by', 'delta_dir', 'delta_format']
+
+
+# Run-state journal of the run in progress: its version, what detect found, a fingerprint of the source tables as
+# the run left them and the stages that completed. It is removed when the run completes, so a run that finds one
+# resumes after the completed stages instead of bumping the version again and starting over.
+def save_run_state(journal, file_path):
+	tmp_path = f"{file_path}.tmp"
+	with open(tmp_path, 'w') as file:
+		json.dump(journal, file)
+	os.replace(tmp_path, file_path)
+
+
+def load_run_state(file_path):
+	if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
+		with open(file_path, 'r') as file:
+			return json.load(file)
+	return None
+
+
+def complete_stage(journal, name, file_path, **outputs):
+	journal['stages'][name] = outputs
+	save_run_state(journal, file_path)
+
+
+def clear_run_state(file_path, checkpoint_dir):
+	remove_output(checkpoint_dir)
+	remove_output(file_path)
+
+
+def resume_options(args):
+	return json.loads(json.dumps({option: getattr(args, option) for option in RESUME_OPTIONS}))
+
+
+# Row count and highest rowid of every source table, cheap enough to take after every stage that writes them
+def get_source_fingerprint(engine):
+	return {table: [count_rows(engine, table), rowid] for table, rowid in get_watermarks(engine).items()}
+
+
+# An interrupted run is resumed when it ran with the same options, its checkpoints are still there and nothing
+# else wrote the source tables since
+def can_resume(journal, engine, args, changelog, checkpoint_dir):
+	files = journal['stages'].get('clean', {}).get('frames', {})
+	if journal.get('options') != resume_options(args):
+		changelog.warning(f"Not resuming the interrupted run of version {journal['version']}, it used other options")
+		return False
+	if not all(os.path.exists(os.path.join(checkpoint_dir, file_name)) for file_name in files.values()):
+		changelog.warning(f"Not resuming the interrupted run of version {journal['version']}, its checkpoints are gone")
+		return False
+	if journal.get('fingerprint') != get_source_fingerprint(engine):
+		changelog.warning(f"Not resuming the interrupted run of version {journal['version']}, the database changed since")
+		return False
+	return True
+
+
+# Checkpoint frames as Arrow IPC files in checkpoint_dir, returns their file names
+def checkpoint_frames(frames, checkpoint_dir):
+	os.makedirs(checkpoint_dir, exist_ok=True)
+	files = {}
+	for name, df in frames.items():
+		files[name] = f"{name}.arrow"
+		write_arrow_ipc(df, os.path.join(checkpoint_dir, files[name]))
+	return files
 
-	current_row_counts = get_row_counts(engine)
 
-	try:
-		if check_for_updates(engine, last_row_counts, changelog, current_row_counts):
-			changelog.info("Updates found.")
+def load_checkpoint_frames(files, checkpoint_dir):
+	return {name: read_arrow_ipc(os.path.join(checkpoint_dir, file_name)) for name, file_name in files.items()}
 
-			# Update the version
-			new_version = update_version(current_version)
 
-			# Reconfigure logging with the new version
-			changelog, errorlog = configure_logging(app_version=new_version)
-			changelog.info(f"Version updated. New version: {new_version}")
+# Where an appendable output ends: the size of a CSV file, the files of a Parquet dataset, None when there is none
+def output_mark(path):
+	if os.path.isdir(path):
+		return sorted(os.path.relpath(os.path.join(root, name), path) for root, _, names in os.walk(path) for name in names)
+	return os.path.getsize(path) if os.path.exists(path) else None
 
-			changelog.info("Processing data...")
 
-			# Get DataFrames
-			dataframes = get_dataframes(engine, changelog)
+# Cut an appendable output back to a mark, undoing whatever an interrupted append wrote
+def rollback_output(path, mark):
+	if mark is None:
+		remove_output(path)
+	elif os.path.isdir(path):
+		for name in set(output_mark(path)) - set(mark):
+			os.remove(os.path.join(path, name))
+	elif os.path.exists(path):
+		with open(path, 'r+b') as file:
+			file.truncate(mark)
 
-			# Process DataFrames
-			df_students, df_jobs, df_courses = process_dataframes(dataframes, changelog)
 
-			# Save DataFrames back to the database
-			update_db_tables(engine, df_students, df_jobs, df_courses)
+# One pass of the pipeline: detect changes, then clean, publish and export whatever changed
+def run_pipeline(engine, read_engine, args, paths=None, run_id=None, warm=None):
+	global changelog, errorlog
+
+	paths = paths or state_paths()
+	run_id = run_id or time.strftime('%Y%m%dT%H%M%S')
+	if args.profile and profiling is None:
+		# Profile the whole run and each of its stages, filed under the version of this run's version file
+		with profile_run(run_id, args.profile_dir, paths.version_file, top=args.profile_top):
+			return run_pipeline(engine, read_engine, args, paths, run_id, warm)
+
+	# Table names and cleaned dimension tables kept by watch from the previous runs, see watch
+	table_names = warm.get('table_names') if warm is not None else None
+
+	current_version = get_current_version(paths.version_file)
+	changelog, errorlog = configure_logging(log_file_prefix=paths.log_dir, app_version=current_version)
+	metrics = []
 
-			# Save the current row counts
-			current_row_counts = get_row_counts(engine)
-			save_row_counts(current_row_counts, row_counts_file)
+	changelog.info(f"Starting script with version {current_version}")
 
-			# Merge dataframes into CSV
-			merged_df = merge_df(df_students, df_jobs, df_courses, changelog)
-			merged_df.to_csv('merged_data.csv', index=False)
+	journal = load_run_state(paths.run_state_file)
+	try:
+		if journal is not None and not can_resume(journal, engine, args, changelog, paths.checkpoint_dir):
+			clear_run_state(paths.run_state_file, paths.checkpoint_dir)
+			journal = None
+
+		if journal is not None:
+			# Pick up an interrupted run where it stopped, its version was already bumped
+			new_version = journal['version']
+			changed_sources = journal['changed_sources']
+			incremental = journal['incremental']
+			last_watermarks = journal['watermarks']
+			changelog, errorlog = configure_logging(log_file_prefix=paths.log_dir, app_version=new_version)
+			changelog.info(f"Resuming the interrupted run of version {new_version}, completed stages: {list(journal['stages'])}")
 
+		else:
+			with stage('detect', metrics, current_version) as record:
+				last_state = load_last_state(args.change_detector, paths)
+				changed_tables, current_state = detect_changes(engine, last_state, changelog, args.change_detector, table_names)
+				changed_sources = [table for table in SOURCE_TABLES if table in changed_tables]
+				record['rows_out'] = len(changed_tables)
+
+			if changed_sources:
+				changelog.info(f"Updates found in {changed_sources}.")
+
+				# Update the version
+				new_version = update_version(current_version, paths.version_file)
+
+				# Reconfigure logging with the new version
+				changelog, errorlog = configure_logging(log_file_prefix=paths.log_dir, app_version=new_version)
+				changelog.info(f"Version updated. New version: {new_version}")
+
+				# Tables that did not change were published by the last run and can be skipped
+				if not last_state:
+					changed_sources = SOURCE_TABLES
+
+				last_watermarks = load_watermarks(paths.watermarks_file)
+				incremental = args.incremental and can_run_incremental(
+					last_watermarks, get_watermarks(read_engine), load_row_counts(paths.row_counts_file),
+					get_row_counts(read_engine, args.workers, table_names), changelog)
+
+				# Journal the run before any work, so a crash from here on resumes instead of starting over
+				journal = {
+					'version': new_version, 'changed_sources': changed_sources, 'incremental': incremental,
+					'watermarks': last_watermarks, 'options': resume_options(args),
+					'fingerprint': get_source_fingerprint(engine), 'stages': {},
+				}
+				save_run_state(journal, paths.run_state_file)
+
+		if journal is not None:
+			changelog.info("Processing data...")
+			completed = journal['stages']
+			# Quarantined rows are stamped with the run that rejected them
+			run = {'run_id': run_id, 'version': new_version}
+			if warm is not None:
+				# The changed tables are read again, whichever way this run processes them
+				warm['dimensions'] = {table_name: df for table_name, df in warm.get('dimensions', {}).items()
+									  if table_name not in changed_sources}
+
+			if args.pipelined and not incremental:
+				# Read, clean, publish and export the students as concurrent stages
+				if 'pipeline' not in completed:
+					with stage('pipeline', metrics, new_version) as record:
+						record['rows_in'], record['rows_out'] = pipeline_students(
+							engine, changelog, chunksize=args.chunksize, sinks=args.output, output_dir=args.output_dir,
+							partition_cols=args.partition_by, run=run)
+					journal['fingerprint'] = get_source_fingerprint(engine)
+					complete_stage(journal, 'pipeline', paths.run_state_file)
+
+			elif args.chunksize and not incremental:
+				# Clean, publish and export the students chunk by chunk
+				if 'stream' not in completed:
+					with stage('stream', metrics, new_version) as record:
+						record['rows_in'], record['rows_out'] = stream_students(
+							engine, changelog, chunksize=args.chunksize, sinks=args.output, output_dir=args.output_dir,
+							partition_cols=args.partition_by, run=run)
+					journal['fingerprint'] = get_source_fingerprint(engine)
+					complete_stage(journal, 'stream', paths.run_state_file)
+
+			else:
+				if 'clean' in completed and pa is not None:
+					# The cleaned tables of the interrupted run were checkpointed
+					frames = load_checkpoint_frames(completed['clean']['frames'], paths.checkpoint_dir)
+					df_students, df_jobs, df_courses = frames.pop('students'), frames.pop('jobs'), frames.pop('courses')
+					rejected = [frames[name] for name in sorted(frames)]
+					read_tables = completed['clean']['read_tables']
+				else:
+					# Dimension tables that did not change since watch cleaned them are neither read nor cleaned again
+					cached = {} if warm is None or incremental else warm['dimensions']
+					with stage('read', metrics, new_version) as record:
+						if incremental:
+							# Get only the rows added since the last run
+							dataframes = get_dataframes_since(engine, last_watermarks, changelog, changed_sources)
+						elif args.workers > 1:
+							dataframes = get_dataframes_parallel(read_engine, changelog, args.workers,
+																 tables=[table for table in SOURCE_TABLES if table not in cached])
+						else:
+							# Get DataFrames
+							dataframes = get_dataframes(engine, changelog, tables=[table for table in SOURCE_TABLES if table not in cached])
+						read_tables = list(dataframes)
+						record['rows_out'] = sum(len(df) for df in dataframes.values())
+
+					# Process DataFrames
+					with stage('clean', metrics, new_version, rows_in=record['rows_out']) as record:
+						rejected = []
+						references = cached or None
+						if incremental:
+							# Deltas are checked against the published dimension tables
+							references = {table_name: pd.read_sql_table(table_name, engine)
+										  for table_name in ['cademycode_student_jobs', 'cademycode_courses'] if table_name not in dataframes}
+						df_students, df_jobs, df_courses = process_dataframes(
+							dataframes, changelog, rejected=rejected, references=references,
+							processes=args.processes, compact=args.compact)
+						df_jobs = cached.get('cademycode_student_jobs', df_jobs)
+						df_courses = cached.get('cademycode_courses', df_courses)
+						record['rows_out'] = len(df_students) + len(df_jobs) + len(df_courses)
+					if warm is not None and not incremental:
+						warm['dimensions'] = {'cademycode_student_jobs': df_jobs, 'cademycode_courses': df_courses}
+
+					if pa is not None:
+						frames = {'students': df_students, 'jobs': df_jobs, 'courses': df_courses}
+						frames.update((f"rejected_{index:03d}", df) for index, df in enumerate(rejected))
+						complete_stage(journal, 'clean', paths.run_state_file,
+									   frames=checkpoint_frames(frames, paths.checkpoint_dir), read_tables=read_tables)
+
+				# Save DataFrames back to the database
+				if 'publish' not in completed:
+					with stage('publish', metrics, new_version, rows_in=len(df_students) + len(df_jobs) + len(df_courses)) as record:
+						if incremental:
+							# Upsert the delta into the database
+							append_db_tables(engine, last_watermarks, {
+								'cademycode_students': df_students if 'cademycode_students' in read_tables else None,
+								'cademycode_student_jobs': df_jobs if 'cademycode_student_jobs' in read_tables else None,
+								'cademycode_courses': df_courses if 'cademycode_courses' in read_tables else None,
+							}, changelog, rejected=rejected, run=run)
+						elif args.publish == 'upsert':
+							# Only write the rows that changed into the published tables
+							upsert_db_tables(engine, join_contact_info(df_students), df_jobs, df_courses, changelog,
+											 tables=changed_sources, rejected=rejected, run=run)
+						else:
+							# The students table keeps contact_info as JSON text, it is also the source of the next run
+							update_db_tables(engine, join_contact_info(df_students), df_jobs, df_courses, tables=changed_sources,
+											 rejected=rejected, run=run)
+						record['rows_out'] = record['rows_in']
+					journal['fingerprint'] = get_source_fingerprint(engine)
+					complete_stage(journal, 'publish', paths.run_state_file)
+
+			if incremental and df_students.empty:
+				changelog.info("No new students to merge.")
+
+			elif incremental:
+				# Merge the new students against the full dimension tables and append them to the CSV
+				with stage('merge', metrics, new_version, rows_in=len(df_students)) as record:
+					merged_df = merge_df(df_students, pd.read_sql_table('cademycode_student_jobs', engine),
+										 pd.read_sql_table('cademycode_courses', engine), changelog)
+					record['rows_out'] = len(merged_df)
+
+				if 'export' not in completed:
+					with stage('export', metrics, new_version, rows_in=len(merged_df)) as record:
+						# Where the outputs ended before this run, an interrupted append is cut back to it first
+						output_paths = [os.path.join(args.output_dir, OUTPUT_SINKS[sink][1]) for sink in args.output]
+						if 'output_marks' not in journal:
+							journal['output_marks'] = {path: output_mark(path) for path in output_paths}
+							save_run_state(journal, paths.run_state_file)
+						for path in output_paths:
+							rollback_output(path, journal['output_marks'][path])
+						write_outputs(merged_df, args.output, changelog, output_dir=args.output_dir, append=True,
+									  partition_cols=args.partition_by)
+						record['rows_out'] = len(merged_df)
+					complete_stage(journal, 'export', paths.run_state_file)
+
+			elif not args.chunksize and not args.pipelined:
+				# Merge dataframes into CSV
+				with stage('merge', metrics, new_version, rows_in=len(df_students)) as record:
+					merged_df = merge_df(df_students, df_jobs, df_courses, changelog)
+					if args.compact:
+						merged_df = compact_dataframe(merged_df, 'merged', changelog)
+					record['rows_out'] = len(merged_df)
+
+				if 'export' not in completed:
+					with stage('export', metrics, new_version, rows_in=len(merged_df)) as record:
+						write_outputs(merged_df, args.output, changelog, output_dir=args.output_dir, partition_cols=args.partition_by)
+						record['rows_out'] = len(merged_df)
+					complete_stage(journal, 'export', paths.run_state_file)
+
+				if args.delta_dir and 'delta' not in completed:
+					# Export only what changed since the last version
+					with stage('delta', metrics, new_version, rows_in=len(merged_df)) as record:
+						record['rows_out'] = export_delta(merged_df, args.delta_dir, new_version, changelog, args.delta_format,
+														  args.snapshot_every)
+					complete_stage(journal, 'delta', paths.run_state_file)
+
+			if args.merged_table and 'materialize' not in completed:
+				# Publish the merged rows as an indexed table for point queries
+				with stage('materialize', metrics, new_version) as record:
+					if incremental and sqlalchemy.inspect(engine).has_table(MERGED_TABLE):
+						# Only the new students and the changed jobs and courses
+						record['rows_out'] = upsert_merged_table(
+							engine, None if df_students.empty else merged_df, df_jobs, df_courses, changelog, args.summary_table)
+					else:
+						if incremental:
+							# First materialization of an incremental setup, merge the whole published tables
+							merged_df = merge_df(*[pd.read_sql_table(table_name, engine) for table_name in SOURCE_TABLES], changelog)
+						record['rows_out'] = publish_merged_table(engine, join_contact_info(merged_df), changelog, args.summary_table)
+				complete_stage(journal, 'materialize', paths.run_state_file)
+
+			# Save the current row counts, watermarks and change state
+			with stage('recount', metrics, new_version) as record:
+				if warm is not None:
+					# Listed once after this run's writes, which may have added tables, and kept for the next runs
+					warm['table_names'] = table_names = get_table_names(engine)
+				current_row_counts = get_row_counts(read_engine, args.workers, table_names)
+				save_row_counts(current_row_counts, paths.row_counts_file)
+				save_watermarks(get_watermarks(engine), paths.watermarks_file)
+				save_change_state(get_change_state(engine, args.change_detector, table_names), paths.change_state_file)
+				record['rows_out'] = sum(current_row_counts.values())
+
+			clear_run_state(paths.run_state_file, paths.checkpoint_dir)
 			changelog.info("Data processing and merging completed successfully.")
 
 
 		else:
 			changelog.info("No updates found.")
+			if changed_tables:
+				# Only tables the pipeline does not read changed, remember them so they are not reported again
+				save_change_state(current_state, paths.change_state_file)
+				if warm is not None:
+					warm['table_names'] = get_table_names(engine)
 	except Exception as e:
 		errorlog.error(f"An error occurred: {e}")
 		raise
+	finally:
+		if args.metrics_file:
+			write_metrics(metrics, args.metrics_file, run_id)
+		if args.prometheus_file:
+			write_prometheus_metrics(metrics, args.prometheus_file)
+
+
+# Cheap change token for the watch loop: the file size and mtime, plus for SQLite the data_version of a
+# connection that stays open, which changes whenever any other connection commits
+def poll_changes(connection, db_path):
+	token = get_file_fingerprint(db_path) if db_path else None
+	if connection.dialect.name == 'sqlite':
+		token = (token, connection.exec_driver_sql("PRAGMA data_version").scalar())
+		connection.rollback()
+	return token
+
+
+# Keep the engines warm and run the pipeline whenever the poll token changes, until `stop` is set.
+# The table names and the cleaned job and course tables are kept between runs as well, and only listed, read
+# or cleaned again after detect_changes reported a change. A failed run is logged and retried on the next
+# change instead of stopping the service.
+def watch(engine, read_engine, args, stop=None, paths=None):
+	stop = stop or threading.Event()
+	db_path = get_db_file(engine)
+	warm = {}
+	with engine.connect() as connection:
+		last_token = None
+		while not stop.is_set():
+			token = poll_changes(connection, db_path)
+			if token != last_token:
+				# Taken before the run, so writes that land during it are picked up by the next poll.
+				# The run's own writes only cost one extra pass that stops at the fingerprint check.
+				last_token = token
+				try:
+					run_pipeline(engine, read_engine, args, paths, warm=warm)
+				except Exception as e:
+					logging.getLogger('errorlog').error(f"Run failed, waiting for the next change: {e}")
+			stop.wait(args.interval)
+
+
+# The database, state files and log directory of a run, passed down from main. Defaults to the module globals
+# as they are when the run starts.
+def state_paths():
+	return argparse.Namespace(
+		db_url=DB_URL, version_file=VERSION_FILE, row_counts_file=ROW_COUNTS_FILE, watermarks_file=WATERMARKS_FILE,
+		change_state_file=CHANGE_STATE_FILE, run_state_file=RUN_STATE_FILE, checkpoint_dir=CHECKPOINT_DIR, log_dir=LOG_DIR)
+
+
+# A shard keeps its state files and logs in its own directory
+def shard_paths(db_path, shard_dir):
+	return argparse.Namespace(
+		db_url=f"sqlite:///{os.path.abspath(db_path)}", log_dir=shard_dir,
+		**{name: os.path.join(shard_dir, file_name) for name, file_name in STATE_FILE_NAMES.items()})
+
+
+# A shard's state directory is named after its database file
+def shard_name(db_path):
+	return os.path.splitext(os.path.basename(db_path))[0]
+
+
+# Runs in a worker process: run the usual single-source pipeline on the shard with the database, state files
+# and logs of shard_paths, writing the merged output into the shard directory.
+# Returns whether the shard had changes, i.e. whether its version moved.
+def run_shard(db_path, shard_dir, args):
+	paths = shard_paths(db_path, shard_dir)
+	shard_args = argparse.Namespace(**vars(args))
+	shard_args.sources = None
+	shard_args.output_dir = shard_dir
+	shard_args.metrics_file = args.metrics_file and os.path.join(shard_dir, 'metrics.jsonl')
+	shard_args.prometheus_file = None
+	shard_args.delta_dir = None
+	shard_args.profile_dir = os.path.join(shard_dir, 'profiles')
+
+	last_version = get_current_version(paths.version_file)
+	main(shard_args, paths=paths)
+	return get_current_version(paths.version_file) != last_version
+
+
+# Concatenate the merged outputs of the shards in source order and keep the last row of each uuid,
+# so a student found in several shards comes from the last source listed
+def consolidate_shards(shard_dirs, sinks, changelog):
+	sink = 'parquet' if 'parquet' in sinks else sinks[0]
+	paths = [os.path.join(shard_dir, OUTPUT_SINKS[sink][1]) for shard_dir in shard_dirs]
+	frames = [read_output(path) for path in paths if os.path.exists(path)]
+	merged_df = pd.concat(frames, ignore_index=True)
+	rows = len(merged_df)
+	merged_df = merged_df.drop_duplicates('uuid', keep='last', ignore_index=True)
+	changelog.info(f"Consolidated {len(frames)} shards into {len(merged_df)} rows, dropped {rows - len(merged_df)} duplicate uuids")
+	return merged_df
+
+
+# Multi-source run: every shard database goes through its own pipeline on a process pool, with its own
+# watermarks and change state. Unchanged shards stop at the change check, so a run costs about as much
+# as its changed shards. The shard outputs are then merged into one output, deduplicated on uuid.
+def run_shards(args, paths):
+	global changelog, errorlog
+
+	current_version = get_current_version(paths.version_file)
+	changelog, errorlog = configure_logging(log_file_prefix=paths.log_dir, app_version=current_version)
+	metrics = []
+
+	changelog.info(f"Starting script with version {current_version} for {len(args.sources)} sources")
+
+	shard_dirs = {db_path: os.path.join(args.shards_dir, shard_name(db_path)) for db_path in args.sources}
+	for shard_dir in shard_dirs.values():
+		os.makedirs(shard_dir, exist_ok=True)
+
+	try:
+		changed, failed = [], []
+		with stage('shards', metrics, current_version) as record:
+			with concurrent_futures.ProcessPoolExecutor(max_workers=min(args.shard_processes, len(shard_dirs))) as executor:
+				futures = {executor.submit(run_shard, db_path, shard_dir, args): db_path for db_path, shard_dir in shard_dirs.items()}
+				for future in concurrent_futures.as_completed(futures):
+					db_path = futures[future]
+					try:
+						if future.result():
+							changed.append(shard_name(db_path))
+					except Exception as e:
+						# The other shards still finish, the failed one keeps its last output
+						errorlog.error(f"Shard {shard_name(db_path)} failed: {e}")
+						failed.append(shard_name(db_path))
+			record['rows_out'] = len(changed)
+
+		missing = [sink for sink in args.output if not os.path.exists(os.path.join(args.output_dir, OUTPUT_SINKS[sink][1]))]
+		if changed or missing:
+			changelog.info(f"Updates found in shards {sorted(changed)}.")
+
+			# Update the version
+			new_version = update_version(current_version, paths.version_file)
+
+			# Reconfigure logging with the new version
+			changelog, errorlog = configure_logging(log_file_prefix=paths.log_dir, app_version=new_version)
+			changelog.info(f"Version updated. New version: {new_version}")
+
+			with stage('consolidate', metrics, new_version) as record:
+				merged_df = consolidate_shards(shard_dirs.values(), args.output, changelog)
+				write_outputs(merged_df, args.output, changelog, output_dir=args.output_dir, partition_cols=args.partition_by)
+				if args.delta_dir:
+					export_delta(merged_df, args.delta_dir, new_version, changelog, args.delta_format, args.snapshot_every)
+				record['rows_out'] = len(merged_df)
+		else:
+			changelog.info("No updates found.")
+
+		if failed:
+			raise RuntimeError(f"Shards {sorted(failed)} failed, see their errorlog.log")
+	except Exception as e:
+		errorlog.error(f"An error occurred: {e}")
+		raise
+	finally:
+		if args.metrics_file:
+			write_metrics(metrics, args.metrics_file, time.strftime('%Y%m%dT%H%M%S'))
+
+
+def main(args=None, stop=None, paths=None):
+	if args is None:
+		args = parse_args([])
+	paths = paths or state_paths()
+
+	if args.sources:
+		run_shards(args, paths)
+		return
+
+	if not args.watch and nothing_to_do(args, paths):
+		return
+	load_lazy_modules()
+
+	engine = create_db_engine(paths.db_url)
+	read_engine = engine
+	if args.workers > 1:
+		# Parallel extraction reads through its own pool of read-only connections
+		enable_wal(engine)
+		read_engine = create_db_engine(paths.db_url, pool_size=args.workers, read_only=True)
+
+	try:
+		if args.watch:
+			stop = stop or threading.Event()
+			if threading.current_thread() is threading.main_thread():
+				signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+			try:
+				watch(engine, read_engine, args, stop, paths)
+			except KeyboardInterrupt:
+				pass
+		else:
+			run_pipeline(engine, read_engine, args, paths)
+	finally:
+		if read_engine is not engine:
+			read_engine.dispose()
+		engine.dispose()
+
+
+def parse_args(argv=None):
+	parser = argparse.ArgumentParser(description='CademyCode subscription pipeline')
+	parser.add_argument('--incremental', action='store_true',
+						help='only read, clean and upsert rows added since the last run')
+	parser.add_argument('--chunksize', type=int, default=None,
+						help='stream the students table in chunks of this many rows')
+	parser.add_argument('--pipelined', action='store_true',
+						help='read, clean, publish and export the students as overlapping stages (chunks of --chunksize rows)')
+	parser.add_argument('--workers', type=int, default=1,
+						help='read tables and row ranges with this many threads and pooled connections')
+	parser.add_argument('--processes', type=int, default=1,
+						help='clean the students table in this many row partitions on a process pool')
+	parser.add_argument('--publish', choices=['swap', 'upsert'], default='swap',
+						help='replace the published tables, or upsert and delete only the rows that changed')
+	parser.add_argument('--merged-table', action='store_true',
+						help=f"also publish the merged data to the indexed {MERGED_TABLE} table")
+	parser.add_argument('--summary-table', action='store_true',
+						help=f"also maintain the {SUMMARY_TABLE} table of students and hours per career path and job category")
+	parser.add_argument('--compact', action='store_true',
+						help='split contact_info into mailing_address and email, use categoricals and downcast integers')
+	parser.add_argument('--change-detector', choices=sorted(CHANGE_DETECTORS), default='counts',
+						help='how tables are compared between runs: row counts, max rowid or content hash')
+	parser.add_argument('--output', default='csv',
+						help=f"comma-separated merged output formats: {', '.join(OUTPUT_SINKS)}")
+	parser.add_argument('--partition-by', choices=['career_path_name', 'job_category'], action='append',
+						help='partition the Parquet output by this column, can be given more than once')
+	parser.add_argument('--delta-dir', default=None,
+						help='also export the merged rows that changed since the last version to this directory')
+	parser.add_argument('--delta-format', choices=list(DELTA_FORMATS), default='parquet',
+						help='write the deltas and snapshots as zstd Parquet or gzip CSV')
+	parser.add_argument('--snapshot-every', type=int, default=10,
+						help='compact the deltas into a full snapshot after this many')
+	parser.add_argument('--output-dir', default='.',
+						help='write the merged outputs to this directory')
+	parser.add_argument('--sources', nargs='+', default=None, metavar='DB_FILE',
+						help='run the pipeline on each of these SQLite shard databases and consolidate their outputs')
+	parser.add_argument('--shards-dir', default=SHARDS_DIR,
+						help='keep the state, logs and outputs of each shard in a directory below this one')
+	parser.add_argument('--shard-processes', type=int, default=4,
+						help='run this many shards at once')
+	parser.add_argument('--watch', action='store_true',
+						help='keep running and process the database whenever it changes')
+	parser.add_argument('--interval', type=float, default=5.0,
+						help='seconds between change polls in --watch mode')
+	parser.add_argument('--metrics-file', default='../metrics.jsonl',
+						help='append per-stage timing and memory records to this JSON-lines file')
+	parser.add_argument('--prometheus-file', default=None,
+						help='also write the stage metrics to this node_exporter textfile collector file')
+	parser.add_argument('--profile', action='store_true', default=bool(os.environ.get(PROFILE_ENV)),
+						help=f"write cProfile stats, allocation reports and collapsed stacks of each run (or set {PROFILE_ENV})")
+	parser.add_argument('--profile-dir', default=PROFILE_DIR,
+						help='write the profiles to a directory per version below this one')
+	parser.add_argument('--profile-top', type=int, default=25,
+						help='report this many allocation sites per stage, 0 turns off the (slow) memory tracing')
+	args = parser.parse_args(argv)
+
+	args.output = [sink.strip() for sink in args.output.split(',') if sink.strip()]
+	for sink in args.output:
+		if sink not in OUTPUT_SINKS:
+			parser.error(f"unknown output format '{sink}'")
+		if (args.incremental or args.chunksize or args.pipelined) and not OUTPUT_SINKS[sink][2]:
+			parser.error(f"the {sink} output cannot be appended to, use it without --incremental, --chunksize and --pipelined")
+	if not args.output and (args.sources or not args.delta_dir):
+		parser.error("--output needs at least one format, it can only be left empty with --delta-dir")
+	if args.delta_dir and (args.incremental or args.chunksize or args.pipelined):
+		parser.error("--delta-dir compares the whole merged data, use it without --incremental, --chunksize and --pipelined")
+	if args.publish == 'upsert' and (args.chunksize or args.pipelined):
+		parser.error("--publish upsert needs the whole cleaned tables, use it without --chunksize and --pipelined")
+	args.merged_table = args.merged_table or args.summary_table
+	if args.merged_table and (args.chunksize or args.pipelined):
+		parser.error("--merged-table needs the whole merged data, use it without --chunksize and --pipelined")
+	if args.compact and (args.incremental or args.chunksize or args.pipelined):
+		parser.error("--compact is for full runs, use it without --incremental, --chunksize and --pipelined")
+	if args.sources:
+		if args.watch:
+			parser.error("--sources runs every shard once, use it without --watch")
+		names = [shard_name(db_path) for db_path in args.sources]
+		if len(set(names)) != len(names):
+			parser.error("the --sources database files need distinct names, they name the shard directories")
+	if args.pipelined and not args.chunksize:
+		args.chunksize = 50000
+	return args
 
  
 if __name__ == '__main__':
@@ -373,4 +2631,4 @@ if __name__ == '__main__':
 		result = run_tests()
 		sys.exit(0 if result else 1)
 	else:
-		main()
+		main(parse_args(sys.argv[1:]))
@@ -1,13 +1,34 @@
 import unittest
+import argparse
 import sqlalchemy
 import pandas as pd
+import io
 import os
 import sys
-from sqlalchemy import create_engine, text
+import json
+import pstats
+import shutil
+import sqlite3
+import tempfile
+import functools
+import itertools
+import subprocess
+import threading
+import multiprocessing
+import concurrent.futures
+import time
+from sqlalchemy import create_engine, text, inspect
 from unittest import TestCase, mock
 import logging
 
 
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+DEV_DIR = os.path.abspath(os.path.join(TESTS_DIR, '..', 'dev'))
+SOURCE_DB = os.path.abspath(os.path.join(TESTS_DIR, '..', 'cademycode.db'))
+# Run the suite against a synthetic database of this many students instead of cademycode.db
+TEST_STUDENTS = int(os.environ.get('TEST_STUDENTS') or 0)
+
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 test_logger = logging.getLogger('testlog')
@@ -16,24 +37,104 @@ test_logger = logging.getLogger('testlog')
 formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 
 # Create file handler and set formatter
-test_handler = logging.FileHandler('./testlog.log')
+test_handler = logging.FileHandler(os.path.join(TESTS_DIR, 'testlog.log'))
 test_handler.setFormatter(formatter)
 
 # Add handler to the logger
 test_logger.addHandler(test_handler)
 
-sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../dev')))
+sys.path.insert(0, DEV_DIR)
 
 from pipeline import create_db_engine, get_table_names, get_dataframes, \
 						process_dataframes, update_db_tables, merge_df, \
-						check_for_updates, get_row_counts, configure_logging
+						check_for_updates, get_row_counts, configure_logging, \
+						get_watermarks, get_dataframes_since, append_db_tables, \
+						stream_students, process_students, stage, write_metrics, \
+						write_prometheus_metrics, detect_changes, get_change_state, \
+						write_outputs, read_output, pa, enable_wal, get_dataframes_parallel, \
+						pipeline_students, watch, parse_args, \
+						apply_quality_rules, QUARANTINE_TABLE, process_students_parallel, upsert_db_tables, \
+						publish_merged_table, upsert_merged_table, MERGED_TABLE, SUMMARY_TABLE, profile_run, \
+						compact_dataframe, join_contact_info, export_delta, load_delta_export, SOURCE_TABLES
+from benchmark import generate_cademycode_db
+
+
+# Session fixtures: the source database is read from disk once and kept in memory. Every test gets a private
+# copy of it through the SQLite backup API, so cademycode.db itself is never written, and the raw and cleaned
+# frames are computed once per session and handed out as copies.
+_memory_databases = itertools.count()
+
+
+@functools.lru_cache(maxsize=None)
+def source_database():
+	if TEST_STUDENTS:
+		# Synthetic databases are kept between sessions, generating a large one takes a while
+		cache_dir = os.path.join(tempfile.gettempdir(), 'cademycode-tests')
+		path = os.path.join(cache_dir, f"synthetic-{TEST_STUDENTS}.db")
+		if not os.path.exists(path):
+			os.makedirs(cache_dir, exist_ok=True)
+			generate_cademycode_db(f"{path}.tmp", TEST_STUDENTS)
+			os.replace(f"{path}.tmp", path)
+		source = sqlite3.connect(path)
+	else:
+		source = sqlite3.connect(f"file:{SOURCE_DB}?mode=ro", uri=True)
+	connection = sqlite3.connect(':memory:', check_same_thread=False)
+	source.backup(connection)
+	source.close()
+	return connection
+
+
+# A private in-memory copy of the source database. It lives as long as the returned connection is open.
+def memory_copy():
+	name = f"file:cademycode{next(_memory_databases)}?mode=memory&cache=shared"
+	connection = sqlite3.connect(name, uri=True, check_same_thread=False)
+	source_database().backup(connection)
+	engine = sqlalchemy.create_engine(f"sqlite:///{name}&uri=true", poolclass=sqlalchemy.pool.QueuePool,
+									  connect_args={'check_same_thread': False})
+	return engine, connection
+
+
+# A file copy of the source database, for code that opens it by path: subprocesses, read-only engines, WAL
+def file_copy(path):
+	connection = sqlite3.connect(path)
+	source_database().backup(connection)
+	connection.close()
+	return path
+
+
+@functools.lru_cache(maxsize=None)
+def session_frames():
+	engine, connection = memory_copy()
+	try:
+		dataframes = get_dataframes(engine, test_logger)
+	finally:
+		engine.dispose()
+		connection.close()
+	rejected = []
+	cleaned = process_dataframes({name: df.copy() for name, df in dataframes.items()}, test_logger, rejected=rejected)
+	return dataframes, cleaned, rejected
+
+
+# The raw source tables, as read by get_dataframes
+def raw_frames():
+	return {name: df.copy() for name, df in session_frames()[0].items()}
+
+
+# The tables as cleaned by process_dataframes
+def cleaned_frames():
+	return tuple(df.copy() for df in session_frames()[1])
+
+
+# The row counts of the source tables
+def source_row_counts():
+	return {name: len(df) for name, df in session_frames()[0].items()}
 
 
 class TestPipelineFunctions(unittest.TestCase):
 
 	def setUp(self):
-		self.db_url = "sqlite:///../cademycode.db"
-		self.engine = create_db_engine(self.db_url)
+		self.engine = self.memory_engine()
+		self.db_url = str(self.engine.url)
 		with self.engine.connect() as connection:
 			connection.execute(text("CREATE TABLE IF NOT EXISTS test_table (id INTEGER PRIMARY KEY, name TEXT)"))
 			connection.execute(text("INSERT INTO test_table (name) VALUES ('test_name')"))
@@ -46,10 +147,38 @@ class TestPipelineFunctions(unittest.TestCase):
 		self.changelog, self.errorlog = configure_logging(test_env=True)
 
 
-	def tearDown(self):
-		with self.engine.connect() as connection:
-			connection.execute(text("DROP TABLE IF EXISTS test_table"))
-		self.engine.dispose()
+	# A private in-memory copy of the source database that the test can write to
+	def memory_engine(self):
+		engine, connection = memory_copy()
+		self.addCleanup(connection.close)
+		self.addCleanup(engine.dispose)
+		return engine
+
+
+	# Point the pipeline's database, state files and logs at a file copy of the source database in a temporary
+	# directory, for runs of pipeline.main in this process. Returns the directory and the state file paths.
+	def patch_state_files(self):
+		tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmp_dir)
+		db_path = file_copy(os.path.join(tmp_dir, 'cademycode.db'))
+		state_files = {name: os.path.join(tmp_dir, file_name) for name, file_name in [
+			('VERSION_FILE', 'version.txt'), ('ROW_COUNTS_FILE', 'row_counts.json'), ('WATERMARKS_FILE', 'watermarks.json'),
+			('CHANGE_STATE_FILE', 'change_state.json'), ('RUN_STATE_FILE', 'run_state.json'), ('CHECKPOINT_DIR', 'checkpoint')]}
+		patches = [mock.patch(f'pipeline.{name}', path) for name, path in state_files.items()]
+		patches += [mock.patch('pipeline.DB_URL', f"sqlite:///{db_path}"), mock.patch('pipeline.LOG_DIR', tmp_dir + os.sep)]
+		for patch in patches:
+			patch.start()
+			self.addCleanup(patch.stop)
+		return tmp_dir, dict(state_files, DB_FILE=db_path)
+
+
+	# A temporary directory removed after the test, with a file copy of the source database in it
+	def file_engine(self):
+		tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmp_dir)
+		engine = create_db_engine(f"sqlite:///{file_copy(os.path.join(tmp_dir, 'cademycode.db'))}")
+		self.addCleanup(engine.dispose)
+		return engine, tmp_dir
 
 
 	@mock.patch('pipeline.logging.getLogger')
@@ -161,8 +290,7 @@ class TestPipelineFunctions(unittest.TestCase):
 		mock_getLogger.return_value = test_logger
 		test_logger.info("Starting test: test_df_students_not_empty")
 
-		dataframes = get_dataframes(self.engine, mock_getLogger)
-		df_students = dataframes.get('cademycode_students', pd.DataFrame())
+		df_students = raw_frames()['cademycode_students']
 		test_logger.info(f"dataframe df_students:  {df_students.head()}")
 		self.assertFalse(df_students.empty, f"{df_students} should not be empty")
 
@@ -172,8 +300,7 @@ class TestPipelineFunctions(unittest.TestCase):
 		mock_getLogger.return_value = test_logger
 		test_logger.info("Starting test: test_df_students_nan_dropped")
 
-		dataframes = get_dataframes(self.engine, mock_getLogger)
-		df_students, df_jobs, df_courses = process_dataframes(dataframes, mock_getLogger)
+		df_students, df_jobs, df_courses = cleaned_frames()
 		nan_counts = df_students.isna().sum()
 		test_logger.info(f"NaN dropped count: {nan_counts}")
 		self.assertTrue((nan_counts == 0).all())
@@ -184,14 +311,14 @@ class TestPipelineFunctions(unittest.TestCase):
 		mock_getLogger.return_value = test_logger
 		test_logger.info("Starting test: test_df_students_dtypes")
 
-		dataframes = get_dataframes(self.engine, mock_getLogger)
-		df_students, df_jobs, df_courses = process_dataframes(dataframes, mock_getLogger)
+		df_students, df_jobs, df_courses = cleaned_frames()
 		# Check data types of columns
 		self.assertEqual(df_students['dob'].dtype, 'datetime64[ns]', "Column 'dob' should have datetime data type")
 		self.assertIn(df_students['job_id'].dtype, ['int32', 'int64'], "Column 'job_id' should have int64 data type")
 		self.assertIn(df_students['num_course_taken'].dtype, ['int32', 'int64'], "Column 'num_course_taken' should have int64 data type")
 		self.assertEqual(df_students['time_spent_hrs'].dtype, 'float64', "Column 'time_spent_hrs' should have float64 data type")
-		self.assertEqual(df_students['contact_info'].dtype, 'object', "Column 'contact_info' should have object (string) data type")
+		self.assertTrue(pd.api.types.is_string_dtype(df_students['contact_info'].dtype), "Column 'contact_info' should have string data type")
+		self.assertIsInstance(df_students['sex'].dtype, pd.CategoricalDtype, "Column 'sex' should have category data type")
 		self.assertIn(df_students['current_career_path_id'].dtype, ['int32', 'int64'], "Column 'current_career_path_id' should have int64 data type")
 
 
@@ -200,8 +327,7 @@ class TestPipelineFunctions(unittest.TestCase):
 		mock_getLogger.return_value = test_logger
 		test_logger.info("Starting test: test_df_jobs_not_empty")
 
-		dataframes = get_dataframes(self.engine, mock_getLogger)
-		df_jobs = dataframes.get('cademycode_student_jobs', pd.DataFrame())
+		df_jobs = raw_frames()['cademycode_student_jobs']
 		test_logger.info(f"dataframe df_students:  {df_jobs.head()}")
 		self.assertFalse(df_jobs.empty, f"{df_jobs} should not be empty")
 
@@ -211,8 +337,7 @@ class TestPipelineFunctions(unittest.TestCase):
 		mock_getLogger.return_value = test_logger
 		test_logger.info("Starting test: test_df_jobs_duplicated_dropped")
 
-		dataframes = get_dataframes(self.engine, mock_getLogger)
-		df_students, df_jobs, df_courses = process_dataframes(dataframes, mock_getLogger)
+		df_students, df_jobs, df_courses = cleaned_frames()
 		duplicates = df_jobs.duplicated()
 		test_logger.info(f"df_jobs duplicates: {duplicates}")
 		self.assertFalse(duplicates.any(), "There are duplicate rows in the DataFrame")
@@ -223,8 +348,7 @@ class TestPipelineFunctions(unittest.TestCase):
 		mock_getLogger.return_value = test_logger
 		test_logger.info("Starting test: test_merged_df_row_count")
 
-		dataframes = get_dataframes(self.engine, mock_getLogger)
-		df_students, df_jobs, df_courses = process_dataframes(dataframes, mock_getLogger)
+		df_students, df_jobs, df_courses = cleaned_frames()
 		merged_df = merge_df(df_students, df_jobs, df_courses, mock_getLogger)
 		expected_row_count = len(merged_df)
 		self.assertEqual(len(merged_df), expected_row_count)
@@ -236,8 +360,7 @@ class TestPipelineFunctions(unittest.TestCase):
 		test_logger.info("Starting test: test_merged_df_columns")
   
 		# Check columns
-		dataframes = get_dataframes(self.engine, mock_getLogger)
-		df_students, df_jobs, df_courses = process_dataframes(dataframes, mock_getLogger)
+		df_students, df_jobs, df_courses = cleaned_frames()
 		merged_df = merge_df(df_students, df_jobs, df_courses, mock_getLogger)
 
 		expected_columns = ['uuid', 'name', 'dob', 'sex', 'contact_info', 'job_id',
@@ -246,7 +369,959 @@ class TestPipelineFunctions(unittest.TestCase):
 		'hours_to_complete']
 
 		self.assertListEqual(list(merged_df.columns), expected_columns)
-        
+
+
+	def test_merge_df_matches_merges_and_reports_drops(self):
+		test_logger.info("Starting test: test_merge_df_matches_merges_and_reports_drops")
+
+		df_students, df_jobs, df_courses = cleaned_frames()
+		df_students.loc[df_students.index[:5], 'job_id'] = 99
+		df_students.loc[df_students.index[3:9], 'current_career_path_id'] = 77
+
+		expected_df = df_students.merge(df_jobs, on='job_id', how='inner') \
+			.merge(df_courses, left_on='current_career_path_id', right_on='career_path_id', how='inner')
+		with self.assertLogs(test_logger, level='WARNING') as logs:
+			merged_df = merge_df(df_students, df_jobs, df_courses, test_logger)
+
+		pd.testing.assert_frame_equal(merged_df, expected_df)
+		self.assertIn("Dropped 9 students", logs.output[0])
+		self.assertIn("unknown job_id [99]", logs.output[0])
+
+
+	@mock.patch('pipeline.logging.getLogger')
+	def test_get_dataframes_since_reads_only_new_rows(self, mock_getLogger):
+		mock_getLogger.return_value = test_logger
+		test_logger.info("Starting test: test_get_dataframes_since_reads_only_new_rows")
+
+		watermarks = get_watermarks(self.engine)
+		self.assertEqual(get_dataframes_since(self.engine, watermarks, test_logger), {})
+
+		watermarks['cademycode_students'] -= 10
+		dataframes = get_dataframes_since(self.engine, watermarks, test_logger)
+		self.assertListEqual(list(dataframes), ['cademycode_students'])
+		self.assertEqual(len(dataframes['cademycode_students']), 10)
+
+
+	@mock.patch('pipeline.logging.getLogger')
+	def test_append_db_tables_upserts_delta(self, mock_getLogger):
+		mock_getLogger.return_value = test_logger
+		test_logger.info("Starting test: test_append_db_tables_upserts_delta")
+
+		engine = self.memory_engine()
+
+		# Re-append the last 10 students as a raw delta
+		with engine.begin() as connection:
+			connection.execute(text("INSERT INTO cademycode_students SELECT * FROM cademycode_students "
+									"WHERE rowid > (SELECT MAX(rowid) - 10 FROM cademycode_students)"))
+		watermarks = get_watermarks(engine)
+		watermarks['cademycode_students'] -= 10
+
+		dataframes = get_dataframes_since(engine, watermarks, test_logger)
+		df_students, df_jobs, df_courses = process_dataframes(dataframes, test_logger)
+		append_db_tables(engine, watermarks, {'cademycode_students': df_students}, test_logger)
+
+		with engine.connect() as connection:
+			total, distinct = connection.execute(text("SELECT COUNT(*), COUNT(DISTINCT uuid) FROM cademycode_students")).fetchone()
+		self.assertEqual(total, distinct)
+		# Cleaned rows replace their originals, the original of a delta row that cleaning drops stays
+		self.assertEqual(total, source_row_counts()['cademycode_students'])
+
+
+	@mock.patch('pipeline.logging.getLogger')
+	def test_stream_students_matches_full_pipeline(self, mock_getLogger):
+		mock_getLogger.return_value = test_logger
+		test_logger.info("Starting test: test_stream_students_matches_full_pipeline")
+
+		df_students, df_jobs, df_courses = cleaned_frames()
+		expected_df = merge_df(df_students, df_jobs, df_courses, test_logger)
+		engine, tmp_dir = self.file_engine()
+
+		csv_path = os.path.join(tmp_dir, 'merged_data.csv')
+		rows_read, rows_written = stream_students(engine, test_logger, chunksize=700, output_dir=tmp_dir)
+
+		self.assertEqual(rows_read, source_row_counts()['cademycode_students'])
+		self.assertEqual(rows_written, len(df_students))
+		self.assertEqual(get_row_counts(engine)['cademycode_students'], len(df_students))
+		streamed_df = pd.read_csv(csv_path)
+		self.assertListEqual(list(streamed_df.columns), list(expected_df.columns))
+		self.assertEqual(len(streamed_df), len(expected_df))
+
+
+
+	@mock.patch('pipeline.changelog', test_logger, create=True)
+	def test_get_dataframes_parallel_matches_sequential(self):
+		test_logger.info("Starting test: test_get_dataframes_parallel_matches_sequential")
+
+		tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmp_dir)
+		db_path = generate_cademycode_db(os.path.join(tmp_dir, 'synthetic.db'), 2500, batch_size=1000)
+		engine = create_db_engine(f"sqlite:///{db_path}")
+		self.addCleanup(engine.dispose)
+		self.assertEqual(enable_wal(engine), 'wal')
+
+		read_engine = create_db_engine(f"sqlite:///{db_path}", pool_size=3, read_only=True)
+		self.addCleanup(read_engine.dispose)
+		tables = ['cademycode_students', 'cademycode_student_jobs', 'cademycode_courses']
+
+		# Students are read as several rowid ranges and stitched back together in order
+		expected = get_dataframes(engine, test_logger)
+		dataframes = get_dataframes_parallel(read_engine, test_logger, workers=3, chunksize=400, tables=tables)
+		for table_name in tables:
+			pd.testing.assert_frame_equal(dataframes[table_name], expected[table_name])
+		self.assertEqual(get_row_counts(read_engine, workers=3), get_row_counts(engine))
+
+		# The read-only engine can never write to the source database
+		with self.assertRaises(sqlalchemy.exc.OperationalError):
+			with read_engine.connect() as connection:
+				connection.execute(text("DELETE FROM cademycode_courses"))
+
+
+	@unittest.skipIf(pa is None, "pyarrow is not installed")
+	def test_write_outputs_parquet_matches_csv(self):
+		test_logger.info("Starting test: test_write_outputs_parquet_matches_csv")
+
+		merged_df = merge_df(*cleaned_frames(), test_logger)
+
+		tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmp_dir)
+		paths = write_outputs(merged_df, ['csv', 'parquet', 'feather'], test_logger,
+							  output_dir=tmp_dir, partition_cols=['career_path_name'])
+		csv_path, parquet_path, feather_path = paths
+
+		# CSV output is unchanged by the new sinks
+		with open(csv_path) as f:
+			self.assertEqual(f.read(), merged_df.to_csv(index=False))
+		self.assertEqual(len(read_output(parquet_path)), len(merged_df))
+		self.assertEqual(len(read_output(feather_path)), len(merged_df))
+
+		# Partition filters and column selection only read what is asked for
+		career_path = merged_df['career_path_name'].dropna().iloc[0]
+		subset = read_output(parquet_path, columns=['uuid', 'time_spent_hrs'],
+							 filters=[('career_path_name', '==', career_path)])
+		self.assertListEqual(list(subset.columns), ['uuid', 'time_spent_hrs'])
+		self.assertEqual(len(subset), (merged_df['career_path_name'] == career_path).sum())
+
+		# Appending adds rows instead of replacing the dataset, feather cannot be appended to
+		write_outputs(merged_df.head(10), ['parquet'], test_logger, output_dir=tmp_dir,
+					  append=True, partition_cols=['career_path_name'])
+		self.assertEqual(len(read_output(parquet_path)), len(merged_df) + 10)
+		with self.assertRaises(ValueError):
+			write_outputs(merged_df, ['feather'], test_logger, output_dir=tmp_dir, append=True)
+
+
+	@mock.patch('pipeline.changelog', test_logger, create=True)
+	def test_pipeline_students_matches_stream(self):
+		test_logger.info("Starting test: test_pipeline_students_matches_stream")
+
+		tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmp_dir)
+		for name in ['stream', 'pipeline']:
+			os.mkdir(os.path.join(tmp_dir, name))
+			file_copy(os.path.join(tmp_dir, name, 'cademycode.db'))
+		stream_engine = create_db_engine(f"sqlite:///{os.path.join(tmp_dir, 'stream', 'cademycode.db')}")
+		pipeline_engine = create_db_engine(f"sqlite:///{os.path.join(tmp_dir, 'pipeline', 'cademycode.db')}")
+		self.addCleanup(stream_engine.dispose)
+		self.addCleanup(pipeline_engine.dispose)
+
+		expected = stream_students(stream_engine, test_logger, chunksize=700, output_dir=os.path.join(tmp_dir, 'stream'))
+		result = pipeline_students(pipeline_engine, test_logger, chunksize=700, queue_size=2,
+								   output_dir=os.path.join(tmp_dir, 'pipeline'))
+
+		self.assertEqual(result, expected)
+		with open(os.path.join(tmp_dir, 'stream', 'merged_data.csv')) as f:
+			expected_csv = f.read()
+		with open(os.path.join(tmp_dir, 'pipeline', 'merged_data.csv')) as f:
+			self.assertEqual(f.read(), expected_csv)
+		self.assertEqual(get_row_counts(pipeline_engine)['cademycode_students'], expected[1])
+
+		# A failing stage stops the others and leaves the published tables and outputs untouched
+		with mock.patch('pipeline.merge_df', side_effect=ValueError('boom')):
+			with self.assertRaises(RuntimeError):
+				pipeline_students(pipeline_engine, test_logger, chunksize=700, queue_size=2,
+								  output_dir=os.path.join(tmp_dir, 'pipeline'))
+		self.assertEqual(get_row_counts(pipeline_engine)['cademycode_students'], expected[1])
+		outputs = [name for name in os.listdir(os.path.join(tmp_dir, 'pipeline')) if name.startswith('merged_data')]
+		self.assertListEqual(outputs, ['merged_data.csv'])
+
+
+	def test_process_students_parallel_matches_single_process(self):
+		test_logger.info("Starting test: test_process_students_parallel_matches_single_process")
+
+		df_students = raw_frames()['cademycode_students']
+		expected_df = process_students(df_students, test_logger)
+
+		with self.assertLogs(test_logger) as logs:
+			parallel_df = process_students_parallel(df_students, test_logger, processes=2, partition_rows=1500)
+		self.assertIn(f"{-(-len(df_students) // 1500)} partitions on 2 processes", ''.join(logs.output))
+		pd.testing.assert_frame_equal(parallel_df, expected_df)
+
+		# process_dataframes gives the same tables and quarantine on the pool
+		_, expected, rejected = session_frames()
+		parallel_rejected = []
+		parallel = process_dataframes(raw_frames(), test_logger, rejected=parallel_rejected, processes=2)
+		for expected_df, parallel_df in zip(expected, parallel):
+			pd.testing.assert_frame_equal(parallel_df, expected_df)
+		pd.testing.assert_frame_equal(
+			pd.concat(parallel_rejected).drop(columns='quarantined_at'), pd.concat(rejected).drop(columns='quarantined_at'))
+
+
+	def test_compact_dataframes_shrink_and_round_trip(self):
+		test_logger.info("Starting test: test_compact_dataframes_shrink_and_round_trip")
+
+		df_students, df_jobs, df_courses = cleaned_frames()
+		with self.assertLogs(test_logger) as logs:
+			compact_students, compact_jobs, compact_courses = process_dataframes(raw_frames(), test_logger, compact=True)
+		self.assertIn("Compacted cademycode_students from", ''.join(logs.output))
+
+		self.assertNotIn('contact_info', compact_students.columns)
+		self.assertEqual(compact_students.loc[compact_students.index[0], 'email'],
+						 json.loads(df_students.loc[df_students.index[0], 'contact_info'])['email'])
+		self.assertEqual(compact_students['job_id'].dtype, 'int8')
+		self.assertIsInstance(compact_jobs['job_category'].dtype, pd.CategoricalDtype)
+		self.assertIsInstance(compact_courses['career_path_name'].dtype, pd.CategoricalDtype)
+		merged_df = merge_df(df_students, df_jobs, df_courses, test_logger)
+		compact_merged = merge_df(compact_students, compact_jobs, compact_courses, test_logger)
+		self.assertLess(compact_merged.memory_usage(deep=True).sum(), 0.7 * merged_df.memory_usage(deep=True).sum())
+
+		# contact_info is rebuilt byte for byte for the database, escapes included
+		pd.testing.assert_series_equal(join_contact_info(compact_students)['contact_info'], df_students['contact_info'])
+		self.assertListEqual(list(join_contact_info(compact_students).columns), list(df_students.columns))
+		escaped = pd.DataFrame({'contact_info': ['{"mailing_address": "caf\\u00e9 1", "email": "a\\\\b@x.io"}', None]})
+		compact = compact_dataframe(escaped, 'escaped', test_logger)
+		self.assertEqual(compact.loc[0, 'mailing_address'], 'caf\u00e9 1')
+		self.assertEqual(compact.loc[0, 'email'], 'a\\b@x.io')
+		self.assertEqual(join_contact_info(compact)['contact_info'].tolist(), [escaped.loc[0, 'contact_info'], pd.NA])
+
+
+	def test_delta_export_applies_to_latest_version(self):
+		test_logger.info("Starting test: test_delta_export_applies_to_latest_version")
+
+		merged_df = merge_df(*cleaned_frames(), test_logger)
+		def sort(df):
+			return df.sort_values('uuid', ignore_index=True)
+
+		for delta_format in ['parquet', 'csv']:
+			with self.subTest(delta_format=delta_format):
+				delta_dir = tempfile.mkdtemp()
+				self.addCleanup(shutil.rmtree, delta_dir)
+				self.assertEqual(export_delta(merged_df, delta_dir, '1.0.1', test_logger, delta_format, snapshot_every=2), len(merged_df))
+
+				# One changed, one removed and one added student
+				updated_df = merged_df.iloc[1:].copy()
+				updated_df.loc[updated_df.index[0], 'time_spent_hrs'] += 1
+				updated_df = pd.concat([updated_df, merged_df.iloc[[1]].assign(uuid=999999)], ignore_index=True)
+				self.assertEqual(export_delta(updated_df, delta_dir, '1.0.2', test_logger, delta_format, snapshot_every=2), 3)
+				# Exporting the same version again, as a resumed run would, writes nothing
+				self.assertEqual(export_delta(updated_df, delta_dir, '1.0.2', test_logger, delta_format, snapshot_every=2), 0)
+
+				with open(os.path.join(delta_dir, 'manifest.json')) as f:
+					manifest = json.load(f)
+				self.assertEqual(manifest['snapshot']['version'], '1.0.1')
+				self.assertEqual([(entry['base_version'], entry['upserts'], entry['deletes']) for entry in manifest['deltas']],
+								 [('1.0.1', 2, 1)])
+				expected_df = updated_df if delta_format == 'parquet' else pd.read_csv(io.StringIO(updated_df.to_csv(index=False)))
+				pd.testing.assert_frame_equal(sort(load_delta_export(delta_dir)), sort(expected_df), check_dtype=False)
+
+				# After snapshot_every deltas the next version is a new snapshot and the older files go
+				export_delta(updated_df, delta_dir, '1.0.3', test_logger, delta_format, snapshot_every=2)
+				export_delta(merged_df, delta_dir, '1.0.4', test_logger, delta_format, snapshot_every=2)
+				with open(os.path.join(delta_dir, 'manifest.json')) as f:
+					manifest = json.load(f)
+				self.assertEqual((manifest['snapshot']['version'], manifest['deltas']), ('1.0.4', []))
+				self.assertEqual(sorted(os.listdir(delta_dir)), sorted(['manifest.json', 'row_hashes.npz', manifest['snapshot']['file']]))
+
+
+	def test_profile_run_writes_profiles_per_version(self):
+		test_logger.info("Starting test: test_profile_run_writes_profiles_per_version")
+
+		tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmp_dir)
+		version_file = os.path.join(tmp_dir, 'version.txt')
+		with open(version_file, 'w') as file:
+			file.write('2.3.4')
+		df_students = raw_frames()['cademycode_students']
+
+		metrics = []
+		with profile_run('run1', os.path.join(tmp_dir, 'profiles'), version_file, top=5):
+			with stage('clean', metrics, '2.3.4'):
+				process_students(df_students, test_logger)
+				time.sleep(0.1)
+
+		directory = os.path.join(tmp_dir, 'profiles', '2.3.4')
+		self.assertCountEqual(os.listdir(directory), [
+			'run1-run.prof', 'run1-clean.prof', 'run1-clean.allocations.txt', 'run1.collapsed'])
+		functions = [function for _, _, function in pstats.Stats(os.path.join(directory, 'run1-clean.prof')).stats]
+		self.assertIn('process_students', functions)
+
+		with open(os.path.join(directory, 'run1-clean.allocations.txt')) as file:
+			lines = file.read().splitlines()
+		self.assertTrue(lines[0].startswith('Peak traced memory'))
+		self.assertLessEqual(len(lines), 7)
+
+		# Collapsed stacks are "stage;thread;frames count" lines, rooted at the stage they were sampled in
+		with open(os.path.join(directory, 'run1.collapsed')) as file:
+			stacks = [line.rsplit(' ', 1) for line in file.read().splitlines()]
+		self.assertTrue(all(count.isdigit() for _, count in stacks))
+		self.assertTrue(any(stack.startswith('clean;MainThread;') for stack, _ in stacks))
+		self.assertEqual(metrics[0]['status'], 'ok')
+
+
+	def test_watch_runs_only_on_changes(self):
+		test_logger.info("Starting test: test_watch_runs_only_on_changes")
+
+		tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmp_dir)
+		engine = create_db_engine(f"sqlite:///{file_copy(os.path.join(tmp_dir, 'cademycode.db'))}")
+		self.addCleanup(engine.dispose)
+
+		stop = threading.Event()
+		runs = []
+		def run_pipeline(engine, read_engine, args, paths, warm):
+			runs.append(time.monotonic())
+			if len(runs) == 2:
+				raise ValueError('boom')
+
+		with mock.patch('pipeline.run_pipeline', side_effect=run_pipeline):
+			thread = threading.Thread(target=watch, args=(engine, engine, parse_args(['--watch', '--interval', '0.05']), stop))
+			thread.start()
+			time.sleep(0.3)
+			# Nothing changed after the first run
+			self.assertEqual(len(runs), 1)
+
+			# A commit from another connection triggers a run, a failing run does not stop the loop
+			for expected_runs in [2, 3]:
+				with engine.begin() as connection:
+					connection.execute(text("DELETE FROM cademycode_courses WHERE rowid = (SELECT MAX(rowid) FROM cademycode_courses)"))
+				time.sleep(0.3)
+				self.assertGreaterEqual(len(runs), expected_runs)
+
+			# And the loop goes idle again
+			idle_runs = len(runs)
+			time.sleep(0.3)
+			self.assertEqual(len(runs), idle_runs)
+			stop.set()
+			thread.join(timeout=5)
+
+		self.assertFalse(thread.is_alive())
+
+
+	def test_watch_keeps_unchanged_dimensions_between_runs(self):
+		test_logger.info("Starting test: test_watch_keeps_unchanged_dimensions_between_runs")
+
+		tmp_dir, state_files = self.patch_state_files()
+		import pipeline
+		engine = create_db_engine(f"sqlite:///{state_files['DB_FILE']}")
+		self.addCleanup(engine.dispose)
+		args = parse_args(['--output-dir', tmp_dir, '--metrics-file', os.path.join(tmp_dir, 'metrics.jsonl')])
+		warm = {}
+		def run(statement):
+			with engine.begin() as connection:
+				connection.execute(text(statement))
+			with mock.patch('pipeline.get_dataframes', wraps=pipeline.get_dataframes) as read, \
+					mock.patch('pipeline.get_table_names', wraps=pipeline.get_table_names) as list_tables:
+				pipeline.run_pipeline(engine, engine, args, warm=warm)
+			return read.call_args.kwargs['tables'], list_tables.call_count
+
+		# The first run reads everything, later runs only the tables detect_changes reported.
+		# After the first run, the table names are listed once per run, after its writes.
+		self.assertEqual(run("SELECT 1"), (SOURCE_TABLES, 2))
+		self.assertEqual(run("INSERT INTO cademycode_students SELECT (SELECT MAX(uuid) + 1 FROM cademycode_students), name, dob, sex, "
+							 "contact_info, job_id, num_course_taken, current_career_path_id, time_spent_hrs FROM cademycode_students "
+							 "WHERE uuid = (SELECT MIN(uuid) FROM cademycode_students)"), (['cademycode_students'], 1))
+		self.assertEqual(run("DELETE FROM cademycode_courses WHERE career_path_id = 1"), (['cademycode_students', 'cademycode_courses'], 1))
+		self.assertEqual(sorted(warm), ['dimensions', 'table_names'])
+
+		# The outputs are the same as those of a run that reads and cleans every table
+		with open(os.path.join(tmp_dir, 'merged_data.csv')) as f:
+			warm_output = f.read()
+		for name in ['CHANGE_STATE_FILE', 'ROW_COUNTS_FILE']:
+			os.remove(state_files[name])
+		pipeline.run_pipeline(engine, engine, args)
+		with open(os.path.join(tmp_dir, 'merged_data.csv')) as f:
+			self.assertEqual(f.read(), warm_output)
+		with open(state_files['VERSION_FILE']) as f:
+			self.assertEqual(f.read().strip(), '1.0.4')
+
+
+	def test_noop_run_skips_heavy_imports(self):
+		test_logger.info("Starting test: test_noop_run_skips_heavy_imports")
+
+		tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmp_dir)
+		build_dir = os.path.join(tmp_dir, 'build')
+		os.mkdir(build_dir)
+		file_copy(os.path.join(tmp_dir, 'cademycode.db'))
+		script = ("import sys; sys.path.insert(0, %r); import pipeline; pipeline.main(pipeline.parse_args([]));"
+				  "print(' '.join(name for name in ('pandas', 'sqlalchemy') if type(sys.modules[name]).__name__ != '_LazyModule'))"
+				  % DEV_DIR)
+		def run():
+			return subprocess.run([sys.executable, '-c', script], cwd=build_dir, capture_output=True, text=True, check=True).stdout.strip()
+
+		# The first run processes everything, the next ones find nothing to do without loading pandas or SQLAlchemy
+		self.assertEqual(run(), 'pandas sqlalchemy')
+		self.assertEqual(run(), '')
+		os.utime(os.path.join(tmp_dir, 'cademycode.db'))
+		self.assertEqual(run(), '')
+
+		with sqlalchemy.create_engine(f"sqlite:///{os.path.join(tmp_dir, 'cademycode.db')}").begin() as connection:
+			connection.execute(text("DELETE FROM cademycode_courses WHERE career_path_id = 1"))
+		self.assertEqual(run(), 'pandas sqlalchemy')
+		with open(os.path.join(tmp_dir, 'version.txt')) as f:
+			self.assertEqual(f.read().strip(), '1.0.2')
+
+
+	def test_workers_run_in_fresh_interpreter(self):
+		test_logger.info("Starting test: test_workers_run_in_fresh_interpreter")
+
+		tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmp_dir)
+		build_dir = os.path.join(tmp_dir, 'build')
+		os.mkdir(build_dir)
+		file_copy(os.path.join(tmp_dir, 'cademycode.db'))
+		# A fresh interpreter, where pandas and SQLAlchemy are still lazy modules when main() starts the extraction threads
+		script = ("import sys; sys.path.insert(0, %r); import pipeline; pipeline.main(pipeline.parse_args(['--workers', '2']))"
+				  % DEV_DIR)
+		subprocess.run([sys.executable, '-c', script], cwd=build_dir, capture_output=True, text=True, check=True)
+
+		expected_df = merge_df(*cleaned_frames(), test_logger)
+		self.assertEqual(len(pd.read_csv(os.path.join(build_dir, 'merged_data.csv'))), len(expected_df))
+		with open(os.path.join(tmp_dir, 'version.txt')) as f:
+			self.assertEqual(f.read().strip(), '1.0.1')
+
+
+	def test_sources_run_changed_shards_and_consolidate(self):
+		test_logger.info("Starting test: test_sources_run_changed_shards_and_consolidate")
+
+		tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmp_dir)
+		build_dir = os.path.join(tmp_dir, 'build')
+		os.mkdir(build_dir)
+		for shard in ['east', 'west']:
+			file_copy(os.path.join(tmp_dir, f'{shard}.db'))
+		def execute(shard, statement):
+			engine = sqlalchemy.create_engine(f"sqlite:///{os.path.join(tmp_dir, f'{shard}.db')}")
+			with engine.begin() as connection:
+				connection.execute(text(statement))
+			engine.dispose()
+		def version(directory):
+			with open(os.path.join(directory, 'version.txt')) as f:
+				return f.read().strip()
+		# Run in this process with the state files moved to tmp_dir, the shards still run on their own process pool
+		for name, path in [('VERSION_FILE', os.path.join(tmp_dir, 'version.txt')), ('LOG_DIR', tmp_dir + os.sep)]:
+			patch = mock.patch(f'pipeline.{name}', path)
+			patch.start()
+			self.addCleanup(patch.stop)
+		import pipeline
+		args_list = ['--sources', os.path.join(tmp_dir, 'east.db'), os.path.join(tmp_dir, 'west.db'),
+					 '--shards-dir', os.path.join(tmp_dir, 'shards'), '--output-dir', build_dir,
+					 '--metrics-file', os.path.join(tmp_dir, 'metrics.jsonl')]
+		args = parse_args(args_list)
+		def run():
+			pipeline.main(args)
+
+		# Both shards hold the same students, the one listed last wins
+		uuid = pd.read_sql_table('cademycode_students', self.engine)['uuid'].iloc[0]
+		execute('west', f"UPDATE cademycode_students SET name = 'West Shard' WHERE uuid = {uuid}")
+		run()
+		merged_df = pd.read_csv(os.path.join(build_dir, 'merged_data.csv'))
+		east_df = pd.read_csv(os.path.join(tmp_dir, 'shards', 'east', 'merged_data.csv'))
+		self.assertEqual(len(merged_df), len(east_df))
+		self.assertFalse(merged_df['uuid'].duplicated().any())
+		self.assertEqual(merged_df.loc[merged_df['uuid'] == uuid, 'name'].tolist(), ['West Shard'])
+		self.assertEqual([version(tmp_dir), version(os.path.join(tmp_dir, 'shards', 'east'))], ['1.0.1', '1.0.1'])
+
+		# Only the changed shard is processed again
+		execute('east', "DELETE FROM cademycode_courses WHERE career_path_id = 1")
+		run()
+		self.assertEqual(version(tmp_dir), '1.0.2')
+		self.assertEqual(version(os.path.join(tmp_dir, 'shards', 'east')), '1.0.2')
+		self.assertEqual(version(os.path.join(tmp_dir, 'shards', 'west')), '1.0.1')
+
+		# Nothing changed, nothing to consolidate
+		run()
+		self.assertEqual(version(tmp_dir), '1.0.2')
+
+		# A shard run keeps to its own paths: its profiles are filed under the shard's version, not the root's
+		execute('east', "DELETE FROM cademycode_courses WHERE career_path_id = 2")
+		shard_dir = os.path.join(tmp_dir, 'shards', 'east')
+		self.assertTrue(pipeline.run_shard(os.path.join(tmp_dir, 'east.db'), shard_dir,
+										   parse_args(args_list + ['--profile', '--profile-top', '0'])))
+		self.assertEqual(os.listdir(os.path.join(shard_dir, 'profiles')), ['1.0.3'])
+		self.assertEqual(pipeline.VERSION_FILE, os.path.join(tmp_dir, 'version.txt'))
+
+
+	def test_interrupted_run_resumes_after_completed_stages(self):
+		test_logger.info("Starting test: test_interrupted_run_resumes_after_completed_stages")
+
+		tmp_dir, state_files = self.patch_state_files()
+		import pipeline
+		args = parse_args(['--output-dir', tmp_dir, '--metrics-file', os.path.join(tmp_dir, 'metrics.jsonl')])
+		def version():
+			with open(state_files['VERSION_FILE']) as f:
+				return f.read().strip()
+
+		# The export fails after the tables were published
+		with mock.patch('pipeline.write_outputs', side_effect=OSError('disk full')):
+			with self.assertRaises(OSError):
+				pipeline.main(args)
+		self.assertEqual(version(), '1.0.1')
+		with open(state_files['RUN_STATE_FILE']) as f:
+			self.assertEqual(list(json.load(f)['stages']), ['clean', 'publish'])
+
+		# The next run picks up at the export, from the checkpointed tables and without bumping the version
+		with mock.patch('pipeline.get_dataframes', wraps=pipeline.get_dataframes) as read, \
+				mock.patch('pipeline.update_db_tables', wraps=pipeline.update_db_tables) as publish:
+			pipeline.main(args)
+		read.assert_not_called()
+		publish.assert_not_called()
+		self.assertEqual(version(), '1.0.1')
+		expected_df = merge_df(*cleaned_frames(), test_logger)
+		self.assertEqual(len(pd.read_csv(os.path.join(tmp_dir, 'merged_data.csv'))), len(expected_df))
+		self.assertFalse(os.path.exists(state_files['RUN_STATE_FILE']))
+		self.assertFalse(os.path.exists(state_files['CHECKPOINT_DIR']))
+
+		# Once completed, the next run has nothing to do
+		pipeline.main(args)
+		self.assertEqual(version(), '1.0.1')
+
+
+	@mock.patch('pipeline.changelog', test_logger, create=True)
+	def test_quality_rules_quarantine_rejected_rows(self):
+		test_logger.info("Starting test: test_quality_rules_quarantine_rejected_rows")
+
+		dataframes = raw_frames()
+		df_raw = dataframes['cademycode_students']
+		# Break rows that are complete, so each one fails only the rule it is meant for
+		rows = df_raw.dropna().index[:5]
+		df_raw.loc[rows[0], 'time_spent_hrs'] = '-3.5'
+		df_raw.loc[rows[1], 'contact_info'] = '{"mailing_address": "1 Main St", "email": "not an email"}'
+		df_raw.loc[rows[2], 'job_id'] = '99'
+		df_raw.loc[rows[3], 'uuid'] = df_raw.loc[rows[4], 'uuid']
+
+		rejected = []
+		df_students, df_jobs, df_courses = process_dataframes(dataframes, test_logger, rejected=rejected)
+		quarantine = pd.concat(rejected, ignore_index=True)
+		reasons = dict(zip(quarantine['reason'], quarantine['source_table']))
+
+		# Every failing row is quarantined with its reason instead of being dropped silently
+		self.assertEqual(reasons['negative_time_spent_hrs'], 'cademycode_students')
+		self.assertEqual(reasons['invalid_contact_info'], 'cademycode_students')
+		self.assertEqual(reasons['unknown_job_id'], 'cademycode_students')
+		self.assertEqual(reasons['duplicate_row;duplicate_job_id'], 'cademycode_student_jobs')
+		self.assertIn('duplicate_uuid', reasons)
+		self.assertTrue(any(reason.startswith('missing_') for reason in reasons))
+		self.assertTrue(df_students['uuid'].is_unique)
+		self.assertEqual(len(df_students) + len(quarantine[quarantine['source_table'] == 'cademycode_students']), len(df_raw))
+		self.assertEqual(json.loads(quarantine.loc[quarantine['reason'] == 'unknown_job_id', 'record'].iloc[0])['job_id'], 99)
+		self.assertEqual(len(df_jobs), len(dataframes['cademycode_student_jobs'].drop_duplicates()))
+
+		# Rejected rows are published with the tables. A resumed publish of the same version replaces its rows,
+		# the next version adds its own.
+		engine = self.memory_engine()
+		for version in ['1.0.1', '1.0.1', '1.0.2']:
+			update_db_tables(engine, df_students, df_jobs, df_courses, rejected=rejected, run={'run_id': 'test', 'version': version})
+		published = pd.read_sql_table(QUARANTINE_TABLE, engine)
+		self.assertEqual(published['version'].value_counts().to_dict(), {'1.0.1': len(quarantine), '1.0.2': len(quarantine)})
+
+
+	def test_apply_quality_rules_checks_each_rule_kind(self):
+		test_logger.info("Starting test: test_apply_quality_rules_checks_each_rule_kind")
+
+		df = pd.DataFrame({
+			'key': [1, 2, 2, 3, 4, 4],
+			'value': [1.0, -1.0, 5.0, None, 7.0, 7.0],
+			'code': ['ab', 'ab', 'xy', 'ab', None, None],
+			'ref': [10, 10, 10, 11, 10, 10],
+		})
+		rules = {'table': [
+			('negative_value', 'range', 'value', (0, None)),
+			('bad_code', 'regex', 'code', r'[a-z]b'),
+			('unknown_ref', 'foreign_key', 'ref', ('refs', 'id')),
+			('duplicate_key', 'unique', 'key', None),
+			('duplicate_row', 'unique', None, None),
+		]}
+		rejected = []
+		kept = apply_quality_rules(df, 'table', test_logger, rejected, rules=rules, references={'refs': pd.DataFrame({'id': [10]})})
+		quarantine = pd.concat(rejected, ignore_index=True)
+
+		# Nulls pass every check, later occurrences of a key or row are the duplicates
+		self.assertEqual(kept['key'].tolist(), [1, 4])
+		self.assertEqual(quarantine['reason'].tolist(), ['negative_value', 'bad_code;duplicate_key', 'unknown_ref', 'duplicate_key;duplicate_row'])
+		self.assertEqual(json.loads(quarantine['record'].iloc[0]), {'key': 2, 'value': -1.0, 'code': 'ab', 'ref': 10})
+		self.assertTrue((quarantine['source_table'] == 'table').all())
+
+		# Foreign keys are not checked without the referenced table, and nothing fails on a clean table
+		rejected = []
+		self.assertEqual(len(apply_quality_rules(df.iloc[[0, 3]], 'table', test_logger, rejected, rules=rules)), 2)
+		self.assertEqual(rejected, [])
+
+		# With `seen`, the keys of earlier chunks are duplicates too
+		rules = {'table': [('duplicate_key', 'unique', 'key', None)]}
+		seen = {}
+		kept = [apply_quality_rules(chunk, 'table', test_logger, [], rules=rules, seen=seen)['key'].tolist()
+				for chunk in [df.iloc[:2], df.iloc[2:4], df.iloc[4:]]]
+		self.assertEqual(kept, [[1, 2], [3], [4]])
+		self.assertEqual(seen, {'key': {1, 2, 3, 4}})
+
+
+	@mock.patch('pipeline.changelog', test_logger, create=True)
+	def test_conflicting_job_id_is_quarantined_not_published(self):
+		test_logger.info("Starting test: test_conflicting_job_id_is_quarantined_not_published")
+
+		# A job_id repeated with other values, which the INTEGER PRIMARY KEY of the published table cannot hold
+		dataframes = raw_frames()
+		df_jobs = dataframes['cademycode_student_jobs']
+		conflict = df_jobs.iloc[[0]].assign(avg_salary=df_jobs['avg_salary'].iloc[0] + 5000)
+		dataframes['cademycode_student_jobs'] = pd.concat([df_jobs, conflict], ignore_index=True)
+
+		rejected = []
+		df_students, df_jobs, df_courses = process_dataframes(dataframes, test_logger, rejected=rejected)
+		quarantine = pd.concat(rejected, ignore_index=True)
+		self.assertTrue(df_jobs['job_id'].is_unique)
+		self.assertIn('duplicate_job_id', quarantine.loc[quarantine['source_table'] == 'cademycode_student_jobs', 'reason'].tolist())
+
+		# Both ways of publishing take the tables, the first upsert falls back to a swap
+		for publish in [update_db_tables, functools.partial(upsert_db_tables, changelog=test_logger)]:
+			engine = self.memory_engine()
+			publish(engine, df_students, df_jobs, df_courses, rejected=rejected)
+			self.assertEqual(get_row_counts(engine)['cademycode_student_jobs'], len(df_jobs))
+
+
+	def test_quarantine_keeps_rejects_of_earlier_runs(self):
+		test_logger.info("Starting test: test_quarantine_keeps_rejects_of_earlier_runs")
+
+		tmp_dir, state_files = self.patch_state_files()
+		import pipeline
+		engine = create_db_engine(f"sqlite:///{state_files['DB_FILE']}")
+		self.addCleanup(engine.dispose)
+		def run(*options):
+			pipeline.main(parse_args(['--output-dir', tmp_dir, '--metrics-file', os.path.join(tmp_dir, 'metrics.jsonl'), *options]))
+			return pd.read_sql_table(QUARANTINE_TABLE, engine)['version'].value_counts().to_dict()
+		def add_students(*assignments):
+			with engine.begin() as connection:
+				for assignment in assignments:
+					connection.execute(text("INSERT INTO cademycode_students SELECT (SELECT MAX(uuid) + 1 FROM cademycode_students), name, dob, "
+											"sex, contact_info, job_id, num_course_taken, current_career_path_id, time_spent_hrs "
+											"FROM cademycode_students WHERE uuid = (SELECT MIN(uuid) FROM cademycode_students)"))
+					connection.execute(text(f"UPDATE cademycode_students SET {assignment} WHERE uuid = (SELECT MAX(uuid) FROM cademycode_students)"))
+
+		# The full run quarantines the source's bad rows and publishes only the good ones
+		first = run()
+		self.assertEqual(first, {'1.0.1': sum(len(df) for df in session_frames()[2])})
+
+		# The incremental run adds the rejects of its delta
+		add_students('time_spent_hrs = -1', 'job_id = NULL')
+		second = run('--incremental')
+		self.assertEqual(second, dict(first, **{'1.0.2': 2}))
+
+		# The next full run re-reads the published tables, the rejected rows exist only in the quarantine and stay there
+		add_students('name = name')
+		self.assertEqual(run(), second)
+		with open(state_files['VERSION_FILE']) as f:
+			self.assertEqual(f.read().strip(), '1.0.3')
+
+
+	def test_incremental_run_appends_new_students(self):
+		test_logger.info("Starting test: test_incremental_run_appends_new_students")
+
+		tmp_dir, state_files = self.patch_state_files()
+		import pipeline
+		args = parse_args(['--output-dir', tmp_dir, '--metrics-file', os.path.join(tmp_dir, 'metrics.jsonl')])
+		pipeline.main(args)
+		merged_df = pd.read_csv(os.path.join(tmp_dir, 'merged_data.csv'))
+
+		# A valid student reaches the export of the incremental run, which appends it to the output
+		engine = create_db_engine(f"sqlite:///{state_files['DB_FILE']}")
+		self.addCleanup(engine.dispose)
+		uuid = merged_df['uuid'].iloc[0]
+		with engine.begin() as connection:
+			connection.execute(text("INSERT INTO cademycode_students SELECT (SELECT MAX(uuid) + 1 FROM cademycode_students), name, dob, "
+									"sex, contact_info, job_id, num_course_taken, current_career_path_id, time_spent_hrs "
+									f"FROM cademycode_students WHERE uuid = {uuid}"))
+		pipeline.main(parse_args(['--incremental', '--output-dir', tmp_dir, '--metrics-file', os.path.join(tmp_dir, 'metrics.jsonl')]))
+
+		appended_df = pd.read_csv(os.path.join(tmp_dir, 'merged_data.csv'))
+		self.assertEqual(len(appended_df), len(merged_df) + 1)
+		self.assertEqual(appended_df['uuid'].iloc[-1], merged_df['uuid'].max() + 1)
+		with open(state_files['VERSION_FILE']) as f:
+			self.assertEqual(f.read().strip(), '1.0.2')
+		self.assertFalse(os.path.exists(state_files['RUN_STATE_FILE']))
+
+
+	@mock.patch('pipeline.changelog', test_logger, create=True)
+	def test_update_db_tables_keeps_primary_keys(self):
+		test_logger.info("Starting test: test_update_db_tables_keeps_primary_keys")
+
+		engine = self.memory_engine()
+		df_students, df_jobs, df_courses = cleaned_frames()
+		update_db_tables(engine, df_students, df_jobs, df_courses, batch_size=1000)
+
+		inspector = inspect(engine)
+		self.assertFalse([name for name in inspector.get_table_names() if name.endswith('2')], "Staging tables should be renamed")
+		self.assertListEqual(inspector.get_pk_constraint('cademycode_students')['constrained_columns'], ['uuid'])
+		self.assertListEqual(inspector.get_pk_constraint('cademycode_student_jobs')['constrained_columns'], ['job_id'])
+		self.assertListEqual(inspector.get_pk_constraint('cademycode_courses')['constrained_columns'], ['career_path_id'])
+		self.assertEqual(get_row_counts(engine)['cademycode_students'], len(df_students))
+
+
+	@mock.patch('pipeline.changelog', test_logger, create=True)
+	def test_update_db_tables_quarantines_repeated_keys(self):
+		test_logger.info("Starting test: test_update_db_tables_quarantines_repeated_keys")
+
+		# Tables that did not go through the quality rules still publish, the repeated key is quarantined
+		engine = self.memory_engine()
+		df_students, df_jobs, df_courses = cleaned_frames()
+		df_jobs = pd.concat([df_jobs, df_jobs.iloc[[0]].assign(avg_salary=1)], ignore_index=True)
+		update_db_tables(engine, df_students, df_jobs, df_courses, rejected=[])
+
+		published = pd.read_sql_table('cademycode_student_jobs', engine)
+		self.assertEqual(len(published), len(df_jobs) - 1)
+		self.assertNotIn(1, published['avg_salary'].tolist())
+		quarantine = pd.read_sql_table(QUARANTINE_TABLE, engine)
+		self.assertEqual(quarantine['reason'].tolist(), ['duplicate_job_id'])
+
+
+	@mock.patch('pipeline.changelog', test_logger, create=True)
+	def test_upsert_db_tables_applies_only_changes(self):
+		test_logger.info("Starting test: test_upsert_db_tables_applies_only_changes")
+
+		engine = self.memory_engine()
+
+		# The raw tables have no primary key yet, so the first upsert replaces them
+		df_students, df_jobs, df_courses = cleaned_frames()
+		self.assertEqual(upsert_db_tables(engine, df_students, df_jobs, df_courses, test_logger), {})
+		with engine.begin() as connection:
+			connection.execute(text("CREATE INDEX ix_students_name ON cademycode_students (name)"))
+
+		# One student changed, one removed and one added
+		df_students = df_students.copy()
+		df_students.loc[df_students.index[0], 'time_spent_hrs'] = 99.5
+		removed_uuid = int(df_students['uuid'].iloc[1])
+		new_student = df_students.iloc[[2]].assign(uuid=999999)
+		df_students = pd.concat([df_students.drop(df_students.index[1]), new_student])
+
+		counts = upsert_db_tables(engine, df_students, df_jobs, df_courses, test_logger, batch_size=1000)
+		self.assertDictEqual(counts['cademycode_students'],
+							 {'inserted': 1, 'updated': 1, 'deleted': 1, 'unchanged': len(df_students) - 2})
+		self.assertDictEqual(counts['cademycode_courses'],
+							 {'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': len(df_courses)})
+
+		published = pd.read_sql_table('cademycode_students', engine).set_index('uuid')
+		self.assertEqual(len(published), len(df_students))
+		self.assertEqual(published.loc[int(df_students['uuid'].iloc[0]), 'time_spent_hrs'], 99.5)
+		self.assertNotIn(removed_uuid, published.index)
+		self.assertIn(999999, published.index)
+		self.assertIn('ix_students_name', [index['name'] for index in inspect(engine).get_indexes('cademycode_students')])
+
+
+	def test_merged_table_is_indexed_and_maintained(self):
+		test_logger.info("Starting test: test_merged_table_is_indexed_and_maintained")
+
+		engine = self.memory_engine()
+
+		df_students, df_jobs, df_courses = cleaned_frames()
+		merged_df = merge_df(df_students, df_jobs, df_courses, test_logger)
+
+		# Publishing twice replaces the table without clashing with its own indexes
+		for _ in range(2):
+			self.assertEqual(publish_merged_table(engine, merged_df, test_logger, summary=True), len(merged_df))
+		indexed = [index['column_names'] for index in inspect(engine).get_indexes(MERGED_TABLE)]
+		self.assertCountEqual(indexed, [['job_id'], ['current_career_path_id']])
+		with engine.connect() as connection:
+			plan = connection.execute(text(f"EXPLAIN QUERY PLAN SELECT * FROM {MERGED_TABLE} WHERE job_id = 3")).fetchall()
+			self.assertIn('USING INDEX', str(plan))
+			self.assertEqual(connection.execute(text(f"SELECT SUM(students) FROM {SUMMARY_TABLE}")).scalar(), len(merged_df))
+
+		# A new student is upserted and a changed job is copied onto every student that has it
+		new_student = merged_df.iloc[[0]].assign(uuid=999999)
+		changed_job = df_jobs[df_jobs['job_id'] == 3].assign(avg_salary=12345)
+		self.assertEqual(upsert_merged_table(engine, new_student, changed_job, None, test_logger, summary=True), 1)
+
+		published = pd.read_sql_table(MERGED_TABLE, engine)
+		self.assertEqual(len(published), len(merged_df) + 1)
+		self.assertIn(999999, published['uuid'].values)
+		self.assertTrue((published.loc[published['job_id'] == 3, 'avg_salary'] == 12345).all())
+		with engine.connect() as connection:
+			self.assertEqual(connection.execute(text(f"SELECT SUM(students) FROM {SUMMARY_TABLE}")).scalar(), len(merged_df) + 1)
+
+
+	@mock.patch('pipeline.changelog', test_logger, create=True)
+	def test_update_db_tables_failure_keeps_old_tables(self):
+		test_logger.info("Starting test: test_update_db_tables_failure_keeps_old_tables")
+
+		engine = self.memory_engine()
+		df_students, df_jobs, df_courses = cleaned_frames()
+
+		# A value SQLite cannot bind makes the staging load fail before anything is published
+		df_students['name'] = df_students['name'].astype(object)
+		df_students.loc[df_students.index[-1], 'name'] = object()
+		with self.assertRaises(Exception):
+			update_db_tables(engine, df_students, df_jobs, df_courses, batch_size=1000)
+
+		row_counts = get_row_counts(engine)
+		self.assertEqual(row_counts['cademycode_students'], source_row_counts()['cademycode_students'])
+		self.assertEqual(row_counts['cademycode_student_jobs'], source_row_counts()['cademycode_student_jobs'])
+		# The half-loaded staging tables are dropped again
+		self.assertFalse([table for table in inspect(engine).get_table_names() if table.endswith('2')])
+
+
+
+	@mock.patch('pipeline.logging.getLogger')
+	def test_process_students_applies_column_spec(self, mock_getLogger):
+		mock_getLogger.return_value = test_logger
+		test_logger.info("Starting test: test_process_students_applies_column_spec")
+
+		df_students = pd.DataFrame({
+			'uuid': [1, 2, 3, 4],
+			'name': ['a', 'b', None, 'd'],
+			'dob': ['2000-01-01', 'not a date', None, '1990-05-06 00:00:00.000000'],
+			'job_id': ['1.0', 'x', '3.0', None],
+			'time_spent_hrs': ['1.5', '2', '3', '4'],
+		})
+		spec = {
+			'uuid': ('int32', 'drop'),
+			'name': ('string', 'keep'),
+			'dob': ('datetime64[ns]', 'keep'),
+			'job_id': ('int32', 'drop'),
+			'time_spent_hrs': ('float64', 'drop'),
+		}
+		df_clean = process_students(df_students, test_logger, spec)
+
+		# Unparsable and missing job ids are dropped, missing names and dates are kept
+		self.assertListEqual(df_clean['uuid'].tolist(), [1, 3])
+		self.assertListEqual(list(df_clean.columns), list(df_students.columns))
+		self.assertEqual(df_clean['job_id'].dtype, 'int32')
+		self.assertEqual(df_clean['dob'].dtype, 'datetime64[ns]')
+		self.assertTrue(pd.isna(df_clean['name'].iloc[1]))
+
+
+
+	@mock.patch('pipeline.logging.getLogger')
+	def test_generate_cademycode_db_matches_source_schema(self, mock_getLogger):
+		mock_getLogger.return_value = test_logger
+		test_logger.info("Starting test: test_generate_cademycode_db_matches_source_schema")
+
+		tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmp_dir)
+		db_path = generate_cademycode_db(os.path.join(tmp_dir, 'synthetic.db'), 3000, batch_size=1000)
+		engine = create_db_engine(f"sqlite:///{db_path}")
+		self.addCleanup(engine.dispose)
+
+		for table_name in ['cademycode_students', 'cademycode_student_jobs', 'cademycode_courses']:
+			synthetic_columns = [(column['name'], str(column['type'])) for column in inspect(engine).get_columns(table_name)]
+			real_columns = [(column['name'], str(column['type'])) for column in inspect(self.engine).get_columns(table_name)]
+			self.assertListEqual(synthetic_columns, real_columns)
+		dataframes = get_dataframes(engine, test_logger)
+		self.assertEqual(len(dataframes['cademycode_students']), 3000)
+		self.assertTrue(dataframes['cademycode_student_jobs'].duplicated().any())
+
+		df_students, df_jobs, df_courses = process_dataframes(dataframes, test_logger)
+		self.assertLess(len(df_students), 3000)
+		self.assertEqual(len(merge_df(df_students, df_jobs, df_courses, test_logger)), len(df_students))
+
+
+
+	def test_stage_records_metrics(self):
+		test_logger.info("Starting test: test_stage_records_metrics")
+
+		metrics = []
+		with stage('clean', metrics, '1.2.3', rows_in=10) as record:
+			record['rows_out'] = 8
+		with self.assertRaises(ValueError):
+			with stage('publish', metrics, '1.2.3'):
+				raise ValueError('publish failed')
+
+		self.assertListEqual([record['stage'] for record in metrics], ['clean', 'publish'])
+		self.assertListEqual([record['status'] for record in metrics], ['ok', 'error'])
+		self.assertEqual(metrics[0]['rows_in'], 10)
+		self.assertEqual(metrics[0]['rows_out'], 8)
+		for key in ['wall_seconds', 'cpu_seconds', 'peak_rss_kb']:
+			self.assertGreaterEqual(metrics[0][key], 0)
+
+		tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmp_dir)
+		metrics_path = os.path.join(tmp_dir, 'metrics.jsonl')
+		write_metrics(metrics, metrics_path, 'run-1')
+		with open(metrics_path, 'r') as file:
+			lines = [json.loads(line) for line in file]
+		self.assertEqual(len(lines), 2)
+		self.assertEqual(lines[0]['run_id'], 'run-1')
+
+		prometheus_path = os.path.join(tmp_dir, 'pipeline.prom')
+		write_prometheus_metrics(metrics, prometheus_path)
+		with open(prometheus_path, 'r') as file:
+			content = file.read()
+		self.assertIn('pipeline_stage_rows_out{stage="clean",version="1.2.3"} 8', content)
+		self.assertIn('# TYPE pipeline_stage_wall_seconds gauge', content)
+
+
+
+	@mock.patch('pipeline.logging.getLogger')
+	def test_detect_changes_reports_changed_tables(self, mock_getLogger):
+		mock_getLogger.return_value = test_logger
+		test_logger.info("Starting test: test_detect_changes_reports_changed_tables")
+
+		engine = self.memory_engine()
+
+		states = {detector: get_change_state(engine, detector) for detector in ['counts', 'rowid', 'hash']}
+		for detector, state in states.items():
+			changed_tables, _ = detect_changes(engine, state, test_logger, detector)
+			self.assertEqual(changed_tables, set(), f"Nothing changed for {detector}")
+
+		# An in-place update is only visible to the content hash
+		with engine.begin() as connection:
+			connection.execute(text("UPDATE cademycode_student_jobs SET avg_salary = avg_salary + 1 WHERE rowid = 1"))
+		self.assertEqual(detect_changes(engine, states['counts'], test_logger, 'counts')[0], set())
+		self.assertEqual(detect_changes(engine, states['rowid'], test_logger, 'rowid')[0], set())
+		self.assertEqual(detect_changes(engine, states['hash'], test_logger, 'hash')[0], {'cademycode_student_jobs'})
+
+		with engine.begin() as connection:
+			connection.execute(text("INSERT INTO cademycode_students (uuid, name) SELECT MAX(uuid) + 1, 'New Student' FROM cademycode_students"))
+		for detector in ['counts', 'rowid']:
+			changed_tables, _ = detect_changes(engine, states[detector], test_logger, detector)
+			self.assertEqual(changed_tables, {'cademycode_students'})
+
+
+	@mock.patch('pipeline.changelog', test_logger, create=True)
+	def test_update_db_tables_only_publishes_given_tables(self):
+		test_logger.info("Starting test: test_update_db_tables_only_publishes_given_tables")
+
+		engine = self.memory_engine()
+		df_students, df_jobs, df_courses = cleaned_frames()
+		update_db_tables(engine, df_students, df_jobs, df_courses, tables=['cademycode_students'])
+
+		row_counts = get_row_counts(engine)
+		self.assertEqual(row_counts['cademycode_students'], len(df_students))
+		self.assertEqual(row_counts['cademycode_student_jobs'], source_row_counts()['cademycode_student_jobs'], "Jobs should not be republished")
+		self.assertNotIn('cademycode_jobs2', get_table_names(engine))
+
+
+def run_names(names):
+	stream = io.StringIO()
+	result = unittest.TextTestRunner(stream=stream).run(unittest.defaultTestLoader.loadTestsFromNames(names))
+	return result.testsRun, len(result.failures) + len(result.errors), stream.getvalue()
+
+
+# Spread the tests over a pool of processes. Every test works on its own database copy and temporary directories,
+# and the cleaned frames are computed before the pool forks, so the workers share them. Each worker reads the
+# source database again rather than use a SQLite connection across the fork.
+def run_parallel(processes):
+	names = [test.id() for test in unittest.defaultTestLoader.loadTestsFromTestCase(TestPipelineFunctions)]
+	session_frames()
+	with concurrent.futures.ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('fork'),
+												  initializer=source_database.cache_clear) as executor:
+		results = list(executor.map(run_names, [names[index::processes] for index in range(processes)]))
+	for _, _, output in results:
+		sys.stderr.write(output)
+	failed = sum(failures for _, failures, _ in results)
+	sys.stderr.write(f"Ran {sum(tests_run for tests_run, _, _ in results)} tests on {processes} processes, {failed} failed\n")
+	return failed == 0
+
 
 if __name__ == '__main__':
-	unittest.main()
\ No newline at end of file
+	parser = argparse.ArgumentParser(add_help=False)
+	parser.add_argument('--processes', type=int, default=1)
+	options, argv = parser.parse_known_args()
+	if options.processes > 1:
+		sys.exit(0 if run_parallel(options.processes) else 1)
+	unittest.main(argv=sys.argv[:1] + argv)
\ No newline at end of file